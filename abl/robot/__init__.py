@@ -1,4 +1,7 @@
 from __future__ import absolute_import
 
 
-from .base import Robot, RobotCallError
+from .base import Robot, RobotCallError, RobotCallResult
+from .deadline import DeadlineExceeded
+from .locking import LockLost
+from .memory import MemoryLimitExceeded
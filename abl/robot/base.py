@@ -17,31 +17,44 @@ import inspect
 import logging
 import optparse
 import tempfile
-from time import time
+import itertools
+import socket
+import threading
+import traceback
+from time import time, sleep
 from textwrap import dedent
-from socket import error as socket_error
 
 from configobj import ConfigObj
 from validate import Validator
 
 from turbomail.control import interface
 from turbomail.message import Message
+from turbomail.wrappedmessage import WrappedMessage
 
 from errorreporter.reporter import (
     EmailReporter,
     XMLExceptionDumper,
     )
 
-from errorreporter.collector import collect_exception
-
 from abl.util import (
     Bunch,
-    LockFile,
     LockFileObtainException,
     LockFileCreationException,
     )
 
-from .mail import configure
+from .mail import configure, describe_message, MailQueue, RetryPolicy
+from .outbox import Outbox, OutboxFlusher
+from .streaming import Attachment, AttachmentPolicy, render_message, send_streamed
+from .locking import BACKENDS as LOCK_BACKENDS, LockLost
+from .sharding import partition, shard_name, splay_offset
+from .checkpoint import Checkpoint
+from .errors import CaptureLimits, DumpIndex, ShardedXMLDumper
+from .state import StateStore
+from .history import RunHistory, format_report, peak_rss, reset_peak_rss
+from .deadline import Deadline, DeadlineExceeded, DeadlineWatchdog
+from .memory import MemoryLimitExceeded, MemoryWatchdog, raise_in_thread
+from .isolation import ResourceLimits, wait_with_rusage
+from .trigger import make_watcher
 
 
 logger = logging.getLogger("abl.robot")
@@ -53,10 +66,50 @@ def nonose(func):
     return func
 
 
+class RobotEmailReporter(EmailReporter):
+    """
+    An `EmailReporter` that hands its messages to the
+    robot instead of the global turbomail-interface.
+    """
+
+    def __init__(self, deliver, **kwargs):
+        EmailReporter.__init__(self, **kwargs)
+        self.deliver = deliver
+
+
+    def report(self, exc_data):
+        subject, body = self.assemble_email(exc_data)
+        header_data = dict(
+            author=self.author,
+            to=self.to,
+            headers=[],
+            subject=subject,)
+        for plugin in self.plugins:
+            plugin.enrich_header_data(exc_data, header_data)
+
+        msg = Message(**header_data)
+        msg.encoding = "utf-8"
+        msg.plain = body
+        self.deliver(msg)
+
+
+
 class ErrorHandler(object):
     """
     Simple class to set up error-reporting
     based on config & the abl.errorreporter.
+
+    Timeouts of robots are reported with error.timeout_prefix
+    in the subject instead of error.prefix.
+
+    The capture.* options bound the cost of collecting
+    the exception, see `abl.robot.errors.CaptureLimits`.
+    The error.xml_* options configure the layout and retention
+    of the dumps, see `abl.robot.errors.ShardedXMLDumper`.
+
+    Unless error.index is False, the dumps are indexed in the
+    SQLite-database error.index_file, by default index.sqlite in
+    the dump-directory. See `abl.robot.errors` on querying it.
     """
 
     BODY_TEMPLATE = dedent("""
@@ -85,12 +138,30 @@ $all_lines
 
     def __init__(self, robot, error_config):
         reporters = []
+        self.robot_name = robot.name
+        self.prefix = error_config["error.prefix"]
+        self.timeout_prefix = error_config.get("error.timeout_prefix", self.prefix)
         self.viewer_prefix = None
+        self.xml_dumper = None
+        self.index_file = None
+        self.index = None
         if "error.xml_dir" in error_config:
-            xml_dumper = XMLExceptionDumper(outputdir=error_config["error.xml_dir"])
-            reporters.append(xml_dumper)
+            self.xml_dumper = ShardedXMLDumper(
+                outputdir=error_config["error.xml_dir"],
+                shards=error_config.get("error.xml_shards", 0),
+                compress=error_config.get("error.xml_compress", False),
+                max_age=error_config.get("error.xml_max_age", 0),
+                max_size=error_config.get("error.xml_max_size", 0),
+                prune_interval=error_config.get("error.xml_prune_interval", 3600.0),
+                )
+            self.prune_timeout = error_config.get("error.xml_prune_timeout", 60.0)
+            reporters.append(self.xml_dumper)
+            if error_config.get("error.index", True):
+                self.index_file = error_config.get("error.index_file") \
+                                  or os.path.join(error_config["error.xml_dir"], "index.sqlite")
         if error_config["mail.on"]:
-            email_reporter = EmailReporter(
+            email_reporter = RobotEmailReporter(
+                deliver=robot.send_message,
                 author=error_config.get("error.sender", robot.AUTHOR),
                 to=error_config.get("error.rcpt", robot.EXCEPTION_MAILING),
                 subject_template="%s $id_code $etype $edata" % error_config["error.prefix"],
@@ -100,46 +171,115 @@ $all_lines
             reporters.append(email_reporter)
             self.viewer_prefix = error_config.get("error.viewer_url")
         self.reporters = reporters
-
+        self.capture_limits = CaptureLimits.from_config(error_config)
 
 
     def enrich_message_data(self, exc_data, message_data):
         url = None
         if self.viewer_prefix:
+            if self.xml_dumper is not None:
+                path = self.xml_dumper.viewer_path(exc_data)
+            else:
+                path = os.path.splitext(XMLExceptionDumper.make_filename(exc_data))[0]
             url = "%(url_base)s/stack/%(path)s" % {
             'url_base' : self.viewer_prefix,
-            'path' : os.path.splitext(XMLExceptionDumper.make_filename(exc_data))[0],
+            'path' : path,
             }
         message_data["url"] = url
 
 
-    def enrich_header_data(self, *args, **kwargs):
-        pass
+    def enrich_header_data(self, exc_data, header_data):
+        etype = exc_data.exception_type
+        if isinstance(etype, type) and issubclass(etype, DeadlineExceeded):
+            header_data["subject"] = header_data["subject"].replace(
+                self.prefix, self.timeout_prefix, 1)
 
 
     def report_exception(self):
         exc_info = sys.exc_info()
-        exc_data = collect_exception(*exc_info)
+        exc_data = self.capture_limits.collect(exc_info)
+        path = None
         for reporter in self.reporters:
             try:
-                reporter.report(exc_data)
+                result = reporter.report(exc_data)
+                if reporter is self.xml_dumper:
+                    path = result
+            except:
+                sys.stderr.write(repr(sys.exc_info()[1]))
+        if self.index_file is not None:
+            try:
+                if self.index is None:
+                    self.index = DumpIndex(self.index_file)
+                self.index.add(exc_data, robot=self.robot_name, path=path)
             except:
                 sys.stderr.write(repr(sys.exc_info()[1]))
 
 
+    def flush(self):
+        """
+        Writes the pending entries of the index, and waits
+        for a pruning of the dumps to finish.
+        """
+        if self.index is not None:
+            self.index.flush()
+        if self.xml_dumper is not None and not self.xml_dumper.wait_for_pruning(self.prune_timeout):
+            logger.warn("Pruning %s didn't finish within %.1fs",
+                        self.xml_dumper.outputdir, self.prune_timeout)
+
+
 #-------------------------------------------------------------------------------
 
 class RobotCallError(Exception):
-    def __init__(self, cmd, ec, output):
+    def __init__(self, cmd, ec, output, call_id=None, rusage=None):
         self.cmd = cmd
         self.ec = ec  # error code
         self.output = output
+        self.call_id = call_id
+        self.rusage = rusage
 
     def __str__(self):
-        return "Subcommand %r exited with %i.\n Ouput was:\n%s" \
-            % ( " ".join(self.cmd), self.ec, "".join(self.output))
+        prefix = "[%s] " % self.call_id if self.call_id is not None else ""
+        return "%sSubcommand %r exited with %i.\n Ouput was:\n%s" \
+            % (prefix, " ".join(self.cmd), self.ec, "".join(self.output))
+
+
+
+class RobotCallResult(object):
+    """
+    The outcome of a successful `Robot.call`.
+
+    `rusage` is the `resource.struct_rusage` of the subprocess,
+    with e.g. its CPU-times ru_utime and ru_stime, its peak RSS
+    ru_maxrss in KB, and its block-I/O ru_inblock and ru_oublock.
+    """
+
+    def __init__(self, call_id, cmd, ec, output, elapsed_time, rusage=None):
+        self.call_id = call_id
+        self.cmd = cmd
+        self.ec = ec
+        self.output = output
+        self.elapsed_time = elapsed_time
+        self.rusage = rusage
+
+
+
+class CallLoggerAdapter(logging.LoggerAdapter):
+    """
+    Prefixes log-messages with the id of the `Robot.call` they
+    belong to, and makes it available as `call_id` to formatters.
+    """
+
+    def process(self, msg, kwargs):
+        kwargs.setdefault("extra", {}).update(self.extra)
+        return "[%s] %s" % (self.extra["call_id"], msg), kwargs
 
 
+_call_ids = itertools.count(1)
+
+_output_lock = threading.Lock()
+
+_call_stats_lock = threading.Lock()
+
 
 #-------------------------------------------------------------------------------
 
@@ -197,6 +337,205 @@ class Robot(object):
       [locking]
       filename = <lockfilename>
       terminate_when_locked = <bool> (optional, default=False)
+      backend = file|fcntl|sqlite|server (optional, default=file)
+
+    The backends are
+
+     - **file**: flock(2) on the local lockfile.
+     - **fcntl**: POSIX advisory locks on the lockfile, which
+       work on NFS with a lock-daemon.
+     - **sqlite**: a lease in the SQLite-database given by
+       `database`, keyed by the lockfile-name.
+     - **server**: a lease on a `abl.robot.locking.LockServer`
+       at `server = host:port`, keyed by the lockfile-name.
+
+    The leased backends (sqlite, server) keep their lease of
+    `lease` seconds alive by renewing it every `heartbeat` seconds,
+    and poll every `poll_interval` seconds while waiting for the lock.
+    If the lease can't be renewed, `LockLost` is raised in `work` -
+    right away, and again by `check_deadline`, `call` and `sendmail`.
+    Further backends can be registered in `LOCK_BACKENDS`.
+
+
+    Sharding
+    --------
+
+    A robot processing many items can be run as several instances,
+    each working on a disjoint slice. The slice is selected through
+    the "sharding"-section or the **--shard-index/--shard-count**
+    commandline-options:::
+
+      [sharding]
+      index = <0..count-1> (optional, default=0)
+      count = <int> (optional, default=1)
+
+    Inside `work`, use `shard` to filter the items for this instance.
+    Each shard uses its own lock, derived from the configured lock-name,
+    so the shards don't block each other.
+
+
+    Checkpoints
+    -----------
+
+    Long-running robots can record their progress in `self.checkpoint`,
+    a small key/value-store, and consult it on the next run to resume
+    where a failed run stopped:::
+
+      [checkpoint]
+      filename = <statefile> (optional, in-memory if not given)
+      flush_every = <int> (optional, default=100)
+      flush_interval = <seconds> (optional, default=5.0)
+      clear_on_success = <bool> (optional, default=True)
+
+    Updates are written atomically to disk after `flush_every` updates
+    or `flush_interval` seconds, and always when `work` terminates -
+    even when it is stopped hard after ignoring the deadline.
+    After a successful run, the checkpoint is cleared unless
+    `clear_on_success` is False. Sharded robots get one file per shard.
+
+
+    State
+    -----
+
+    In contrast to the checkpoint, `self.state` is kept across
+    successful runs. Use it to remember e.g. up to which point data
+    has been processed, so the next run only needs to look at what's
+    new. It supports `get`, `set` and `compare_and_set`, and is backed
+    by an SQLite-database:::
+
+      [state]
+      filename = <database> (optional, in-memory if not given)
+      commit_every = <int> (optional, default=100)
+      commit_interval = <seconds> (optional, default=5.0)
+
+    Pending updates are committed when `work` terminates, even if it
+    fails - so only record what has actually been done.
+
+
+    Deadline
+    --------
+
+    The runtime of `work` can be bounded, e.g. so a robot doesn't
+    overlap its next scheduled run:::
+
+      [deadline]
+      max_runtime = <seconds> (optional, default=0, unlimited)
+      grace = <seconds> (optional, default=30.0)
+
+    or with the commandline-option **--max-runtime**. When the deadline
+    passes, subprocesses started by `call` are terminated, and `call`,
+    `sendmail` and `check_deadline` raise `DeadlineExceeded`. Long
+    loops in `work` should call `check_deadline` regularly, and can
+    consult `remaining_time`. If `work` hasn't returned `grace` seconds
+    after the deadline, the timeout is reported and `terminate` ends
+    the process.
+
+
+    Splay
+    -----
+
+    Robots scheduled at the same time on many hosts can be spread
+    out by delaying `work` by a random, but for each robot, shard
+    and host fixed offset of up to `max` seconds:::
+
+      [splay]
+      max = <seconds> (optional, default=0, no delay)
+
+    or with the commandline-option **--splay**. The delay is taken
+    after the lock is obtained, so no other run can take it in the
+    meantime. It is shortened by the time spent waiting for the lock,
+    and skipped if it would reach the deadline or exceed the lease of
+    a leased lock. If the lease is lost anyway, the run is aborted
+    with `LockLost`.
+
+
+    Trigger
+    -------
+
+    Instead of being started by cron to look for new work, a robot
+    can keep running and watch paths - files, or directories
+    recursively - for changes:::
+
+      [trigger]
+      paths = <path>, ... (required)
+      debounce = <seconds> (optional, default=1.0)
+      max_delay = <seconds> (optional, default=30.0)
+      backend = auto|inotify|poll (optional, default=auto)
+      poll_interval = <seconds> (optional, default=2.0)
+
+    With the commandline-option **--trigger**, `run` calls
+    `work_on_changes` with the set of changed paths, once there were no
+    further changes for `debounce` seconds, or `max_delay` seconds after
+    the first one. By default, it just calls `work`. The first call gets
+    the watched paths themselves, to catch up with what happened before.
+    Each call is locked, limited and has its errors handled as in a
+    normal run, but without a splay, and the changes are kept for the
+    next one if the lock couldn't be obtained. inotify is used on Linux,
+    elsewhere - or with the poll-backend, e.g. for NFS - the paths are
+    compared every `poll_interval` seconds.
+
+
+    Subprocesses
+    ------------
+
+    The subprocesses started by `call` can be kept from
+    competing with other services on the host:::
+
+      [call]
+      nice = <niceness-increment> (optional)
+      ionice = idle|best-effort[:0..7]|realtime[:0..7] (optional)
+      cpu_time = <seconds> (optional)
+      address_space = <MB> (optional)
+      open_files = <int> (optional)
+      cpu_affinity = <cpu>, ... (optional)
+
+    These are defaults, each call can override them. Limits above
+    the current hard limit are lowered to it, and an invalid ionice
+    raises ValueError when the configuration is read.
+
+
+    Memory
+    ------
+
+    To keep leaking robots from taking down their host, the memory
+    usage can be limited:::
+
+      [memory]
+      soft_limit = <MB> (optional, default=0, unlimited)
+      hard_limit = <MB> (optional, default=0, unlimited)
+      interval = <seconds> (optional, default=1.0)
+      grace = <seconds> (optional, default=30.0)
+
+    While `run` is working, the resident set size is sampled every
+    `interval` seconds. At the soft limit, a warning is logged and
+    `memory_pressure` is called, which subclasses can override to
+    e.g. drop caches. At the hard limit, `MemoryLimitExceeded` is
+    raised in `work` and reported like any other error. As it only
+    arrives once `work` executes Python-code again, the process is
+    terminated if `work` hasn't returned `grace` seconds later. The peak
+    usage is available as "peak_memory" in `last_run`.
+
+
+    History
+    -------
+
+    Each run can be recorded with its start, duration, outcome, the
+    time spent waiting for the lock, the peak RSS, and the number and
+    time of `call` invocations:::
+
+      [history]
+      filename = <database> (optional, no history if not given)
+      max_runs = <int> (optional, default=1000)
+      flush_every = <int> (optional, default=10)
+      flush_interval = <seconds> (optional, default=60.0)
+
+    Only the latest `max_runs` runs are kept. Runs are written
+    after `flush_every` runs or `flush_interval` seconds, and when
+    the robot ends. The peak RSS is that of the run itself where
+    Linux allows to reset it, otherwise the peak seen by the memory
+    watchdog - or of the whole process for its first run. Run the robot with
+    **--stats** to print percentiles of the durations, and how
+    they developed over the last weeks.
 
 
     Mail
@@ -209,6 +548,71 @@ class Robot(object):
       [mail]
       transport = debug|smtp (optional, default=smtp)
       smtp.server = <smtp-server:port> (optional)
+      retry.attempts = <int> (optional, default=2)
+      retry.backoff = <seconds> (optional, default=1.0)
+      retry.backoff_max = <seconds> (optional, default=60.0)
+      retry.jitter = <0..1> (optional, default=0.5)
+      retry.codes = <smtp-codes> (optional, default=421, 450, 451, 452)
+      breaker.threshold = <int> (optional, default=5)
+      breaker.reset = <seconds> (optional, default=60.0)
+
+    `sendmail` retries deliveries failing with network-errors or one of
+    the `retry.codes`, waiting exponentially longer between attempts.
+    After `breaker.threshold` such failures in a row - across all mails
+    of the run - the relay is considered down, and for `breaker.reset`
+    seconds `sendmail` fails right away with `MailRelayUnavailable`.
+    A threshold of 0 turns this off.
+
+    To not depend on the relay at all while working, mails can be
+    spooled to an outbox-directory instead of being sent right away:::
+
+      [mail]
+      outbox.dir = <directory> (optional)
+      outbox.flush = exit|background|never (optional, default=exit)
+      outbox.batch = <int> (optional, default=100)
+      outbox.interval = <seconds> (optional, default=30.0)
+      outbox.max_attempts = <int> (optional, default=5)
+      outbox.claim_timeout = <seconds> (optional, default=3600.0)
+
+    With `exit`, the outbox is flushed when `run` ends, with `background`
+    additionally every `outbox.interval` seconds while working. Mails
+    that can't be delivered stay in the outbox. They, and the mails of
+    robots using `never`, are delivered by running the robot with
+    **--flush-outbox**, e.g. from cron. After `outbox.max_attempts`
+    failures, a mail is renamed to end in ".failed" instead. Mails
+    claimed by a flushing process that died are taken back - after
+    `outbox.claim_timeout` seconds if it ran on another host.
+
+    Mails can be delivered in the background, so the robot
+    doesn't wait for the relay:::
+
+      [mail]
+      manager = immediate|queue (optional, default=immediate)
+      queue.workers = <int> (optional, default=2)
+      queue.size = <int> (optional, default=100)
+      queue.drain_timeout = <seconds> (optional, default=30.0)
+
+    With `queue`, `sendmail` only blocks while `queue.size` mails are
+    waiting already. When `run` ends, it waits up to `queue.drain_timeout`
+    seconds for the queue to be delivered, and logs the mails that weren't.
+    Mails with streamed attachments are always sent right away.
+
+    Big attachments can be compressed, or left out of the mail:::
+
+      [mail]
+      attachments.compress = none|gzip|zip (optional, default=none)
+      attachments.compress_threshold = <bytes> (optional, default=1048576)
+      attachments.compress_level = <1..9> (optional, default=6)
+      attachments.max_size = <bytes> (optional, default=0)
+      attachments.artifact_dir = <directory> (optional)
+      attachments.artifact_url = <url> (optional)
+
+    Attachments bigger than `attachments.compress_threshold` are
+    compressed while being sent, unless their type is compressed
+    already. Those bigger than `attachments.max_size` (0 is unlimited)
+    are copied to `attachments.artifact_dir` instead, and the mail
+    links to them - below `attachments.artifact_url` if given, which
+    should be where the directory is served.
 
 
     Also there is the class-variable `AUTHOR` that should be
@@ -234,6 +638,16 @@ class Robot(object):
 
       - **--loglevel** to specify the log-level.
 
+      - **--shard-index/--shard-count** to select a slice of the work.
+
+      - **--stats** to print statistics of the recorded runs.
+
+      - **--max-runtime** to bound the runtime of `work`.
+
+      - **--splay** to delay `work` by a per-host offset.
+
+      - **--trigger** to work whenever the trigger-paths change.
+
 
     :ivar parser: the `optparse.OptionParser` for this robot.
 
@@ -257,11 +671,40 @@ class Robot(object):
         [locking]
         filename = string
         terminate_when_locked = boolean(default=True)
+        backend = string(default=file)
+        database = string(default=None)
+        server = string(default=localhost:7010)
+        lease = integer(min=1, default=60)
+        heartbeat = integer(min=1, default=20)
+        poll_interval = float(min=0, default=1.0)
         """),
         mail=dedent("""
         [mail]
         transport = option(smtp, debug, default=smtp)
+        manager = option(immediate, queue, default=immediate)
+        queue.workers = integer(min=1, default=2)
+        queue.size = integer(min=0, default=100)
+        queue.drain_timeout = float(min=0, default=30.0)
         smtp.server = string(default=localhost)
+        retry.attempts = integer(min=1, default=2)
+        retry.backoff = float(min=0, default=1.0)
+        retry.backoff_max = float(min=0, default=60.0)
+        retry.jitter = float(min=0, max=1, default=0.5)
+        retry.codes = int_list(default=list(421, 450, 451, 452))
+        breaker.threshold = integer(min=0, default=5)
+        breaker.reset = float(min=0, default=60.0)
+        outbox.dir = string(default=None)
+        outbox.flush = option(exit, background, never, default=exit)
+        outbox.batch = integer(min=1, default=100)
+        outbox.interval = float(min=0, default=30.0)
+        outbox.max_attempts = integer(min=1, default=5)
+        outbox.claim_timeout = float(min=0, default=3600.0)
+        attachments.compress = option(none, gzip, zip, default=none)
+        attachments.compress_threshold = integer(min=0, default=1048576)
+        attachments.compress_level = integer(min=1, max=9, default=6)
+        attachments.max_size = integer(min=0, default=0)
+        attachments.artifact_dir = string(default=None)
+        attachments.artifact_url = string(default=None)
         """),
         logging=dedent("""
         [logging]
@@ -276,12 +719,84 @@ class Robot(object):
         error.rcpt = string
         error.sender = string
         error.prefix = string(default='[Robot Stumbled]')
+        error.timeout_prefix = string(default='[Robot Timeout]')
+        error.xml_shards = integer(min=0, max=256, default=0)
+        error.xml_compress = boolean(default=False)
+        error.xml_max_age = float(min=0, default=0)
+        error.xml_max_size = integer(min=0, default=0)
+        error.xml_prune_interval = float(min=0, default=3600.0)
+        error.xml_prune_timeout = float(min=0, default=60.0)
+        error.index = boolean(default=True)
+        error.index_file = string(default=None)
         mail.on = boolean(default=False)
+        capture.max_frames = integer(min=1, default=50)
+        capture.max_locals = integer(min=0, default=50)
+        capture.max_repr = integer(min=10, default=1000)
+        capture.time_budget = float(min=0, default=2.0)
+        capture.size_budget = integer(min=0, default=1048576)
         """),
         pingback=dedent("""
         [pingback]
         url = string(default='')
         """),
+        sharding=dedent("""
+        [sharding]
+        index = integer(min=0, default=0)
+        count = integer(min=1, default=1)
+        """),
+        checkpoint=dedent("""
+        [checkpoint]
+        filename = string(default=None)
+        flush_every = integer(min=1, default=100)
+        flush_interval = float(min=0, default=5.0)
+        clear_on_success = boolean(default=True)
+        """),
+        deadline=dedent("""
+        [deadline]
+        max_runtime = float(min=0, default=0)
+        grace = float(min=0, default=30.0)
+        """),
+        splay=dedent("""
+        [splay]
+        max = float(min=0, default=0)
+        """),
+        trigger=dedent("""
+        [trigger]
+        paths = force_list(default=list())
+        debounce = float(min=0, default=1.0)
+        max_delay = float(min=0, default=30.0)
+        backend = option("auto", "inotify", "poll", default="auto")
+        poll_interval = float(min=0.01, default=2.0)
+        """),
+        call=dedent("""
+        [call]
+        nice = integer(min=-20, max=19, default=None)
+        ionice = string(default=None)
+        cpu_time = integer(min=1, default=None)
+        address_space = integer(min=1, default=None)
+        open_files = integer(min=1, default=None)
+        cpu_affinity = int_list(default=None)
+        """),
+        memory=dedent("""
+        [memory]
+        soft_limit = integer(min=0, default=0)
+        hard_limit = integer(min=0, default=0)
+        interval = float(min=0.01, default=1.0)
+        grace = float(min=0, default=30.0)
+        """),
+        history=dedent("""
+        [history]
+        filename = string(default=None)
+        max_runs = integer(min=1, default=1000)
+        flush_every = integer(min=1, default=10)
+        flush_interval = float(min=0, default=60.0)
+        """),
+        state=dedent("""
+        [state]
+        filename = string(default=None)
+        commit_every = integer(min=1, default=100)
+        commit_interval = float(min=0, default=5.0)
+        """),
         )
     """
     Used to validate the configuration options.
@@ -322,28 +837,76 @@ class Robot(object):
 
     LOCK_TERMINATION_MESSAGE = """Terminating because the lock was active."""
 
+    TIMEOUT_EXIT_CODE = 3
+    """
+    The exit-code of robots stopped by `terminate`.
+    """
+
+    mail_sink = None
+    """
+    If set to a `abl.robot.mail.MailSink`, all mails of this
+    robot are delivered there, and turbomail isn't configured.
+    """
+
+    LOCK_BACKENDS = LOCK_BACKENDS
+    """
+    The lock-backends selectable through the `backend`-option of
+    the locking-section. Subclasses can extend this dict with their
+    own lock-classes, which are instantiated as::
+
+      lock_class(lock_name, fail_on_lock=<bool>, config=<locking-section>)
+
+    and must be usable as context-manager.
+    """
+
 
     def __init__(self):
         self.parser = self.parser_with_default_options()
         self.add_options(self.parser)
         self.logger = self.get_logger()
+        self.call_count, self.call_time = 0, 0.0
+        self.deadline = self._watchdog = None
+        self._held_lock = None
+        self._peak_reset = False
+        self._recorded_runs = 0
+        self.call_limits = ResourceLimits()
+        self._working = False
+        self._working_lock = threading.Lock()
+        self._stop_watching = threading.Event()
 
 
 
-    def setup(self, argv=None):
+    def setup(self, argv=None, config=None):
+        """
+        Parse the commandline and set up configuration,
+        logging, error-handling and mail.
+
+        :Parameters:
+          argv : list<str>
+            The commandline, defaults to `sys.argv`.
+
+          config : dict|ConfigObj
+            If given, use this configuration instead of
+            loading it from a file.
+        """
         if argv is None:
             argv = sys.argv
 
         self.opts, self.rest = self.parser.parse_args(argv)
         self.raise_exceptions = self.opts.raise_exceptions
-        self.config = self._locate_config(self.opts.config)
+        if config is not None:
+            self.config = self._validated_config(config)
+        else:
+            self.config = self._locate_config(self.opts.config)
         self._setup_logging()
         self.error_handler = ErrorHandler(self, self.config.get('error_handler'))
-
-        mail_config = {}
-        if "mail" in self.config:
-            mail_config = self.config["mail"].dict()
-        configure(mail_config)
+        self._setup_sharding()
+        self._setup_deadline()
+        self.call_limits = ResourceLimits.from_config(self.config["call"])
+        self._setup_checkpoint()
+        self._setup_state()
+        self._setup_history()
+        self._setup_mail()
 
 
     def parser_with_default_options(self):
@@ -399,6 +962,47 @@ class Robot(object):
             """)
 
             )
+        g.add_option(
+            "--flush-outbox", default=False,
+            action="store_true",
+            help="Deliver the mails spooled in the outbox, instead of working."
+            )
+
+        g.add_option(
+            "--stats", default=False,
+            action="store_true",
+            help="Print statistics of the recorded runs, instead of working."
+            )
+
+        g.add_option(
+            "--max-runtime", default=None,
+            type="float",
+            help="Stop working after this many seconds."
+            )
+
+        g.add_option(
+            "--trigger", default=False,
+            action="store_true",
+            help="Keep running, and work whenever the trigger-paths change."
+            )
+
+        g.add_option(
+            "--splay", default=None,
+            type="float",
+            help="Delay working by up to this many seconds, fixed per host."
+            )
+
+        g.add_option(
+            "--shard-index", default=None,
+            type="int",
+            help="Work on the given slice (0-based) of the items."
+            )
+
+        g.add_option(
+            "--shard-count", default=None,
+            type="int",
+            help="Split the items into this many slices."
+            )
 
         parser.add_option_group(g)
 
@@ -413,35 +1017,435 @@ class Robot(object):
 
 
     def run(self):
+        """
+        Run `work` under the configured lock, and handle
+        errors. Returns the result of `work`.
+
+        With **--trigger**, `watch` is run instead.
+        """
         if self.opts.config_spec:
             self.print_config_spec()
             sys.exit(0)
         if self.opts.default_config:
             self.print_default_config()
             sys.exit(0)
+        if self.opts.flush_outbox:
+            self.flush_outbox()
+            sys.exit(0)
+        if self.opts.stats:
+            self.print_stats()
+            sys.exit(0)
+        try:
+            if self.opts.trigger:
+                return self.watch()
+            return self._run(self.work)
+        finally:
+            self._flush_history()
+
+
+    def _run(self, work, splay=True):
+        """
+        Calls `work` under the lock and the runtime-limits, handles
+        its errors, and records the run. Returns the result of `work`.
+        """
+        run_info = self.last_run = dict(start=time(), outcome="ok", lock_wait=0.0)
+        self._peak_reset = reset_peak_rss()
+        self.call_count, self.call_time = 0, 0.0
+        watchdog = None
+        if self.max_runtime:
+            self.deadline = Deadline(self.max_runtime)
+            work_thread = threading.currentThread()
+            watchdog = self._watchdog = DeadlineWatchdog(
+                self.deadline, self.deadline_grace,
+                on_hard_stop=lambda: self._hard_stop(work_thread),
+                )
+            watchdog.start()
+        memory_watchdog = None
+        cfg = self.config["memory"]
+        if cfg["soft_limit"] or cfg["hard_limit"]:
+            work_thread = threading.currentThread()
+            memory_watchdog = MemoryWatchdog(
+                cfg["soft_limit"] * 1024, cfg["hard_limit"] * 1024,
+                on_soft=self._memory_soft_limit,
+                on_hard=lambda rss: self._memory_hard_limit(rss, work_thread),
+                interval=cfg["interval"],
+                grace=cfg["grace"],
+                on_hard_stop=lambda: self._memory_hard_stop(work_thread),
+                )
+            memory_watchdog.start()
+        flusher = None
+        if self.outbox is not None and self.outbox_flush == "background":
+            flusher = OutboxFlusher(self.outbox, self.deliver_message,
+                                    interval=self.outbox_interval,
+                                    batch=self.outbox_batch)
+            flusher.start()
+        try:
+            try:
+                lock_start = time()
+                lock = self._locking_context()
+                if hasattr(lock, "on_lost"):
+                    work_thread = threading.currentThread()
+                    lock.on_lost = lambda: self._lock_lost(work_thread)
+                with lock:
+                    self._held_lock = lock
+                    run_info["lock_wait"] = time() - lock_start
+                    if splay:
+                        run_info["splay"] = self._splay(lock, run_info["lock_wait"])
+                    try:
+                        with self._working_lock:
+                            self._working = True
+                        try:
+                            result = work()
+                        finally:
+                            self._stop_working()
+                    finally:
+                        self.checkpoint.flush()
+                        self.state.commit()
+                    if self.config["checkpoint"]["clear_on_success"]:
+                        self.checkpoint.clear()
+                pingback_url = self.config["pingback"]["url"]
+                if pingback_url:
+                    try:
+                        res = urlopen(pingback_url % self.name)
+                        res.read()
+                    except:
+                        self.logger.exception("Couldn't ping %s." % pingback_url)
+                return result
+            except LockFileObtainException:
+                run_info.update(outcome="locked", lock_wait=time() - lock_start)
+                self.logger.info(self.LOCK_TERMINATION_MESSAGE)
+            except LockFileCreationException:
+                run_info["outcome"] = "lock_error"
+                self.logger.error("Couldn't create a lockfile.")
+            except LockLost:
+                run_info["outcome"] = "lock_lost"
+                if self.raise_exceptions:
+                    raise
+                self.error_handler.report_exception()
+            except DeadlineExceeded:
+                run_info["outcome"] = "timeout"
+                if self.raise_exceptions:
+                    raise
+                self.logger.error("Stopped at the deadline after %.1fs", self.max_runtime)
+                self.error_handler.report_exception()
+            except MemoryLimitExceeded:
+                run_info["outcome"] = "memory"
+                if self.raise_exceptions:
+                    raise
+                self.error_handler.report_exception()
+            except (KeyboardInterrupt, SystemExit):
+                run_info["outcome"] = "interrupted"
+            except:
+                run_info["outcome"] = "error"
+                if self.raise_exceptions:
+                    raise
+                self.error_handler.report_exception()
+        finally:
+            self._held_lock = None
+            if watchdog is not None:
+                watchdog.stop()
+                self._watchdog = None
+            if memory_watchdog is not None:
+                memory_watchdog.stop()
+                run_info["peak_memory"] = memory_watchdog.peak
+                self.logger.info("Peak memory usage: %.1fMB", memory_watchdog.peak / 1024.0)
+            # a failing step must neither keep the others from running
+            # nor replace the outcome of work
+            self._cleanup(self.error_handler.flush, "flush the error-reports")
+            self._cleanup(self.close_mail_queue, "close the mail-queue")
+            if flusher is not None:
+                self._cleanup(flusher.stop, "stop the outbox-flusher")
+            if self.outbox is not None and self.outbox_flush != "never":
+                self._cleanup(self.flush_outbox, "flush the outbox")
+            self._cleanup(lambda: self._record_run(run_info), "record the run")
+
+
+    def watch(self):
+        """
+        Calls `work_on_changes` with the changed paths whenever
+        the trigger-paths change, until `stop_watching` is called
+        or the robot is interrupted.
+        """
+        cfg = self.config["trigger"]
+        if not cfg["paths"]:
+            self.error_message("Please configure the paths of the trigger-section.")
+        watcher = make_watcher(cfg["paths"], backend=cfg["backend"],
+                               poll_interval=cfg["poll_interval"])
+        self.logger.info("Watching %s via %s", ", ".join(watcher.paths), watcher.__class__.__name__)
+        self._stop_watching.clear()
+        pending = set(watcher.paths)
         try:
-            with self._locking_context():
-                self.work()
-            pingback_url = self.config["pingback"]["url"]
-            if pingback_url:
+            while True:
+                if pending:
+                    # the splay would only add latency here
+                    self._run(lambda paths=frozenset(pending): self.work_on_changes(paths),
+                              splay=False)
+                    outcome = self.last_run["outcome"]
+                    if outcome == "interrupted":
+                        break
+                    if outcome in ("locked", "lock_error"):
+                        self.logger.info("Keeping %i changes for the next run", len(pending))
+                    else:
+                        pending = set()
+                if self._stop_watching.isSet():
+                    break
                 try:
-                    res = urlopen(pingback_url % self.name)
-                    res.read()
-                except:
-                    self.logger.exception("Couldn't ping %s." % pingback_url)
-        except LockFileObtainException:
-            self.logger.info(self.LOCK_TERMINATION_MESSAGE)
-        except LockFileCreationException:
-            self.logger.error("Couldn't create a lockfile.")
-        except (KeyboardInterrupt, SystemExit):
-            pass
-        except:
-            if self.raise_exceptions:
-                raise
+                    pending.update(watcher.wait(cfg["debounce"], cfg["max_delay"],
+                                                stop=self._stop_watching))
+                except KeyboardInterrupt:
+                    break
+        finally:
+            watcher.close()
+
+
+    def work_on_changes(self, paths):
+        """
+        Called by `watch` with the set of changed paths. Override
+        this to make use of them, by default it calls `work`.
+        """
+        return self.work()
+
+
+    def stop_watching(self):
+        """
+        Ends `watch` after the current run, if any.
+        """
+        self._stop_watching.set()
+
+
+    def memory_pressure(self, rss):
+        """
+        Called from a background-thread when the memory usage
+        reaches the soft limit. Override to free memory.
+
+        :param rss: the resident set size in KB
+        """
+
+
+    def _memory_soft_limit(self, rss):
+        self.logger.warn("Memory usage of %.1fMB reached the soft limit of %iMB",
+                         rss / 1024.0, self.config["memory"]["soft_limit"])
+        self.memory_pressure(rss)
+
+
+    def _memory_hard_limit(self, rss, work_thread):
+        self.logger.error("Memory usage of %.1fMB reached the hard limit of %iMB, aborting",
+                          rss / 1024.0, self.config["memory"]["hard_limit"])
+        with self._working_lock:
+            if self._working:
+                raise_in_thread(work_thread, MemoryLimitExceeded)
+
+
+    def _stop_working(self):
+        """
+        Ends the window in which `_memory_hard_limit` and `_lock_lost`
+        raise in the working thread - also if their exception
+        arrives only now.
+        """
+        while True:
+            try:
+                with self._working_lock:
+                    self._working = False
+                    # too late to abort work, so it's dropped
+                    raise_in_thread(threading.currentThread(), None)
+                return
+            except (MemoryLimitExceeded, LockLost):
+                pass
+
+
+    def _lock_lost(self, work_thread):
+        self.logger.error("Lost the lock, aborting")
+        with self._working_lock:
+            if self._working:
+                raise_in_thread(work_thread, LockLost)
+
+
+    def check_deadline(self):
+        """
+        Raise `DeadlineExceeded` if the robot has worked
+        longer than `max_runtime`, and `LockLost` if its
+        leased lock was lost.
+        """
+        if self.deadline is not None:
+            self.deadline.check()
+        check = getattr(self._held_lock, "check", None)
+        if check is not None:
+            check()
+
+
+    def splay_offset(self):
+        """
+        The delay of `work` for this robot, shard and host.
+        """
+        return splay_offset(self.splay, self.name, self.shard_index, socket.gethostname())
+
+
+    def _splay(self, lock, lock_wait):
+        """
+        Sleeps for the splay-offset, less the time spent waiting
+        for the lock. Returns the seconds actually slept.
+
+        Raises `LockLost` if a leased lock is lost meanwhile.
+        """
+        delay = self.splay_offset() - lock_wait
+        if delay <= 0:
+            return 0.0
+        remaining = self.remaining_time()
+        if remaining is not None and delay >= remaining:
+            self.logger.warn("Skipping the splay of %.1fs, only %.1fs are left until the deadline",
+                             delay, remaining)
+            return 0.0
+        lease = getattr(lock, "lease", None)
+        if lease is not None and delay >= lease:
+            self.logger.warn("Skipping the splay of %.1fs, it exceeds the lease of %ss",
+                             delay, lease)
+            return 0.0
+        self.logger.info("Splaying the start by %.1fs", delay)
+        check = getattr(lock, "check", lambda: None)
+        start = time()
+        end = start + delay
+        while time() < end:
+            check()
+            sleep(max(min(end - time(), 1.0), 0))
+        check()
+        return time() - start
+
+
+    def remaining_time(self):
+        """
+        The seconds left until the deadline, or None
+        without `max_runtime`.
+        """
+        if self.deadline is not None:
+            return self.deadline.remaining()
+        return None
+
+
+    def _hard_stop(self, work_thread):
+        self.logger.error("work didn't stop within %.1fs after the deadline", self.deadline_grace)
+        self._abort(DeadlineExceeded(
+            "Work didn't stop within %.1fs after the maximum runtime of %.1fs, it was at:\n%s"
+            % (self.deadline_grace, self.max_runtime, self._stack_of(work_thread))), "timeout")
+
+
+    def _memory_hard_stop(self, work_thread):
+        grace = self.config["memory"]["grace"]
+        self.logger.error("work didn't stop within %.1fs after the hard memory-limit", grace)
+        self._abort(MemoryLimitExceeded(
+            "Work didn't stop within %.1fs after the hard memory-limit, it was at:\n%s"
+            % (grace, self._stack_of(work_thread))), "memory")
+
+
+    def _stack_of(self, thread):
+        frame = sys._current_frames().get(thread.ident)
+        return "".join(traceback.format_stack(frame)) if frame is not None else ""
+
+
+    def _abort(self, exc, outcome):
+        """
+        Reports `exc`, saves what can be saved of the current
+        run with `outcome`, and terminates.
+        """
+        try:
+            raise exc
+        except exc.__class__:
             self.error_handler.report_exception()
+        # keep the progress made so far for the next run
+        self._cleanup(self.checkpoint.flush, "flush the checkpoint")
+        self._cleanup(self.state.commit, "commit the state")
+        self._cleanup(self.error_handler.flush, "flush the error-reports")
+        self._cleanup(self.close_mail_queue, "close the mail-queue")
+        self.last_run["outcome"] = outcome
+        self._cleanup(lambda: self._record_run(self.last_run), "record the run")
+        self._flush_history()
+        self.terminate()
+
+
+    def _cleanup(self, step, what):
+        """
+        Calls `step`, logging its errors instead of raising them.
+        """
+        try:
+            step()
+        except Exception:
+            self.logger.exception("Couldn't %s", what)
+
+
+    def terminate(self):
+        """
+        Ends the process right away with `TIMEOUT_EXIT_CODE`, after
+        `work` ignored the deadline or the hard memory-limit for
+        its grace-period.
+        """
+        logging.shutdown()
+        os._exit(self.TIMEOUT_EXIT_CODE)
+
+
+    def _record_run(self, run_info):
+        if self._peak_reset or not self._recorded_runs:
+            peak = peak_rss()
+        else:
+            # the peak of the process would be taken for that of each run
+            peak = run_info.get("peak_memory")
+        self._recorded_runs += 1
+        run_info.update(
+            duration=time() - run_info["start"],
+            peak_rss=peak,
+            calls=self.call_count,
+            call_time=self.call_time,
+            )
+        if self.history is None:
+            return
+        try:
+            self.history.record(robot=self.name, shard=self.shard_index, **run_info)
+        except Exception:
+            self.logger.exception("Couldn't record the run in %s", self.history.filename)
+
+
+    def _flush_history(self):
+        if self.history is None:
+            return
+        try:
+            self.history.flush()
+        except Exception:
+            self.logger.exception("Couldn't record the runs in %s", self.history.filename)
+
+
+    def print_stats(self):
+        if self.history is None:
+            self.error_message("No run-history configured, see the history-section.")
+        print format_report(self.history.report(self.name))
 
 
     def sendmail(self, subject, to, text=None, attachments=()):
+        """
+        Send a mail from `AUTHOR`.
+
+        :Parameters:
+          subject : str|unicode
+            The subject.
+
+          to : str|list<str>
+            The recipient(s).
+
+          text : str|unicode
+            The plain-text body.
+
+          attachments : list
+            Each attachment is either a tuple of (name, content),
+            or an `abl.robot.streaming.Attachment` for content read
+            from a file or iterable. Mails with the latter are
+            streamed onto the SMTP-connection without being assembled
+            in memory - unless they go to a `mail_sink` or the outbox.
+
+        Big attachments are compressed or replaced by links
+        as configured in the mail-section.
+        """
+        self.check_deadline()
+        if self.attachment_policy.active:
+            text, attachments = self.attachment_policy.apply(text, attachments)
+        if any(isinstance(a, Attachment) for a in attachments):
+            return self._sendmail_streamed(subject, to, text, attachments)
         message = Message(encoding="utf-8")
         message.author = self.AUTHOR
         message.subject = subject
@@ -451,16 +1455,104 @@ class Robot(object):
         message.plain = text
         for name, attachment in attachments:
             message.attach(StringIO(attachment), name)
-        tries = 2
-        while tries > 0:
-            try:
-                interface.send(message)
-            except socket_error:
-                tries -= 1
-                if not tries:
-                    raise
-            else:
+        self.send_message(message)
+
+
+    def _sendmail_streamed(self, subject, to, text, attachments):
+        recipients = [to] if isinstance(to, basestring) else list(to)
+        if text is None:
+            text = " "
+        render = lambda: render_message(self.AUTHOR, recipients, subject, text, attachments)
+        cfg = self.mail_config
+        if self.mail_sink is not None or self.outbox is not None \
+               or cfg.get("transport", "smtp") != "smtp":
+            message = WrappedMessage(self.AUTHOR, recipients, "".join(render()))
+            return self.send_message(message)
+        return self.mail_retry(
+            lambda: send_streamed(
+                cfg.get("smtp.server", "localhost"),
+                self.AUTHOR,
+                recipients,
+                render(),
+                username=cfg.get("smtp.username"),
+                password=cfg.get("smtp.password"),
+                tls=cfg.get("smtp.tls"),
+                ))
+
+
+    def send_message(self, message):
+        """
+        Send a turbomail `Message`, or spool it if
+        an outbox is configured, or queue it for the
+        background-workers.
+        """
+        if self.outbox is not None:
+            return self.outbox.spool(message)
+        if self.mail_manager == "queue":
+            with self._mail_queue_lock:
+                if self.mail_queue is None:
+                    self.mail_queue = MailQueue(self.deliver_message,
+                                                workers=self.mail_queue_workers,
+                                                size=self.mail_queue_size)
+            return self.mail_queue.put(message)
+        return self.deliver_message(message)
+
+
+    def deliver_message(self, message, send=None):
+        """
+        Deliver a turbomail `Message` right away, either through
+        the `mail_sink` or turbomail, retrying according to
+        the mail-configuration.
+
+        :param send: delivers through turbomail, defaults
+                     to `interface.send`.
+        """
+        if self.mail_sink is not None:
+            return self.mail_retry(self.mail_sink.deliver, message)
+        # turbomail would otherwise retry right away on its own
+        message.nr_retries = -1
+        return self.mail_retry(send or interface.send, message)
+
+
+    def close_mail_queue(self):
+        """
+        Wait up to `queue.drain_timeout` seconds for the mails of
+        the background-queue, and log those that weren't delivered.
+
+        :return: the undelivered messages
+        """
+        with self._mail_queue_lock:
+            queue, self.mail_queue = self.mail_queue, None
+        if queue is None:
+            return []
+        undelivered = queue.close(self.mail_queue_drain_timeout)
+        for message in undelivered:
+            self.logger.error("Couldn't deliver mail %s", describe_message(message))
+        self.undelivered_mails.extend(undelivered)
+        return undelivered
+
+
+    def flush_outbox(self):
+        """
+        Deliver the mails spooled in the outbox, until each
+        was tried once or the relay is unavailable.
+
+        :return: the number of delivered mails
+        """
+        if self.outbox is None:
+            return 0
+        total = 0
+        # failing mails are skipped, so they don't block the others
+        skip = set()
+        while True:
+            sent, failed = self.outbox.flush(self.deliver_message, self.outbox_batch, skip=skip)
+            total += sent
+            if not (sent or failed):
                 break
+        remaining = len(self.outbox.pending())
+        if remaining:
+            self.logger.warn("%i mails remain in the outbox %s", remaining, self.outbox.directory)
+        return total
 
 
     def get_logger(self):
@@ -500,10 +1592,14 @@ class Robot(object):
                 lock_file = self.opts.lockfile
             else:
                 lock_file = c["locking"]["filename"]
-            return LockFile(
+            lock_file = shard_name(lock_file, self.shard_index, self.shard_count)
+            backend = c["locking"].get("backend", "file")
+            if backend not in self.LOCK_BACKENDS:
+                raise LockFileCreationException("Unknown lock-backend %r" % backend)
+            return self.LOCK_BACKENDS[backend](
                 lock_file,
-                cleanup=True,
-                fail_on_lock=fail_on_lock
+                fail_on_lock=fail_on_lock,
+                config=c["locking"],
                 )
 
         @contextlib.contextmanager
@@ -533,10 +1629,7 @@ class Robot(object):
                     candidates.append(cfn)
 
         for cfn in candidates:
-            cp = ConfigObj(cfn, configspec=self._configspec())
-            vdt = Validator({})
-            cp.validate(vdt)
-            return cp
+            return self._validated_config(cfn)
 
         if self.NEEDS_CONFIG:
             l = logging.getLogger()
@@ -544,7 +1637,17 @@ class Robot(object):
             l.level = logging.DEBUG
             l.error("No config found, using emergency log!")
         # return an empty config.
-        cp = ConfigObj(configspec=self._configspec())
+        return self._validated_config(None)
+
+
+    def _validated_config(self, source):
+        """
+        Creates a `ConfigObj` from a filename, a list of lines
+        or a dictionary, and validates it against our spec.
+        """
+        if isinstance(source, ConfigObj):
+            source = source.dict()
+        cp = ConfigObj(source, configspec=self._configspec())
         vdt = Validator({})
         cp.validate(vdt)
         return cp
@@ -605,6 +1708,121 @@ class Robot(object):
 
 
 
+    def _setup_mail(self):
+        mail_config = {}
+        if "mail" in self.config:
+            mail_config = self.config["mail"].dict()
+        self.mail_retry = RetryPolicy.from_config(mail_config)
+
+        outbox_dir = mail_config.pop("outbox.dir", None)
+        self.outbox = None
+        if outbox_dir is not None:
+            self.outbox = Outbox(
+                outbox_dir,
+                max_attempts=mail_config.pop("outbox.max_attempts", 5),
+                claim_timeout=mail_config.pop("outbox.claim_timeout", 3600.0),
+                )
+        self.outbox_flush = mail_config.pop("outbox.flush", "exit")
+        self.outbox_batch = mail_config.pop("outbox.batch", 100)
+        self.outbox_interval = mail_config.pop("outbox.interval", 30.0)
+        self.attachment_policy = AttachmentPolicy.from_config(mail_config)
+
+        self.mail_manager = mail_config.pop("manager", "immediate")
+        self.mail_queue_workers = mail_config.pop("queue.workers", 2)
+        self.mail_queue_size = mail_config.pop("queue.size", 100)
+        self.mail_queue_drain_timeout = mail_config.pop("queue.drain_timeout", 30.0)
+        self.mail_queue = None
+        self._mail_queue_lock = threading.Lock()
+        self.undelivered_mails = []
+
+        self.mail_config = mail_config
+        if self.mail_sink is None:
+            configure(mail_config)
+
+
+    def _setup_sharding(self):
+        """
+        Determines the shard of this instance from the
+        commandline, falling back to the sharding-section.
+        """
+        cfg = self.config.get("sharding", {})
+        self.shard_index = cfg.get("index", 0)
+        self.shard_count = cfg.get("count", 1)
+        if self.opts.shard_index is not None:
+            self.shard_index = self.opts.shard_index
+        if self.opts.shard_count is not None:
+            self.shard_count = self.opts.shard_count
+        if self.shard_count < 1 or not 0 <= self.shard_index < self.shard_count:
+            self.parser.error("The shard-index must be in 0..%i, but is %i" %
+                              (self.shard_count - 1, self.shard_index))
+
+
+    def _setup_checkpoint(self):
+        cfg = self.config["checkpoint"]
+        filename = cfg["filename"]
+        if filename is not None:
+            filename = shard_name(filename, self.shard_index, self.shard_count)
+        self.checkpoint = Checkpoint(
+            filename,
+            flush_every=cfg["flush_every"],
+            flush_interval=cfg["flush_interval"],
+            )
+
+
+    def _setup_state(self):
+        cfg = self.config["state"]
+        filename = cfg["filename"]
+        if filename is not None:
+            filename = shard_name(filename, self.shard_index, self.shard_count)
+        self.state = StateStore(
+            filename,
+            commit_every=cfg["commit_every"],
+            commit_interval=cfg["commit_interval"],
+            )
+
+
+    def _setup_deadline(self):
+        """
+        Takes the maximum runtime from the commandline,
+        falling back to the deadline-section.
+        """
+        cfg = self.config["deadline"]
+        self.max_runtime = cfg["max_runtime"]
+        if self.opts.max_runtime is not None:
+            self.max_runtime = self.opts.max_runtime
+        self.deadline_grace = cfg["grace"]
+        self.deadline = None
+        self._watchdog = None
+        self.splay = self.config["splay"]["max"]
+        if self.opts.splay is not None:
+            self.splay = self.opts.splay
+
+
+    def _setup_history(self):
+        cfg = self.config["history"]
+        self.history = None
+        if cfg["filename"] is not None:
+            self.history = RunHistory(cfg["filename"], max_runs=cfg["max_runs"],
+                                      flush_every=cfg["flush_every"],
+                                      flush_interval=cfg["flush_interval"])
+
+
+    def shard(self, iterable, key=None):
+        """
+        Filter the items of `iterable` down to those this
+        instance is responsible for, based on a stable hash.
+
+        :Parameters:
+          iterable : iterable
+            The items to partition.
+
+          key : callable
+            Computes the value to hash from an item, e.g. a
+            primary key. Defaults to the item itself.
+        """
+        return partition(iterable, self.shard_index, self.shard_count, key=key)
+
+
     def create_logger(self):
         return logging.getLogger(self.__class__.__module__)
 
@@ -729,39 +1947,109 @@ class Robot(object):
         print
 
 
-    def call(self, cmd, print_output=False, **kwargs):
+    def call(self, cmd, print_output=False, tag_output=False, output_stream=None,
+             nice=None, ionice=None, cpu_time=None, address_space=None,
+             open_files=None, cpu_affinity=None, **kwargs):
         """
-        Call a command via `subprocess.call`. Fail on error.
+        Call a command via `subprocess.Popen`. Fail on error.
+
+        This method is safe to be used from several threads at once.
+        Each call gets a unique id, which prefixes its log-messages and
+        is available on the result and on a `RobotCallError`. Output is
+        written line by line, so lines of concurrent calls don't mix.
 
        :Parameters:
           cmd : list<str>
             The command with possible arguments to execute.
+
+          print_output : bool
+            Write the command's output to `output_stream`.
+
+          tag_output : bool
+            Prefix each written line with the call-id.
+
+          output_stream : file
+            Where to write the output to. Defaults to `sys.stdout`.
+
+          nice, ionice, cpu_time, address_space, open_files, cpu_affinity
+            Resource-controls for the subprocess, overriding those of
+            the call-section. See `abl.robot.isolation.ResourceLimits`.
+
+        Further keyword-arguments are passed to `subprocess.Popen`.
+
+        :rtype: RobotCallResult
         """
+        call_id = "call-%i" % next(_call_ids)
+        call_logger = CallLoggerAdapter(self.get_logger(), dict(call_id=call_id))
+        if output_stream is None:
+            output_stream = sys.stdout
         start_time = time()
 
+        self.check_deadline()
+        # unbuffered pipes would make readline fetch byte by byte
+        kwargs.setdefault("bufsize", -1)
+        limits = self.call_limits.merged(
+            nice=nice, ionice=ionice, cpu_time=cpu_time, address_space=address_space,
+            open_files=open_files, cpu_affinity=cpu_affinity,
+            )
+        if limits:
+            kwargs["preexec_fn"] = limits.preexec_fn(kwargs.get("preexec_fn"))
         np = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             **kwargs
             )
+        watchdog = self._watchdog
+        if watchdog is not None:
+            watchdog.track(np)
 
+        debug = call_logger.isEnabledFor(logging.DEBUG)
         output = []
-        while True:
-            stdout, _ = np.communicate()
-            logger.debug(stdout)
-            output.append(stdout)
-            if print_output:
-                sys.stdout.write(stdout)
-            if np.returncode is not None:
-                break
-        ec = np.returncode
+        try:
+            for line in iter(np.stdout.readline, ""):
+                if debug:
+                    call_logger.debug(line.rstrip("\n"))
+                output.append(line)
+                if print_output:
+                    if tag_output:
+                        line = "[%s] %s" % (call_id, line)
+                    with _output_lock:
+                        output_stream.write(line)
+            np.stdout.close()
+            ec, rusage = wait_with_rusage(np)
+        except BaseException:
+            # e.g. MemoryLimitExceeded raised into the working thread
+            self._kill_call(np, call_logger)
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.untrack(np)
 
         elapsed_time = time() - start_time
-        self.get_logger().debug("%s [%.3fs]" % (" ".join(cmd), elapsed_time))
+        call_logger.debug("%s [%.3fs, cpu %.3fs, max rss %iKB]" % (
+            " ".join(cmd), elapsed_time, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss))
+        with _call_stats_lock:
+            self.call_count += 1
+            self.call_time += elapsed_time
 
         if ec != 0:
-            raise RobotCallError(cmd, ec, output)
+            if self.deadline is not None and self.deadline.expired:
+                raise DeadlineExceeded("[%s] %r was stopped at the deadline" % (call_id, " ".join(cmd)))
+            raise RobotCallError(cmd, ec, output, call_id=call_id, rusage=rusage)
+        return RobotCallResult(call_id, cmd, ec, output, elapsed_time, rusage=rusage)
 
 
+    def _kill_call(self, process, call_logger):
+        """
+        Kills and reaps the subprocess of an aborted `call`.
+        """
+        try:
+            if process.returncode is None:
+                process.kill()
+                wait_with_rusage(process)
+        except OSError:
+            call_logger.exception("Couldn't kill %i", process.pid)
+        process.stdout.close()
+
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import errno
+import json
+import tempfile
+from time import time
+
+
+def atomic_write(filename, data):
+    """
+    Replace `filename` with `data`, so that readers either
+    see the old or the new content, even after a crash.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            outf.write(data)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+    dirfd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+
+class Checkpoint(object):
+    """
+    A small key/value store for progress markers of `Robot.work`.
+
+    Values must be JSON-serializable. Updates are kept in memory and
+    written to disk atomically after `flush_every` updates or
+    `flush_interval` seconds, whichever comes first, so frequent
+    progress markers don't fsync on every call.
+
+    Without a filename, the checkpoint only lives in memory.
+    """
+
+    def __init__(self, filename=None, flush_every=100, flush_interval=5.0):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._data = {}
+        self._pending = 0
+        self._last_flush = time()
+        if filename is not None:
+            try:
+                with open(filename, "rb") as inf:
+                    self._data = json.load(inf)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._pending += 1
+        if self._pending >= self.flush_every \
+               or time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write pending updates to disk.
+        """
+        if self._pending and self.filename is not None:
+            atomic_write(self.filename, json.dumps(self._data))
+        self._pending = 0
+        self._last_flush = time()
+
+
+    def clear(self):
+        """
+        Forget all progress, e.g. after the work is done.
+        """
+        self._data = {}
+        self._pending = 0
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
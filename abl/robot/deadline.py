@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import logging
+import threading
+from time import time
+
+
+logger = logging.getLogger("abl.robot.deadline")
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a robot works longer than its `max_runtime`.
+    """
+
+
+
+class Deadline(object):
+    """
+    The point in time `max_runtime` seconds from now.
+    """
+
+    def __init__(self, max_runtime, clock=time):
+        self.max_runtime = max_runtime
+        self.clock = clock
+        self.expires = clock() + max_runtime
+
+
+    def remaining(self):
+        """
+        The seconds left, never negative.
+        """
+        return max(self.expires - self.clock(), 0.0)
+
+
+    @property
+    def expired(self):
+        return self.clock() >= self.expires
+
+
+    def check(self):
+        """
+        Raise `DeadlineExceeded` if the deadline has passed.
+        """
+        if self.expired:
+            raise DeadlineExceeded("The maximum runtime of %.1fs is exceeded" % self.max_runtime)
+
+
+
+class DeadlineWatchdog(object):
+    """
+    Watches a `Deadline` in a background-thread.
+
+    When it expires, the subprocesses registered through `track` are
+    terminated. If the watchdog isn't stopped within `grace` seconds
+    after that, `on_hard_stop` is called.
+    """
+
+    def __init__(self, deadline, grace, on_hard_stop):
+        self.deadline = deadline
+        self.grace = grace
+        self.on_hard_stop = on_hard_stop
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="deadline-watchdog")
+        self._thread.setDaemon(True)
+
+
+    def track(self, process):
+        with self._lock:
+            self._processes.add(process)
+        if self.deadline.expired:
+            self._terminate(process)
+
+
+    def untrack(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+
+    def _terminate(self, process):
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+        except OSError:
+            # exited already
+            pass
+
+
+    def _run(self):
+        if self._stop.wait(self.deadline.remaining()):
+            return
+        with self._lock:
+            processes = list(self._processes)
+        if processes:
+            logger.warn("Terminating %i subprocesses at the deadline", len(processes))
+        for process in processes:
+            self._terminate(process)
+        if self._stop.wait(self.grace):
+            return
+        self.on_hard_stop()
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not threading.currentThread():
+            self._thread.join()
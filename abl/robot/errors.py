@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Support for the `ErrorHandler` of robots.
+
+The index of exception-dumps can be queried with::
+
+  python -m abl.robot.errors <index> counts [--since <days>]
+  python -m abl.robot.errors <index> recent [--id-code <code>] [--robot <name>]
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import gzip
+import errno
+import json
+import logging
+import optparse
+import sqlite3
+import tempfile
+import threading
+from time import time, mktime, strftime, localtime
+from repr import Repr
+
+from errorreporter import formatter
+from errorreporter.collector import collect_exception, DEBUG_IDENT_PREFIX
+from errorreporter.reporter import XMLExceptionDumper
+from errorreporter.util import serial_number_generator
+
+from .sharding import stable_hash
+
+
+logger = logging.getLogger("abl.robot.errors")
+
+
+class CapturedValue(object):
+    """
+    Stands in for a local variable of a captured frame, and
+    renders as the bounded representation taken at capture-time.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+
+    def __repr__(self):
+        return self.text
+
+    __str__ = __repr__
+
+
+
+class CaptureLimits(object):
+    """
+    Bounds the cost of reporting an exception.
+
+    `errorreporter.collector.collect_exception` keeps references to
+    the locals of all frames, and the reporters `repr` each of them
+    in full - which can take long and a lot of memory when a robot
+    holds big data. `collect` only collects the innermost
+    `max_frames` frames, and `apply` replaces their locals with
+    representations of bounded size, taken innermost frame first:
+
+     - of each frame, the first `max_locals` locals by name,
+     - each representation is cut to `max_repr` characters,
+     - once `time_budget` seconds are spent or `size_budget`
+       characters are taken, the remaining frames lose their locals.
+
+    Budgets of 0 are unlimited.
+    """
+
+    def __init__(self, max_frames=50, max_locals=50, max_repr=1000,
+                 time_budget=2.0, size_budget=1024 * 1024, clock=time):
+        self.max_frames = max_frames
+        self.max_locals = max_locals
+        self.max_repr = max_repr
+        self.time_budget = time_budget
+        self.size_budget = size_budget
+        self.clock = clock
+        self._repr = Repr()
+        self._repr.maxstring = self._repr.maxother = self._repr.maxlong = max_repr
+
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        Creates the limits from the capture.* options
+        of an error_handler-section.
+        """
+        return cls(
+            max_frames=conf.get("capture.max_frames", 50),
+            max_locals=conf.get("capture.max_locals", 50),
+            max_repr=conf.get("capture.max_repr", 1000),
+            time_budget=conf.get("capture.time_budget", 2.0),
+            size_budget=conf.get("capture.size_budget", 1024 * 1024),
+            )
+
+
+    def represent(self, value):
+        try:
+            text = self._repr.repr(value)
+        except Exception:
+            text = "<unrepresentable %s>" % type(value).__name__
+        if len(text) > self.max_repr:
+            text = text[:self.max_repr - 3] + "..."
+        return text
+
+
+    def collect(self, exc_info):
+        """
+        Collects the exception `exc_info` like `collect_exception`,
+        but only its innermost `max_frames` frames, and bounds it
+        with `apply`. The identification code still covers all
+        frames, so it doesn't depend on the limits.
+
+        :return: the `CollectedException`
+        """
+        etype, value, tb = exc_info
+        # walking the traceback is cheap, collecting its frames isn't
+        ident_data = []
+        depth = 0
+        walk = tb
+        while walk is not None:
+            ident_data.append(walk.tb_frame.f_globals.get("__name__") or "?")
+            ident_data.append(walk.tb_frame.f_code.co_name or "?")
+            depth += 1
+            walk = walk.tb_next
+        ident_data.append(str(etype))
+        omitted_frames = max(depth - self.max_frames, 0) if self.max_frames else 0
+        for _ in xrange(omitted_frames):
+            tb = tb.tb_next
+        exc_data = collect_exception(etype, value, tb, limit=self.max_frames or None)
+        exc_data.identification_code = serial_number_generator.hash_identifier(
+            " ".join(ident_data), length=5, upper=True, prefix=DEBUG_IDENT_PREFIX)
+        return self.apply(exc_data, omitted_frames=omitted_frames)
+
+
+    def apply(self, exc_data, omitted_frames=0):
+        """
+        Bounds the locals of the collected exception `exc_data` in
+        place. What was left out - including `omitted_frames` - is
+        noted in its extra_data as "capture limits".
+
+        :return: `exc_data`
+        """
+        start = self.clock()
+        frames = exc_data.frames
+        size = omitted_locals = 0
+        exhausted = False
+        for frame in reversed(frames):
+            if not hasattr(getattr(frame, "locals", None), "iteritems"):
+                continue
+            captured = {}
+            for name in sorted(frame.locals)[:self.max_locals]:
+                exhausted = exhausted \
+                            or (self.time_budget and self.clock() - start > self.time_budget) \
+                            or (self.size_budget and size > self.size_budget)
+                if exhausted:
+                    break
+                text = self.represent(frame.locals[name])
+                size += len(name) + len(text)
+                captured[name] = CapturedValue(text)
+            omitted_locals += len(frame.locals) - len(captured)
+            frame.locals = captured
+        if omitted_frames or omitted_locals:
+            exc_data.extra_data[("important", "capture limits")] = [dict(
+                omitted_frames=omitted_frames,
+                omitted_locals=omitted_locals,
+                budget_exhausted=bool(exhausted),
+                )]
+        return exc_data
+
+
+
+class ShardedXMLDumper(XMLExceptionDumper):
+    """
+    An `XMLExceptionDumper` for directories receiving lots of dumps.
+
+    Below the daily directories, the dumps are spread over `shards`
+    subdirectories by their identification code, and can be written
+    gzip-compressed. Dumps older than `max_age` days, and the oldest
+    ones exceeding `max_size` bytes in total, are removed by a
+    background-thread started after writing a dump, at most every
+    `prune_interval` seconds after the last completed pruning.
+    """
+
+    shards = 0
+    """
+    The number of hash-subdirectories, 0 for none.
+    """
+
+    compress = False
+    """
+    Whether to write the dumps as .xml.gz.
+    """
+
+    max_age = 0
+    """
+    Days after which dumps are removed, 0 to keep them.
+    """
+
+    max_size = 0
+    """
+    The maximum size of all dumps in bytes, 0 for unlimited.
+    """
+
+    prune_interval = 3600.0
+    """
+    The minimal number of seconds between prunings.
+    """
+
+    PRUNE_STAMP = ".pruned"
+
+    _prune_thread = None
+
+
+    def make_filename(self, exc_data, daily_dirs=True):
+        name = super(ShardedXMLDumper, self).make_filename(exc_data, daily_dirs)
+        if self.shards:
+            dirname, basename = os.path.split(name)
+            shard = "%02x" % (stable_hash(exc_data.identification_code) % self.shards)
+            name = os.path.join(dirname, shard, basename)
+        if self.compress:
+            name += ".gz"
+        return name
+
+
+    def viewer_path(self, exc_data):
+        """
+        The path of the dump for the exception-viewer, which
+        is its filename without the extensions.
+        """
+        name = self.make_filename(exc_data, self.daily_dirs)
+        return name[:name.index(".xml")]
+
+
+    def report(self, exc_data):
+        text, _ = formatter.format_xml(exc_data, plugins=self.plugins)
+        self.safe_make_dir(self.outputdir)
+        tmp_dir = os.path.join(self.outputdir, ".tmp")
+        self.safe_make_dir(tmp_dir)
+        fd, tmp_name = tempfile.mkstemp(dir=tmp_dir)
+        with os.fdopen(fd, "wb") as outf:
+            if self.compress:
+                with gzip.GzipFile(mode="wb", fileobj=outf) as gzf:
+                    gzf.write(text)
+            else:
+                outf.write(text)
+        if self.filemode:
+            os.chmod(tmp_name, self.filemode)
+
+        local_name = self.make_filename(exc_data, self.daily_dirs)
+        for attempt in xrange(3):
+            dirname = self.outputdir
+            for part in os.path.dirname(local_name).split(os.sep):
+                if part:
+                    dirname = os.path.join(dirname, part)
+                    if not os.path.isdir(dirname):
+                        self.safe_make_dir(dirname)
+            try:
+                os.rename(tmp_name, os.path.join(self.outputdir, local_name))
+                break
+            except OSError as e:
+                # a concurrent prune removed the directory
+                # while it was still empty
+                if e.errno != errno.ENOENT or attempt == 2:
+                    raise
+        self.prune_in_background()
+        return local_name
+
+
+    def prune_in_background(self):
+        """
+        Starts pruning in a thread, if there is a retention-limit,
+        the last pruning finished `prune_interval` seconds ago, and
+        no pruning is running already.
+
+        The thread is a daemon, so `wait_for_pruning` before exiting.
+
+        :return: the thread, or None
+        """
+        if not (self.max_age or self.max_size):
+            return None
+        thread = self._prune_thread
+        if thread is not None and thread.isAlive():
+            return None
+        try:
+            last = os.path.getmtime(os.path.join(self.outputdir, self.PRUNE_STAMP))
+        except OSError:
+            last = 0
+        if time() - last < self.prune_interval:
+            return None
+        thread = self._prune_thread = threading.Thread(target=self._prune)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+    def wait_for_pruning(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for a running pruning.
+
+        :return: True if none is running anymore
+        """
+        thread = self._prune_thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.isAlive()
+
+
+    def _prune(self):
+        try:
+            self.prune()
+        except Exception:
+            logger.exception("Couldn't prune %s", self.outputdir)
+            return
+        # only stamp a completed pruning, so an interrupted
+        # one is retried next time
+        stamp = os.path.join(self.outputdir, self.PRUNE_STAMP)
+        try:
+            open(stamp, "a").close()
+            os.utime(stamp, None)
+        except (IOError, OSError):
+            logger.exception("Couldn't stamp the pruning of %s", self.outputdir)
+
+
+    def prune(self):
+        """
+        Removes the dumps exceeding `max_age` or `max_size`,
+        oldest first, and the directories left empty.
+
+        :return: the number of removed dumps
+        """
+        dumps = []
+        for dirpath, dirnames, filenames in os.walk(self.outputdir):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if name.endswith((".xml", ".xml.gz")):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    dumps.append((st.st_mtime, st.st_size, path))
+        dumps.sort()
+        total = sum(size for _, size, _ in dumps)
+        oldest = time() - self.max_age * 86400
+        removed = 0
+        for mtime, size, path in dumps:
+            if not ((self.max_age and mtime < oldest)
+                    or (self.max_size and total > self.max_size)):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        for dirpath, _, _ in os.walk(self.outputdir, topdown=False):
+            if dirpath != self.outputdir and not os.path.basename(dirpath).startswith("."):
+                try:
+                    # fails for directories that aren't empty
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return removed
+
+
+
+class DumpIndex(object):
+    """
+    An SQLite-index of reported exceptions, so their occurrences
+    can be found without reading the dumps.
+
+    Entries are inserted in batches of `flush_every`, or after
+    `flush_interval` seconds, and when `flush` is called.
+    """
+
+    COLUMNS = ("id_code", "exception_type", "last_line", "robot", "timestamp", "path")
+
+
+    def __init__(self, filename, flush_every=100, flush_interval=5.0):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time()
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS dumps
+                                  (id_code TEXT NOT NULL, exception_type TEXT,
+                                   last_line TEXT, robot TEXT,
+                                   timestamp REAL NOT NULL, path TEXT)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS dumps_by_id_code
+                                  ON dumps (id_code, timestamp)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS dumps_by_timestamp
+                                  ON dumps (timestamp)""")
+            self._conn.commit()
+
+
+    def add(self, exc_data, robot=None, path=None):
+        """
+        Records the collected exception `exc_data`, dumped to `path`.
+        """
+        etype = exc_data.exception_type
+        if not isinstance(etype, basestring):
+            etype = etype.__name__
+        last_line = None
+        frames = [frame for frame in exc_data.frames if not isinstance(frame, basestring)]
+        if frames:
+            last = frames[-1]
+            last_line = "File %r, line %s, in %s" % (last.filename, last.lineno, last.name)
+        with self._lock:
+            self._pending.append((exc_data.identification_code, etype, last_line, robot,
+                                  mktime(exc_data.date), path))
+            if len(self._pending) >= self.flush_every \
+                   or time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT INTO dumps (%s) VALUES (?, ?, ?, ?, ?, ?)" % ", ".join(self.COLUMNS),
+                        self._pending)
+                self._pending = []
+            self._last_flush = time()
+
+
+    def counts(self, since=None, limit=20):
+        """
+        The most frequent exceptions since the timestamp `since`,
+        as dicts with their id_code, exception_type, count and the
+        last_seen-timestamp, last_line and path.
+        """
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT id_code, exception_type, COUNT(*), MAX(timestamp)
+                FROM dumps WHERE timestamp >= ?
+                GROUP BY id_code ORDER BY COUNT(*) DESC, MAX(timestamp) DESC LIMIT ?
+                """, (since or 0, limit)).fetchall()
+            result = []
+            for id_code, etype, count, last_seen in rows:
+                last_line, path = self._conn.execute("""
+                    SELECT last_line, path FROM dumps WHERE id_code = ?
+                    ORDER BY timestamp DESC, rowid DESC LIMIT 1""", (id_code,)).fetchone()
+                result.append(dict(id_code=id_code, exception_type=etype, count=count,
+                                   last_seen=last_seen, last_line=last_line, path=path))
+        return result
+
+
+    def recent(self, id_code=None, robot=None, limit=20):
+        """
+        The latest occurrences, optionally of one `id_code` or
+        `robot`, as dicts of the indexed columns.
+        """
+        conditions, args = [], []
+        if id_code is not None:
+            conditions.append("id_code = ?")
+            args.append(id_code)
+        if robot is not None:
+            conditions.append("robot = ?")
+            args.append(robot)
+        where = "WHERE %s" % " AND ".join(conditions) if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT %s FROM dumps %s ORDER BY timestamp DESC, rowid DESC LIMIT ?"
+                % (", ".join(self.COLUMNS), where), args + [limit]).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+
+def _format_time(timestamp):
+    return strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog <index> counts|recent [options]")
+    parser.add_option("--since", type="float", default=None,
+                      help="Only count exceptions of the last SINCE days.")
+    parser.add_option("--id-code", default=None,
+                      help="Only list occurrences of this exception.")
+    parser.add_option("--robot", default=None,
+                      help="Only list occurrences in this robot.")
+    parser.add_option("-n", "--limit", type="int", default=20,
+                      help="How many rows to show.")
+    parser.add_option("--json", default=False, action="store_true",
+                      help="Print the rows as JSON.")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2 or args[1] not in ("counts", "recent"):
+        parser.error("Please give the index and either counts or recent")
+    filename, command = args
+    if not os.path.exists(filename):
+        parser.error("No such index: %s" % filename)
+
+    index = DumpIndex(filename)
+    if command == "counts":
+        since = time() - opts.since * 86400 if opts.since is not None else None
+        rows = index.counts(since=since, limit=opts.limit)
+        lines = ["%(count)6i  %(id_code)s  %(exception_type)s  last seen " % row
+                 + _format_time(row["last_seen"]) + "  %(last_line)s" % row
+                 for row in rows]
+    else:
+        rows = index.recent(id_code=opts.id_code, robot=opts.robot, limit=opts.limit)
+        lines = [_format_time(row["timestamp"])
+                 + "  %(id_code)s  %(exception_type)s  %(robot)s  %(path)s" % row
+                 for row in rows]
+    index.close()
+    if opts.json:
+        print json.dumps(rows, indent=2, sort_keys=True)
+    else:
+        print "\n".join(lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import sqlite3
+import resource
+import threading
+from time import time, strftime, localtime
+
+from .stats import summarize
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process in KB, since it
+    started or `reset_peak_rss` was called.
+    """
+    try:
+        with open("/proc/self/status") as inf:
+            for line in inf:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size to the current one,
+    which needs Linux 4.0 or later.
+
+    :return: True if it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as outf:
+            outf.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+
+class RunHistory(object):
+    """
+    Records the runs of robots in an SQLite-database, to see
+    how they behave over time.
+
+    Runs are buffered by `record`, and written together with
+    the removal of all but the latest `max_runs` runs of each
+    robot in one transaction by `flush` - which `record` calls
+    after `flush_every` runs or `flush_interval` seconds, and
+    `close` at the end.
+    """
+
+    COLUMNS = ("robot", "shard", "start", "duration", "outcome",
+               "lock_wait", "peak_rss", "calls", "call_time")
+
+
+    def __init__(self, filename, max_runs=1000, flush_every=10, flush_interval=60.0):
+        self.filename = filename
+        self.max_runs = max_runs
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time()
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS runs
+                                  (robot TEXT NOT NULL, shard INTEGER,
+                                   start REAL NOT NULL, duration REAL,
+                                   outcome TEXT, lock_wait REAL, peak_rss INTEGER,
+                                   calls INTEGER, call_time REAL)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS runs_by_robot
+                                  ON runs (robot, start)""")
+            self._conn.commit()
+
+
+    def record(self, **run):
+        """
+        Buffers a run, given by the values of `COLUMNS`.
+        """
+        with self._lock:
+            self._pending.append(tuple(run.get(column) for column in self.COLUMNS))
+            if len(self._pending) >= self.flush_every \
+                   or time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time()
+            if not self._pending:
+                return
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO runs (%s) VALUES (%s)"
+                    % (", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS))),
+                    self._pending)
+                for robot in set(run[0] for run in self._pending):
+                    self._conn.execute("""
+                        DELETE FROM runs WHERE robot = ? AND rowid NOT IN
+                        (SELECT rowid FROM runs WHERE robot = ?
+                         ORDER BY start DESC LIMIT ?)""", (robot, robot, self.max_runs))
+            self._pending = []
+
+
+    def runs(self, robot, since=None):
+        """
+        The recorded runs of `robot` as dicts, oldest first.
+        """
+        with self._lock:
+            self.flush()
+            rows = self._conn.execute(
+                "SELECT %s FROM runs WHERE robot = ? AND start >= ? ORDER BY start"
+                % ", ".join(self.COLUMNS), (robot, since or 0)).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+
+    def report(self, robot, weeks=8, now=None):
+        """
+        Statistics over the runs of `robot`: the outcomes, summaries
+        of the durations, lock-waits, calls and peak RSS, and the
+        durations per week of the last `weeks` weeks, latest last.
+        """
+        runs = self.runs(robot)
+        outcomes = {}
+        for run in runs:
+            outcomes[run["outcome"]] = outcomes.get(run["outcome"], 0) + 1
+        now = now if now is not None else time()
+        trend = []
+        for week in xrange(weeks, 0, -1):
+            start, end = now - week * 7 * 86400, now - (week - 1) * 7 * 86400
+            durations = [run["duration"] for run in runs if start <= run["start"] < end]
+            trend.append(dict(summarize(durations), start=start))
+        return dict(
+            robot=robot,
+            runs=len(runs),
+            outcomes=outcomes,
+            duration=summarize(_known(runs, "duration")),
+            lock_wait=summarize(_known(runs, "lock_wait")),
+            calls=summarize(_known(runs, "calls")),
+            call_time=summarize(_known(runs, "call_time")),
+            peak_rss=summarize(_known(runs, "peak_rss")),
+            trend=trend,
+            )
+
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+
+def _known(runs, column):
+    """
+    The values of `column`, without those not recorded.
+    """
+    return [run[column] for run in runs if run[column] is not None]
+
+
+def _seconds(value):
+    return "%.3fs" % value if value is not None else "-"
+
+
+def format_report(report):
+    lines = [
+        "robot:      %(robot)s" % report,
+        "runs:       %i (%s)" % (report["runs"], ", ".join(
+            "%s=%i" % item for item in sorted(report["outcomes"].items()))),
+        ]
+    if not report["runs"]:
+        return "\n".join(lines)
+    for name in "duration", "lock_wait", "call_time":
+        s = report[name]
+        lines.append("%-11s p50=%s p90=%s p99=%s max=%s" % (
+            name.replace("_", " ") + ":",
+            _seconds(s["p50"]), _seconds(s["p90"]), _seconds(s["p99"]), _seconds(s["max"])))
+    lines.append("calls:      p50=%.0f max=%.0f" % (report["calls"]["p50"], report["calls"]["max"]))
+    if report["peak_rss"]["count"]:
+        lines.append("peak rss:   p50=%.1fMB max=%.1fMB" % (report["peak_rss"]["p50"] / 1024.0,
+                                                          report["peak_rss"]["max"] / 1024.0))
+    else:
+        lines.append("peak rss:   n/a")
+    lines.append("duration per week:")
+    previous = None
+    for week in report["trend"]:
+        line = "  %s  runs=%-4i p50=%-9s p90=%s" % (
+            strftime("%Y-%m-%d", localtime(week["start"])), week["count"],
+            _seconds(week["p50"]), _seconds(week["p90"]))
+        if previous and week["p50"] is not None:
+            line += "  (%+.0f%%)" % ((week["p50"] / previous - 1) * 100)
+        if week["p50"]:
+            previous = week["p50"]
+        lines.append(line)
+    return "\n".join(lines)
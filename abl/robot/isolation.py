@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Resource-controls for the subprocesses of `Robot.call`.
+
+They are applied in the child between fork and exec. CPU-affinity
+and the I/O-priority are set through libc, as Python 2 has no
+wrappers for them, and are only available on Linux. The I/O-priority
+is ignored with a warning on machines whose syscall-number for
+ioprio_set isn't known.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import logging
+import platform
+import resource
+
+
+logger = logging.getLogger("abl.robot.isolation")
+
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_WHO_PROCESS = 1
+
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    }
+
+
+_libc = None
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def parse_ionice(spec):
+    """
+    Parses an I/O-priority given as "class" or "class:level",
+    e.g. "idle" or "best-effort:7", into the value for ioprio_set.
+    """
+    name, _, level = spec.partition(":")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError("Unknown I/O-scheduling class %r, use one of %s"
+                         % (name, ", ".join(sorted(IOPRIO_CLASSES))))
+    level = int(level) if level else 4
+    if not 0 <= level <= 7:
+        raise ValueError("The I/O-priority level must be within 0..7, not %i" % level)
+    return IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | level
+
+
+def _check(result):
+    if result != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+
+class ResourceLimits(object):
+    """
+    The resource-controls for a subprocess. Unset (None)
+    controls leave the inherited values alone.
+
+    :ivar nice: the niceness-increment
+    :ivar ionice: the I/O-priority as "class[:level]", see `parse_ionice`
+    :ivar cpu_time: the limit of CPU-seconds (RLIMIT_CPU)
+    :ivar address_space: the limit of the address-space in MB (RLIMIT_AS)
+    :ivar open_files: the limit of open files (RLIMIT_NOFILE)
+    :ivar cpu_affinity: the list of CPUs to run on
+    """
+
+    FIELDS = ("nice", "ionice", "cpu_time", "address_space", "open_files", "cpu_affinity")
+
+
+    def __init__(self, nice=None, ionice=None, cpu_time=None, address_space=None,
+                 open_files=None, cpu_affinity=None):
+        if ionice is not None:
+            # raises ValueError for invalid ones right away
+            parse_ionice(ionice)
+            if platform.machine() not in SYS_IOPRIO_SET:
+                logger.warn("Ignoring ionice %r, it isn't supported on %s",
+                            ionice, platform.machine())
+                ionice = None
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_time = cpu_time
+        self.address_space = address_space
+        self.open_files = open_files
+        self.cpu_affinity = cpu_affinity
+
+
+    @classmethod
+    def from_config(cls, conf):
+        return cls(**dict((field, conf.get(field)) for field in cls.FIELDS))
+
+
+    def merged(self, **overrides):
+        """
+        A copy with the given controls replaced, unless they are None.
+        """
+        values = dict((field, getattr(self, field)) for field in self.FIELDS)
+        values.update((field, value) for field, value in overrides.items() if value is not None)
+        return self.__class__(**values)
+
+
+    def __nonzero__(self):
+        return any(getattr(self, field) is not None for field in self.FIELDS)
+
+
+    def preexec_fn(self, chained=None):
+        """
+        A function for the preexec_fn of `subprocess.Popen` applying
+        the controls, and calling `chained` afterwards.
+
+        Everything that can fail is prepared here in the parent,
+        so errors surface there. Resource-limits above the current
+        hard limit are lowered to it, as only root may raise it.
+        """
+        address_space = self.address_space
+        if address_space is not None:
+            address_space *= 1024 * 1024
+        rlimits = []
+        for limit, value in ((resource.RLIMIT_CPU, self.cpu_time),
+                             (resource.RLIMIT_AS, address_space),
+                             (resource.RLIMIT_NOFILE, self.open_files)):
+            if value is None:
+                continue
+            _, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY and value > hard:
+                value = hard
+            rlimits.append((limit, value))
+        ioprio = syscall = mask = None
+        if self.ionice is not None:
+            ioprio = parse_ionice(self.ionice)
+            syscall = SYS_IOPRIO_SET[platform.machine()]
+        if self.cpu_affinity is not None:
+            bits = ctypes.sizeof(ctypes.c_ulong) * 8
+            mask = (ctypes.c_ulong * (1024 // bits))()
+            for cpu in self.cpu_affinity:
+                mask[cpu // bits] |= 1 << (cpu % bits)
+        nice = self.nice
+        c = libc() if ioprio is not None or mask is not None else None
+
+        def apply():
+            if nice:
+                os.nice(nice)
+            for limit, value in rlimits:
+                resource.setrlimit(limit, (value, value))
+            if ioprio is not None:
+                _check(c.syscall(syscall, IOPRIO_WHO_PROCESS, 0, ioprio))
+            if mask is not None:
+                _check(c.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)))
+            if chained is not None:
+                chained()
+
+        return apply
+
+
+
+def wait_with_rusage(process):
+    """
+    Waits for a `subprocess.Popen` via `os.wait4`, and returns its
+    exit-code - negative for signals, like `Popen.wait` - and the
+    `resource.struct_rusage` of the child.
+    """
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
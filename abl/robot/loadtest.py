@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Load-testing for robots.
+
+Starts many instances of a robot as separate processes, the way cron
+does when a lot of robots share a schedule, and reports how they
+behave against their shared lock and mail-relay::
+
+  python -m abl.robot.loadtest --robot mypackage.robots:MyRobot \\
+      --count 50 --rate 10 --arrival poisson --config robot.ini \\
+      -- --some-robot-option
+
+Mails are delivered to a local `SMTPSink` instead of the configured
+relay. The report contains the outcomes of the runs, the lock
+contention, the queueing delay between scheduled and actual start,
+the time spent waiting for the lock, the latency until each run
+finished, and the mail throughput.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import json
+import random
+import optparse
+import multiprocessing
+from Queue import Empty
+from time import time, sleep
+
+from configobj import ConfigObj
+
+from .smtpsink import SMTPSink
+from .stats import summarize
+from .zygote import load_robot
+
+
+LOCK_CONTENTION_THRESHOLD = 0.01
+"""
+Runs waiting longer than this many seconds for
+their lock count as contended.
+"""
+
+
+def arrival_times(count, rate, arrival="burst"):
+    """
+    The start-offsets in seconds of `count` robots.
+
+    :param rate: robots per second. 0 starts all at once.
+    :param arrival: one of "burst", "uniform" or "poisson".
+    """
+    if not rate or arrival == "burst":
+        return [0.0] * count
+    if arrival == "uniform":
+        return [i / float(rate) for i in xrange(count)]
+    offsets, offset = [], 0.0
+    for _ in xrange(count):
+        offsets.append(offset)
+        offset += random.expovariate(rate)
+    return offsets
+
+
+
+def run_robot(robot_class, argv, config, scheduled, results):
+    """
+    Runs one robot and puts its timings into the `results`-queue.
+    This is the target of the robot-processes.
+
+    The lock-wait and the outcome are those the robot
+    records in its `last_run`.
+    """
+    timings = dict(scheduled=scheduled, started=time(), lock_wait=0.0, outcome="error")
+    try:
+        robot = robot_class()
+        robot.setup(argv, config=config)
+        robot.run()
+    except BaseException:
+        pass
+    else:
+        timings.update(lock_wait=robot.last_run["lock_wait"], outcome=robot.last_run["outcome"])
+    timings["finished"] = time()
+    results.put(timings)
+
+
+def run_load(robot_class, count, rate=0, arrival="burst", config=None, argv=(), timeout=600):
+    """
+    Run `count` robots against a local `SMTPSink`, and
+    return the report as dict.
+    """
+    config = dict(config or {})
+    sink = SMTPSink(("localhost", 0))
+    sink.start()
+    mail = dict(config.get("mail", {}))
+    mail["transport"] = "smtp"
+    mail["smtp.server"] = sink.address
+    config["mail"] = mail
+
+    results = multiprocessing.Queue()
+    processes = []
+    start = time()
+    try:
+        for offset in arrival_times(count, rate, arrival):
+            delay = start + offset - time()
+            if delay > 0:
+                sleep(delay)
+            process = multiprocessing.Process(
+                target=run_robot,
+                args=(robot_class, list(argv), config, start + offset, results),
+                )
+            process.start()
+            processes.append(process)
+
+        timings = []
+        deadline = start + timeout
+        while len(timings) < len(processes):
+            try:
+                timings.append(results.get(timeout=max(deadline - time(), 0)))
+            except Empty:
+                break
+        for process in processes:
+            process.join(max(deadline - time(), 0))
+            if process.is_alive():
+                process.terminate()
+        wall_time = time() - start
+    finally:
+        sink.stop()
+    return make_report(timings, count, sink, wall_time)
+
+
+def make_report(timings, count, sink, wall_time):
+    outcomes = dict(ok=0, locked=0, error=0)
+    for t in timings:
+        outcomes[t["outcome"]] = outcomes.get(t["outcome"], 0) + 1
+    outcomes["lost"] = count - len(timings)
+    contended = [t for t in timings
+                 if t["outcome"] == "locked" or t["lock_wait"] > LOCK_CONTENTION_THRESHOLD]
+    return dict(
+        robots=count,
+        wall_time=wall_time,
+        outcomes=outcomes,
+        lock_contention=len(contended) / float(count) if count else 0.0,
+        queueing_delay=summarize([t["started"] - t["scheduled"] for t in timings]),
+        lock_wait=summarize([t["lock_wait"] for t in timings]),
+        latency=summarize([t["finished"] - t["scheduled"] for t in timings]),
+        mail=sink.stats(),
+        )
+
+
+def format_report(report):
+    lines = [
+        "robots:          %(robots)i in %(wall_time).3fs" % report,
+        "outcomes:        %s" % ", ".join("%s=%i" % item for item in sorted(report["outcomes"].items())),
+        "lock contention: %.1f%%" % (report["lock_contention"] * 100),
+        ]
+    for name in "queueing_delay", "lock_wait", "latency":
+        s = report[name]
+        if not s["count"]:
+            continue
+        lines.append("%-16s p50=%.3fs p90=%.3fs p99=%.3fs max=%.3fs"
+                     % (name.replace("_", " ") + ":", s["p50"], s["p90"], s["p99"], s["max"]))
+    lines.append("mail:            %(messages)i messages, %(connections)i connections, "
+                 "%(throughput).1f messages/s" % report["mail"])
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog --robot module:Class [options] [-- robot-options]")
+    parser.add_option("--robot", help="The robot-class to run, as module:Class.")
+    parser.add_option("-n", "--count", type="int", default=10,
+                      help="How many robots to start.")
+    parser.add_option("--rate", type="float", default=0,
+                      help="Robots started per second. 0 starts all at once.")
+    parser.add_option("--arrival", type="choice", choices=["burst", "uniform", "poisson"],
+                      default="burst",
+                      help="How robot-starts are distributed when a rate is given.")
+    parser.add_option("-c", "--config", default=None,
+                      help="The configuration of the robots.")
+    parser.add_option("--timeout", type="float", default=600,
+                      help="Give up on robots after this many seconds.")
+    parser.add_option("--json", default=False, action="store_true",
+                      help="Print the report as JSON.")
+    opts, rest = parser.parse_args(argv)
+    if opts.robot is None:
+        parser.error("--robot is required")
+
+    try:
+        robot_class = load_robot(opts.robot)
+    except ValueError as e:
+        parser.error(str(e))
+    config = ConfigObj(opts.config).dict() if opts.config else {}
+    report = run_load(
+        robot_class,
+        opts.count,
+        rate=opts.rate,
+        arrival=opts.arrival,
+        config=config,
+        argv=rest,
+        timeout=opts.timeout,
+        )
+    if opts.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print format_report(report)
+
+
+if __name__ == "__main__":
+    main()
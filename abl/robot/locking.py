@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import errno
+import fcntl
+import socket
+import sqlite3
+import threading
+import logging
+import SocketServer
+from time import time, sleep
+from uuid import uuid4
+
+from abl.util import (
+    LockFile,
+    LockFileObtainException,
+    LockFileCreationException,
+    )
+
+
+logger = logging.getLogger("abl.robot.locking")
+
+
+def make_owner_id():
+    """
+    Returns a string identifying the current process
+    across several nodes.
+    """
+    return "%s:%i:%s" % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+
+class LockLost(Exception):
+    """
+    Raised in the working thread of a robot when its leased
+    lock couldn't be renewed, so another run may hold it.
+    """
+
+    def __str__(self):
+        return Exception.__str__(self) or "The lease on the lock was lost"
+
+
+#-------------------------------------------------------------------------------
+
+class FileLock(LockFile):
+    """
+    The classic `abl.util.LockFile`, using flock(2) on
+    a local file.
+    """
+
+    def __init__(self, name, fail_on_lock=False, config=None):
+        super(FileLock, self).__init__(name, fail_on_lock=fail_on_lock, cleanup=True)
+
+
+
+class FcntlLock(object):
+    """
+    POSIX advisory record-locks via fcntl(2).
+
+    Unlike flock(2), these are forwarded to the lock-daemon
+    on most NFS-setups. The lockfile itself is never removed,
+    as that would race with other processes waiting on it.
+    """
+
+    def __init__(self, name, fail_on_lock=False, config=None):
+        self.name = name
+        self.fail_on_lock = fail_on_lock
+        self.file = None
+
+
+    def __enter__(self):
+        try:
+            fd = os.open(self.name, os.O_WRONLY | os.O_CREAT)
+        except OSError as e:
+            raise LockFileCreationException(e)
+        self.file = os.fdopen(fd, "w")
+        flags = fcntl.LOCK_EX
+        if self.fail_on_lock:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self.file, flags)
+        except IOError as e:
+            self.file.close()
+            self.file = None
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise LockFileObtainException()
+            raise
+        return self.file
+
+
+    def __exit__(self, unused_exc_type, unused_exc_val, unused_exc_tb):
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+#-------------------------------------------------------------------------------
+
+class LeasedLock(object):
+    """
+    Baseclass for locks that are held for a limited lease-time
+    only, and are kept alive by a heartbeat-thread.
+
+    If the holder dies, the lock becomes available again once
+    the lease has expired. If the lease can't be renewed - or
+    renewing it failed for the whole lease-time - `lost` is set
+    and `on_lost` is called from the heartbeat-thread.
+
+    Subclasses implement `acquire`, `renew` and `release`.
+    """
+
+    def __init__(self, name, fail_on_lock=False, config=None):
+        config = config or {}
+        self.name = name
+        self.fail_on_lock = fail_on_lock
+        self.lease = config.get("lease", 60)
+        self.heartbeat = config.get("heartbeat", 20)
+        self.poll_interval = config.get("poll_interval", 1.0)
+        if self.heartbeat >= self.lease:
+            raise LockFileCreationException(
+                "The heartbeat of %ss must be shorter than the lease of %ss"
+                % (self.heartbeat, self.lease))
+        self.owner = make_owner_id()
+        self.lost = False
+        self.on_lost = None
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+
+    def acquire(self):
+        """
+        Try to obtain the lock. Returns True on success.
+        """
+        raise NotImplementedError
+
+
+    def renew(self):
+        """
+        Extend the lease. Returns False if the lock is lost.
+        """
+        raise NotImplementedError
+
+
+    def release(self):
+        raise NotImplementedError
+
+
+    def __enter__(self):
+        while not self.acquire():
+            if self.fail_on_lock:
+                raise LockFileObtainException()
+            sleep(self.poll_interval)
+        self._stop.clear()
+        self._last_renewed = time()
+        self._heartbeat_thread = threading.Thread(target=self._beat)
+        self._heartbeat_thread.setDaemon(True)
+        self._heartbeat_thread.start()
+        return self
+
+
+    def __exit__(self, unused_exc_type, unused_exc_val, unused_exc_tb):
+        self._stop.set()
+        self._heartbeat_thread.join()
+        try:
+            self.release()
+        except Exception:
+            logger.exception("Couldn't release lock %r", self.name)
+
+
+    def check(self):
+        """
+        Raise `LockLost` if the lease was lost.
+        """
+        if self.lost:
+            raise LockLost("The lease on lock %r was lost" % self.name)
+
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                renewed = self.renew()
+            except Exception:
+                logger.exception("Couldn't renew lock %r", self.name)
+                # others may take the lock once the lease ran out
+                renewed = time() - self._last_renewed < self.lease
+            else:
+                if renewed:
+                    self._last_renewed = time()
+            if not renewed:
+                self.lost = True
+                logger.error("Lost the lease on lock %r", self.name)
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+
+
+class SQLiteLock(LeasedLock):
+    """
+    A lease in a SQLite-database, configured via `database`
+    in the locking-section. The database can live on a shared
+    filesystem. If no database is given, the lock-name is used.
+    """
+
+    def __init__(self, name, fail_on_lock=False, config=None):
+        super(SQLiteLock, self).__init__(name, fail_on_lock=fail_on_lock, config=config)
+        config = config or {}
+        self.database = config.get("database") or name
+
+
+    def _connect(self):
+        try:
+            conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        except sqlite3.Error as e:
+            raise LockFileCreationException(e)
+        conn.execute("""CREATE TABLE IF NOT EXISTS locks
+                        (name TEXT PRIMARY KEY, owner TEXT, expires REAL)""")
+        return conn
+
+
+    def acquire(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires FROM locks WHERE name=?",
+                               (self.name,)).fetchone()
+            now = time()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO locks VALUES (?, ?, ?)",
+                         (self.name, self.owner, now + self.lease))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+
+    def renew(self):
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE locks SET expires=? WHERE name=? AND owner=?",
+                (time() + self.lease, self.name, self.owner))
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+
+    def release(self):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM locks WHERE name=? AND owner=?",
+                         (self.name, self.owner))
+        finally:
+            conn.close()
+
+
+
+class ServerLock(LeasedLock):
+    """
+    A lease held on a `LockServer`, configured via
+    `server = host:port` in the locking-section.
+    """
+
+    def __init__(self, name, fail_on_lock=False, config=None):
+        super(ServerLock, self).__init__(name, fail_on_lock=fail_on_lock, config=config)
+        config = config or {}
+        host, _, port = config.get("server", "localhost:7010").rpartition(":")
+        self.address = host, int(port)
+        self.timeout = config.get("server_timeout", 10.0)
+
+
+    def _request(self, command):
+        line = "%s %s %s %i\n" % (command, self.name, self.owner, self.lease)
+        try:
+            conn = socket.create_connection(self.address, self.timeout)
+        except socket.error as e:
+            raise LockFileCreationException(e)
+        try:
+            conn.sendall(line)
+            answer = conn.makefile().readline().strip()
+        finally:
+            conn.close()
+        if answer not in ("OK", "LOCKED", "LOST"):
+            raise LockFileCreationException("Bad answer from lock-server: %r" % answer)
+        return answer == "OK"
+
+
+    def acquire(self):
+        return self._request("ACQUIRE")
+
+
+    def renew(self):
+        return self._request("RENEW")
+
+
+    def release(self):
+        self._request("RELEASE")
+
+
+#-------------------------------------------------------------------------------
+
+class LockServerHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                command, name, owner, lease = line.split()
+                lease = float(lease)
+            except ValueError:
+                self.wfile.write("ERROR\n")
+                return
+            self.wfile.write("%s\n" % self.server.process(command, name, owner, lease))
+            self.wfile.flush()
+
+
+
+class LockServer(SocketServer.ThreadingTCPServer):
+    """
+    A minimal TCP lock-server handing out leases for `ServerLock`.
+
+    The protocol is line-based, each request being::
+
+      ACQUIRE|RENEW|RELEASE <name> <owner> <lease-seconds>
+
+    answered by one of ``OK``, ``LOCKED`` or ``LOST``.
+
+    Bind it to port 0 to get an ephemeral port, e.g. in tests::
+
+      server = LockServer(("localhost", 0))
+      server.start()
+      ...
+      server.stop()
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+    def __init__(self, address=("localhost", 7010)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, LockServerHandler)
+        self.leases = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    @property
+    def address(self):
+        return "%s:%i" % self.server_address[:2]
+
+
+    def process(self, command, name, owner, lease):
+        now = time()
+        with self._lock:
+            holder, expires = self.leases.get(name, (None, 0))
+            if holder is not None and expires <= now:
+                holder = None
+            if command == "ACQUIRE":
+                if holder not in (None, owner):
+                    return "LOCKED"
+                self.leases[name] = owner, now + lease
+                return "OK"
+            if command == "RENEW":
+                if holder != owner:
+                    return "LOST"
+                self.leases[name] = owner, now + lease
+                return "OK"
+            if command == "RELEASE":
+                if holder == owner:
+                    del self.leases[name]
+                return "OK"
+        return "ERROR"
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+
+BACKENDS = dict(
+    file=FileLock,
+    fcntl=FcntlLock,
+    sqlite=SQLiteLock,
+    server=ServerLock,
+    )
+"""
+The available lock-backends, keyed by the name used in
+the `backend` option of the locking-section.
+"""
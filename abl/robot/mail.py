@@ -5,13 +5,27 @@
 
 __docformat__ = "restructuredtext en"
 
+import copy
+import email
+import random
+import logging
+import smtplib
+import threading
+from Queue import Queue, Empty, Full
+from time import time, sleep
+from email.header import decode_header
+from socket import error as socket_error
+
 from turbomail.message import Message
 from turbomail.control import interface
+from turbomail.managers.immediate import ImmediateManager
 
 from genshi.template.loader import package
 from genshi.template import MarkupTemplate, NewTextTemplate
 
 
+logger = logging.getLogger("abl.robot.mail")
+
 
 #-------------------------------------------------------------------------------
 
@@ -80,9 +94,304 @@ class TemplateMessage(Message):
         interface.send(self)
 
 
+def decode_message(msg_string):
+    """
+    Renders a MIME-message as unicode-text with decoded headers
+    and text-parts, independent of the transfer-encoding.
+    """
+    parsed = email.message_from_string(msg_string)
+    lines = []
+    for name, value in parsed.items():
+        value = u"".join(unicode(part, charset or "ascii", "replace")
+                         for part, charset in decode_header(value))
+        lines.append(u"%s: %s" % (name, value))
+    for part in parsed.walk():
+        if part.is_multipart():
+            continue
+        lines.append(u"")
+        if part.get_content_maintype() == "text":
+            charset = part.get_content_charset() or "ascii"
+            lines.append(unicode(part.get_payload(decode=True), charset, "replace"))
+        else:
+            lines.append(unicode(part.get_payload(), "ascii", "replace"))
+    return u"\n".join(lines)
+
+
+
+class MailSink(object):
+    """
+    Collects messages instead of delivering them.
+
+    Set an instance as `Robot.mail_sink` to keep the mails
+    of one robot away from the process-global turbomail
+    interface, e.g. in tests. The messages are stored as
+    text, see `decode_message`.
+
+    If a `parent` sink is given, messages are delivered
+    there as well.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._sent_mails = []
+        self._lock = threading.Lock()
+
+
+    def deliver(self, message):
+        msg_string = decode_message(str(message))
+        with self._lock:
+            self._sent_mails.append(msg_string)
+        if self.parent is not None:
+            self.parent.deliver(message)
+        return True
+
+
+    def get_sent_mails(self):
+        with self._lock:
+            return copy.copy(self._sent_mails)
+
+
+    def clear(self):
+        with self._lock:
+            self._sent_mails = []
+
+
+class MailRelayUnavailable(Exception):
+    """
+    Raised instead of trying to send a mail while the
+    `CircuitBreaker` considers the relay to be down.
+    """
+
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive delivery-failures across messages.
+
+    After `threshold` failures in a row, the breaker opens, and
+    no delivery is attempted for `reset_timeout` seconds. After
+    that, deliveries are tried again; the first success closes
+    the breaker, another failure opens it again.
+
+    A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60.0, clock=time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None \
+                   and self.clock() - self.opened_at < self.reset_timeout
+
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+
+class RetryPolicy(object):
+    """
+    Retries deliveries failing with network-errors or
+    one of the given SMTP-codes, with exponential backoff.
+
+    The n-th retry waits ``min(backoff * 2 ** (n - 1), backoff_max)``
+    seconds, reduced by up to `jitter` (a fraction) at random, so
+    robots failing together don't retry together.
+    """
+
+    def __init__(self, attempts=2, backoff=1.0, backoff_max=60.0, jitter=0.5,
+                 codes=(421, 450, 451, 452), breaker=None, sleep=sleep):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.codes = frozenset(codes)
+        self.breaker = breaker
+        self.sleep = sleep
+
+
+    def is_retriable(self, exc):
+        if isinstance(exc, (socket_error, smtplib.SMTPServerDisconnected)):
+            return True
+        if isinstance(exc, smtplib.SMTPResponseException):
+            return exc.smtp_code in self.codes
+        if isinstance(exc, smtplib.SMTPRecipientsRefused):
+            return all(code in self.codes for code, _ in exc.recipients.values())
+        return False
+
+
+    def delay(self, retry):
+        delay = min(self.backoff * 2 ** retry, self.backoff_max)
+        return delay * (1.0 - self.jitter * random.random())
+
+
+    def __call__(self, func, *args, **kwargs):
+        """
+        Call `func` until it succeeds, raises a non-retriable
+        error, or the attempts are exhausted.
+        """
+        breaker = self.breaker
+        for attempt in xrange(self.attempts):
+            if breaker is not None and breaker.is_open:
+                raise MailRelayUnavailable("Not sending, the mail-relay failed %i times in a row."
+                                           % breaker.failures)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retriable(e):
+                    raise
+                if breaker is not None:
+                    breaker.failure()
+                if attempt == self.attempts - 1:
+                    raise
+                self.sleep(self.delay(attempt))
+            else:
+                if breaker is not None:
+                    breaker.success()
+                return result
+
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        Creates a policy and its breaker from the retry.* and
+        breaker.* options of a mail-section, and removes them.
+        """
+        breaker = CircuitBreaker(
+            threshold=conf.pop("breaker.threshold", 5),
+            reset_timeout=conf.pop("breaker.reset", 60.0),
+            )
+        return cls(
+            attempts=conf.pop("retry.attempts", 2),
+            backoff=conf.pop("retry.backoff", 1.0),
+            backoff_max=conf.pop("retry.backoff_max", 60.0),
+            jitter=conf.pop("retry.jitter", 0.5),
+            codes=conf.pop("retry.codes", (421, 450, 451, 452)),
+            breaker=breaker,
+            )
+
+
+def describe_message(message):
+    """
+    Subject and recipients of a turbomail-message, for logging.
+    """
+    subject = getattr(message, "subject", None)
+    if subject is None:
+        subject = message.email_msg["Subject"]
+    return "%r to %s" % (subject, ", ".join(message.recipients.string_addresses))
+
+
+
+class MailQueue(object):
+    """
+    Delivers mails in `workers` background-threads, so sending
+    them doesn't block. `put` only blocks while `size` mails are
+    waiting already (0 is unbounded).
+
+    Each worker has a turbomail-manager of its own, as those of
+    the "immediate" kind share their SMTP-connection. `deliver` is
+    called with the message and the `send`-function of this manager.
+    """
+
+    _STOP = object()
+
+
+    def __init__(self, deliver, workers=2, size=100):
+        self.deliver = deliver
+        self.queue = Queue(size)
+        self.failed = []
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name="mail-queue-%i" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def put(self, message):
+        self.queue.put(message)
+
+
+    def _work(self):
+        manager = ImmediateManager()
+        manager.start()
+        name = threading.currentThread().getName()
+        try:
+            while True:
+                message = self.queue.get()
+                if message is self._STOP:
+                    return
+                with self._lock:
+                    self._in_flight[name] = message
+                try:
+                    self.deliver(message, manager.deliver)
+                except Exception:
+                    logger.exception("Couldn't deliver %s", describe_message(message))
+                    with self._lock:
+                        self.failed.append(message)
+                with self._lock:
+                    del self._in_flight[name]
+        finally:
+            manager.stop()
+
+
+    def close(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for the queued mails to
+        be delivered, and stops the workers.
+
+        :return: the mails that weren't delivered, either because
+                 they failed or because the time ran out.
+        """
+        deadline = time() + timeout if timeout is not None else None
+        remaining = lambda: max(deadline - time(), 0) if deadline is not None else None
+        for _ in self._threads:
+            try:
+                self.queue.put(self._STOP, timeout=remaining())
+            except Full:
+                break
+        for thread in self._threads:
+            thread.join(remaining())
+        undelivered = []
+        while True:
+            try:
+                message = self.queue.get_nowait()
+            except Empty:
+                break
+            if message is not self._STOP:
+                undelivered.append(message)
+        with self._lock:
+            return self.failed + self._in_flight.values() + undelivered
+
+
 def configure(conf):
     """
     Configures the turbomail system.
+
+    The turbomail-manager can be chosen as "manager", and
+    defaults to "immediate". `Robot` always leaves it at that:
+    its own mail.manager chooses between immediate delivery
+    and its `MailQueue`, which offers background-delivery with
+    bounded queues and draining, and isn't passed on here.
     """
     default_conf = {
         "manager" :             "immediate",
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import ctypes
+import logging
+import resource
+import threading
+
+from .history import peak_rss
+
+
+logger = logging.getLogger("abl.robot.memory")
+
+
+class MemoryLimitExceeded(Exception):
+    """
+    Raised in the working thread of a robot when the
+    process exceeds its hard memory-limit.
+    """
+
+    def __str__(self):
+        return Exception.__str__(self) or "The hard memory-limit is exceeded"
+
+
+
+def current_rss():
+    """
+    The resident set size of this process in KB. Where /proc
+    isn't available, this is the peak instead.
+    """
+    try:
+        with open("/proc/self/statm") as inf:
+            resident = int(inf.read().split()[1])
+        return resident * resource.getpagesize() // 1024
+    except (IOError, ValueError, IndexError):
+        return peak_rss()
+
+
+def raise_in_thread(thread, exc_class):
+    """
+    Raises `exc_class` asynchronously in `thread`, as soon as it
+    executes Python-code again. With None, an exception that
+    hasn't arrived yet is cleared instead.
+
+    :return: True if the thread was found
+    """
+    exc = ctypes.py_object(exc_class) if exc_class is not None else None
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread.ident), exc) == 1
+
+
+
+class MemoryWatchdog(object):
+    """
+    Samples the memory-usage every `interval` seconds in a
+    background-thread, and keeps track of its peak.
+
+    `on_soft` is called with the RSS in KB when it reaches
+    `soft_limit` KB, again only after it dropped below.
+    `on_hard` is called when it reaches `hard_limit` KB, and
+    ends the sampling. Limits of 0 are ignored. If the watchdog
+    isn't stopped within `grace` seconds after that,
+    `on_hard_stop` is called, if given.
+    """
+
+    def __init__(self, soft_limit, hard_limit, on_soft, on_hard,
+                 interval=1.0, sample=current_rss, grace=30.0, on_hard_stop=None):
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.on_soft = on_soft
+        self.on_hard = on_hard
+        self.grace = grace
+        self.on_hard_stop = on_hard_stop
+        self.interval = interval
+        self.sample = sample
+        self.peak = sample()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="memory-watchdog")
+        self._thread.setDaemon(True)
+
+
+    def _run(self):
+        soft_reached = False
+        while not self._stop.wait(self.interval):
+            rss = self.sample()
+            self.peak = max(self.peak, rss)
+            if self.hard_limit and rss >= self.hard_limit:
+                self.on_hard(rss)
+                if self.on_hard_stop is not None and not self._stop.wait(self.grace):
+                    self.on_hard_stop()
+                return
+            if self.soft_limit and rss >= self.soft_limit:
+                if not soft_reached:
+                    soft_reached = True
+                    try:
+                        self.on_soft(rss)
+                    except Exception:
+                        logger.exception("Memory-pressure hook failed")
+            else:
+                soft_reached = False
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import errno
+import json
+import socket
+import logging
+import threading
+from time import time
+from uuid import uuid4
+
+from turbomail.wrappedmessage import WrappedMessage
+
+from .checkpoint import atomic_write
+from .mail import MailRelayUnavailable
+
+
+logger = logging.getLogger("abl.robot.outbox")
+
+
+class Outbox(object):
+    """
+    A spool-directory for mails, to deliver them later.
+
+    Each mail is written atomically into its own file, named
+    so that they sort in the order they were spooled. While
+    being delivered, a file is renamed to claim it, so several
+    flushing processes don't send a mail twice. Claims of dead
+    processes on this host, and claims older than `claim_timeout`
+    seconds, are taken back by `reclaim`.
+
+    A mail failing `max_attempts` times is moved aside, with the
+    suffix `FAILED_SUFFIX`, so it doesn't hold up the others.
+    """
+
+    SUFFIX = ".mail"
+
+    FAILED_SUFFIX = ".failed"
+
+    CLAIM_SEPARATOR = "@"
+    """
+    Separates the name of a mail from the "host:pid" of its
+    claim - it can't appear in hostnames.
+    """
+
+
+    def __init__(self, directory, max_attempts=5, claim_timeout=3600.0):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def spool(self, message):
+        """
+        Store a turbomail-message for later delivery.
+
+        :return: the path of the spooled mail
+        """
+        data = json.dumps(dict(
+            sender=str(message.envelope_sender),
+            recipients=message.recipients.string_addresses,
+            message=str(message),
+            ))
+        name = "%017.6f-%s%s" % (time(), uuid4().hex, self.SUFFIX)
+        path = os.path.join(self.directory, name)
+        atomic_write(path, data)
+        return path
+
+
+    def pending(self):
+        """
+        The names of the spooled mails, oldest first.
+        """
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(self.SUFFIX))
+
+
+    def failed(self):
+        """
+        The names of the mails that were given up on.
+        """
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(self.FAILED_SUFFIX))
+
+
+    def _claim_suffix(self):
+        return "%s%s:%i" % (self.CLAIM_SEPARATOR, socket.gethostname(), os.getpid())
+
+
+    def reclaim(self):
+        """
+        Puts the mails claimed by processes that died back into
+        the outbox. On other hosts, processes can't be checked,
+        so their claims are taken back after `claim_timeout`.
+
+        :return: the number of reclaimed mails
+        """
+        hostname = socket.gethostname()
+        reclaimed = 0
+        for name in os.listdir(self.directory):
+            mail, separator, claim = name.partition(self.CLAIM_SEPARATOR)
+            if not separator:
+                # claimed by an older version, as "<mail>.<host>:<pid>"
+                base, separator, claim = name.partition(self.SUFFIX + ".")
+                mail = base + self.SUFFIX
+            host, _, pid = claim.rpartition(":")
+            if not separator or not mail.endswith(self.SUFFIX) or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, name)
+            if host == hostname:
+                if _alive(int(pid)):
+                    continue
+            else:
+                try:
+                    # renaming updates the ctime, so it's the claim-time
+                    if time() - os.stat(path).st_ctime < self.claim_timeout:
+                        continue
+                except OSError:
+                    continue
+            try:
+                os.rename(path, os.path.join(self.directory, mail))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            logger.warn("Reclaimed %s from %s", mail, claim)
+            reclaimed += 1
+        return reclaimed
+
+
+    def flush(self, deliver, batch=None, skip=None):
+        """
+        Deliver up to `batch` spooled mails through `deliver`, which
+        is passed a turbomail `WrappedMessage`.
+
+        Mails that fail stay in the outbox, until they failed
+        `max_attempts` times. Their names are added to `skip`, and
+        mails in `skip` aren't tried. Flushing stops early when the
+        mail-relay is known to be unavailable.
+
+        :return: a tuple of the numbers of sent and failed mails
+        """
+        self.reclaim()
+        skip = skip if skip is not None else set()
+        sent = failed = 0
+        names = [name for name in self.pending() if name not in skip]
+        for name in names[:batch]:
+            path = os.path.join(self.directory, name)
+            claimed = path + self._claim_suffix()
+            try:
+                os.rename(path, claimed)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # another process got it first
+                    continue
+                raise
+            data = None
+            try:
+                with open(claimed) as inf:
+                    data = json.load(inf)
+                deliver(WrappedMessage(data["sender"], data["recipients"],
+                                       data["message"].encode("utf-8")))
+            except MailRelayUnavailable:
+                os.rename(claimed, path)
+                break
+            except Exception:
+                logger.exception("Couldn't deliver %s", name)
+                failed += 1
+                skip.add(name)
+                self._failed(name, claimed, data)
+            else:
+                os.remove(claimed)
+                sent += 1
+        return sent, failed
+
+
+    def _failed(self, name, claimed, data):
+        """
+        Counts the failed attempt, and puts the mail back - or
+        aside, if it failed too often or can't be read.
+        """
+        path = os.path.join(self.directory, name)
+        attempts = data.get("attempts", 0) + 1 if isinstance(data, dict) else None
+        if attempts is None or attempts >= self.max_attempts:
+            os.rename(claimed, path[:-len(self.SUFFIX)] + self.FAILED_SUFFIX)
+            logger.error("Giving up on %s after %s attempts", name, attempts or "unreadable")
+            return
+        data["attempts"] = attempts
+        atomic_write(claimed, json.dumps(data))
+        os.rename(claimed, path)
+
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+
+class OutboxFlusher(object):
+    """
+    Flushes an outbox every `interval` seconds in
+    a background-thread.
+    """
+
+    def __init__(self, outbox, deliver, interval=30.0, batch=None):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.interval = interval
+        self.batch = batch
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.outbox.flush(self.deliver, self.batch)
+            except Exception:
+                logger.exception("Couldn't flush the outbox")
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+
+__docformat__ = "restructuredtext en"
+
+import hashlib
+
+
+def stable_hash(value):
+    """
+    A hash of `value` that is the same for all processes
+    and hosts, unlike the builtin `hash`.
+
+    Unicode is hashed via its UTF-8 encoding, everything
+    else via its `str`.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+def partition(iterable, index, count, key=None):
+    """
+    Yields those items of `iterable` belonging to shard
+    `index` of `count` shards.
+
+    :param key: a callable computing the value to hash from an item.
+                Defaults to the item itself.
+    """
+    for item in iterable:
+        value = item if key is None else key(item)
+        if stable_hash(value) % count == index:
+            yield item
+
+
+def shard_name(name, index, count):
+    """
+    Derives the name of a per-shard resource, like
+    the lockfile, from the configured name.
+    """
+    if count == 1:
+        return name
+    return "%s.shard-%i-of-%i" % (name, index, count)
+
+
+def splay_offset(max_splay, *key):
+    """
+    A delay within [0, `max_splay`) seconds, derived from `key`
+    via `stable_hash`. The same key always gets the same delay,
+    while different keys spread evenly across the interval.
+    """
+    if max_splay <= 0:
+        return 0.0
+    return stable_hash(":".join(str(part) for part in key)) % 1000000 / 1000000.0 * max_splay
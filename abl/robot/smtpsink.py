@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import threading
+import SocketServer
+from time import time, sleep
+
+
+class SMTPSinkHandler(SocketServer.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept mails from `smtplib`.
+    """
+
+    def reply(self, line):
+        self.wfile.write("%s\r\n" % line)
+        self.wfile.flush()
+
+
+    def reply_or_fail(self, command, line):
+        """
+        Sends `line`, unless a failure was injected for `command`.
+
+        :return: True if the command succeeded.
+        """
+        failure = self.server.before_reply(command)
+        self.reply(failure or line)
+        return failure is None
+
+
+    def handle(self):
+        server = self.server
+        server.connection_opened()
+        try:
+            if not self.reply_or_fail("CONNECT", "220 %s SMTP sink ready" % server.hostname):
+                return
+            self.converse()
+        finally:
+            server.connection_closed()
+
+
+    def converse(self):
+        server = self.server
+        mailfrom, rcpttos = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.strip().partition(" ")
+            command = command.upper()
+            server.count_command(command)
+            if command == "EHLO":
+                self.wfile.write("250-%s\r\n" % server.hostname)
+                self.reply("250 PIPELINING")
+            elif command == "HELO":
+                self.reply("250 %s" % server.hostname)
+            elif command == "MAIL":
+                if self.reply_or_fail(command, "250 OK"):
+                    mailfrom, rcpttos = argument.partition(":")[2].strip(), []
+            elif command == "RCPT":
+                if self.reply_or_fail(command, "250 OK"):
+                    rcpttos.append(argument.partition(":")[2].strip())
+            elif command == "DATA":
+                if not rcpttos:
+                    self.reply("503 Need RCPT first")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for line in iter(self.rfile.readline, ""):
+                    if line in (".\r\n", ".\n"):
+                        break
+                    if line.startswith(".."):
+                        line = line[1:]
+                    data.append(line)
+                if self.reply_or_fail(command, "250 OK"):
+                    server.record(mailfrom, rcpttos, "".join(data))
+                mailfrom, rcpttos = None, []
+            elif command == "RSET":
+                mailfrom, rcpttos = None, []
+                self.reply("250 OK")
+            elif command == "NOOP":
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+
+class SMTPSink(SocketServer.ThreadingTCPServer):
+    """
+    A local SMTP-server recording all mails it receives,
+    to be used instead of a real relay in tests and
+    load-tests.
+
+    Bind it to port 0 to get an ephemeral port::
+
+      sink = SMTPSink(("localhost", 0))
+      sink.start()
+      ... configure "smtp.server" as sink.address ...
+      sink.stop()
+
+    The recorded mails are available as ``messages``, a list
+    of (mailfrom, rcpttos, data, timestamp)-tuples.
+
+    To simulate a slow or failing relay, delays and failures can be
+    injected for the phases CONNECT (the greeting), MAIL, RCPT and
+    DATA (the reply after the message-data)::
+
+      sink.delays["DATA"] = 0.5
+      sink.fail("DATA", times=2)               # 451 twice, then accept
+      sink.fail("CONNECT", code=421, times=1)  # refuse one connection
+
+    `stats` reports connection-counts and the throughput.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    hostname = "localhost"
+
+
+    def __init__(self, address=("localhost", 0)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, SMTPSinkHandler)
+        self.messages = []
+        self.connections = 0
+        self.active_connections = 0
+        self.max_active_connections = 0
+        self.commands = {}
+        self.failures = []
+        self.delays = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._started = None
+
+
+    @property
+    def address(self):
+        return "%s:%i" % self.server_address[:2]
+
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active_connections += 1
+            self.max_active_connections = max(self.max_active_connections,
+                                              self.active_connections)
+
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+
+    def count_command(self, command):
+        with self._lock:
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+
+    def fail(self, command, code=451, text="Try again later", times=1):
+        """
+        Make the next `times` occurrences of `command` fail
+        with the given reply.
+        """
+        with self._lock:
+            self._failures.setdefault(command, []).extend(
+                ["%i %s" % (code, text)] * times)
+
+
+    def before_reply(self, command):
+        """
+        Applies the injected delay for `command`, and returns
+        the injected failure-reply, if any.
+        """
+        delay = self.delays.get(command)
+        if delay:
+            sleep(delay)
+        with self._lock:
+            pending = self._failures.get(command)
+            if pending:
+                failure = pending.pop(0)
+                self.failures.append((command, failure))
+                return failure
+        return None
+
+
+    def record(self, mailfrom, rcpttos, data):
+        with self._lock:
+            self.messages.append((mailfrom, rcpttos, data, time()))
+
+
+    def stats(self):
+        """
+        Counters and throughput since the sink was started.
+        """
+        with self._lock:
+            messages = len(self.messages)
+            elapsed = time() - self._started if self._started else 0.0
+            return dict(
+                messages=messages,
+                connections=self.connections,
+                max_active_connections=self.max_active_connections,
+                messages_per_connection=messages / float(self.connections) if self.connections else 0.0,
+                failures=len(self.failures),
+                commands=dict(self.commands),
+                elapsed=elapsed,
+                throughput=messages / elapsed if elapsed else 0.0,
+                )
+
+
+    def start(self):
+        self._started = time()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
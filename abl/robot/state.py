@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import json
+import sqlite3
+import threading
+from time import time
+
+
+def _dump(value):
+    # sorted keys make equal values compare equal in SQL
+    return json.dumps(value, sort_keys=True)
+
+
+
+class StateStore(object):
+    """
+    A persistent key/value-store for state that survives
+    between robot runs, e.g. high-water marks of processed data.
+
+    Values must be JSON-serializable. The data lives in an SQLite
+    database; writes are committed in batches of `commit_every`
+    updates or after `commit_interval` seconds. While a batch is
+    open, other processes can read, but not write the database.
+
+    Without a filename, the store only lives in memory.
+    """
+
+    def __init__(self, filename=None, commit_every=100, commit_interval=5.0):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._last_commit = time()
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            filename if filename is not None else ":memory:",
+            timeout=30,
+            check_same_thread=False,
+            )
+        with self._lock:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS state
+                                  (key TEXT PRIMARY KEY, value TEXT NOT NULL)""")
+            self._conn.commit()
+
+
+    def __contains__(self, key):
+        return self._get(key) is not None
+
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM state WHERE key=?", (key,))
+            if not cursor.rowcount:
+                raise KeyError(key)
+            self._written()
+
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key=?",
+                                     (key,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is None:
+            return default
+        return json.loads(value)
+
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                               (key, _dump(value)))
+            self._written()
+
+
+    def compare_and_set(self, key, expected, value):
+        """
+        Set `key` to `value` only if it currently is `expected`.
+
+        An `expected` value of None means the key must not exist.
+
+        :return: True if the value was set.
+        :rtype: bool
+        """
+        with self._lock:
+            if expected is None:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO state VALUES (?, ?)",
+                    (key, _dump(value)))
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE state SET value=? WHERE key=? AND value=?",
+                    (_dump(value), key, _dump(expected)))
+            if cursor.rowcount != 1:
+                return False
+            self._written()
+            return True
+
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.commit_every \
+               or time() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+
+    def commit(self):
+        """
+        Make all pending updates durable.
+        """
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+            self._last_commit = time()
+
+
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+
+__docformat__ = "restructuredtext en"
+
+
+def percentile(values, p):
+    """
+    The `p`-th percentile (0..100) of `values`, by
+    linear interpolation. Returns None for no values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+    """
+    Count, min, max, mean and the given percentiles of `values`
+    as a dict, with the percentiles keyed as "p50" and so on.
+    """
+    values = sorted(values)
+    summary = dict(count=len(values))
+    if values:
+        summary.update(
+            min=values[0],
+            max=values[-1],
+            mean=sum(values) / float(len(values)),
+            )
+    for p in percentiles:
+        summary["p%i" % p] = percentile(values, p)
+    return summary
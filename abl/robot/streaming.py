@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Mails with attachments that are streamed from their source onto
+the SMTP-connection, instead of being assembled in memory.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import zlib
+import time
+import struct
+import base64
+import socket
+import smtplib
+import logging
+import mimetypes
+from uuid import uuid4
+from urllib import quote
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+
+logger = logging.getLogger("abl.robot.streaming")
+
+
+CHUNK_SIZE = 57 * 1024
+"""
+Bytes read per chunk. A multiple of 57, so each chunk
+encodes to whole base64-lines of 76 characters.
+"""
+
+COMPRESSED_TYPES = frozenset([
+    "application/gzip",
+    "application/x-gzip",
+    "application/zip",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/pdf",
+    ])
+"""
+Content-types that don't get smaller by compressing them,
+in addition to images, audio and video.
+"""
+
+
+class Attachment(object):
+    """
+    An attachment for `Robot.sendmail` that is read in chunks
+    while sending, so its size doesn't matter for memory.
+
+    The source can be a filename, a file-like object, or an
+    iterable of strings. Iterators and unseekable files can only
+    be sent once, so deliveries streaming from them aren't retried.
+    """
+
+    def __init__(self, source, name=None, content_type=None):
+        self.source = source
+        if name is None:
+            name = getattr(source, "name", None) if not isinstance(source, basestring) else source
+        if name is None:
+            raise ValueError("Please give a name for attachment %r" % source)
+        self.name = name.rsplit("/", 1)[-1]
+        if content_type is None:
+            content_type = mimetypes.guess_type(self.name)[0] or "application/octet-stream"
+        self.content_type = content_type
+        self._consumed = False
+
+
+    def chunks(self):
+        """
+        Yields the raw content in chunks of `CHUNK_SIZE`.
+        """
+        source = self.source
+        if isinstance(source, basestring):
+            with open(source, "rb") as inf:
+                for chunk in iter(lambda: inf.read(CHUNK_SIZE), ""):
+                    yield chunk
+        elif hasattr(source, "read"):
+            if hasattr(source, "seek"):
+                source.seek(0)
+            elif self._consumed:
+                raise RuntimeError("Attachment %s can't be read twice" % self.name)
+            self._consumed = True
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), ""):
+                yield chunk
+        else:
+            if iter(source) is source:
+                if self._consumed:
+                    raise RuntimeError("Attachment %s can't be read twice" % self.name)
+                self._consumed = True
+            for chunk in rechunk(source, CHUNK_SIZE):
+                yield chunk
+
+
+    def size(self):
+        """
+        The size of the content in bytes, or None if it
+        can't be known without reading it.
+        """
+        source = self.source
+        if isinstance(source, basestring):
+            return os.path.getsize(source)
+        if hasattr(source, "read"):
+            if hasattr(source, "fileno"):
+                try:
+                    return os.fstat(source.fileno()).st_size
+                except (IOError, OSError, ValueError):
+                    pass
+            if hasattr(source, "seek"):
+                position = source.tell()
+                source.seek(0, os.SEEK_END)
+                try:
+                    return source.tell()
+                finally:
+                    source.seek(position)
+            return None
+        if iter(source) is source:
+            return None
+        return sum(len(piece) for piece in source)
+
+
+    def compressible(self):
+        """
+        False for content-types that are compressed already.
+        """
+        major = self.content_type.split("/", 1)[0]
+        return major not in ("image", "audio", "video") \
+               and self.content_type not in COMPRESSED_TYPES \
+               and mimetypes.guess_type(self.name)[1] is None
+
+
+    def encoded(self):
+        """
+        Yields the base64-encoded content, line by line.
+        """
+        return encode_chunks(self.chunks())
+
+
+
+class CompressedAttachment(Attachment):
+    """
+    Compresses another attachment with gzip or zip
+    while it is read.
+    """
+
+    METHODS = dict(
+        gzip=(".gz", "application/gzip"),
+        zip=(".zip", "application/zip"),
+        )
+
+
+    def __init__(self, attachment, method="gzip", level=6):
+        suffix, content_type = self.METHODS[method]
+        super(CompressedAttachment, self).__init__(
+            attachment, name=attachment.name + suffix, content_type=content_type)
+        self.method = method
+        self.level = level
+
+
+    def chunks(self):
+        original = self.source
+        if self.method == "gzip":
+            compressed = gzip_chunks(original.chunks(), self.level)
+        else:
+            compressed = zip_chunks(original.name, original.chunks(), self.level)
+        return rechunk(compressed, CHUNK_SIZE)
+
+
+    def size(self):
+        return None
+
+
+    def compressible(self):
+        return False
+
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compresses `chunks` into a gzip-stream, chunk by chunk.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def zip_chunks(name, chunks, level=6, date_time=None):
+    """
+    Compresses `chunks` into a zip-archive containing one
+    file called `name`, chunk by chunk.
+
+    As the sizes and checksum aren't known up front, they
+    follow the data in a data-descriptor. There is no ZIP64
+    support, so the content must stay below 4GB.
+    """
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    year, month, day, hour, minute, second = (date_time or time.localtime())[:6]
+    dos_time = hour << 11 | minute << 5 | second // 2
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    # data-descriptor follows, name is utf-8
+    flags = 1 << 3 | 1 << 11
+    header = struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, flags, 8, dos_time, dos_date,
+                         0, 0, 0, len(name), 0) + name
+    yield header
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = size = compressed_size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        compressed = compressor.compress(chunk)
+        compressed_size += len(compressed)
+        if compressed:
+            yield compressed
+    compressed = compressor.flush()
+    compressed_size += len(compressed)
+    crc &= 0xffffffff
+    yield compressed + struct.pack("<IIII", 0x08074b50, crc, compressed_size, size)
+
+    directory = struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, flags, 8,
+                            dos_time, dos_date, crc, compressed_size, size,
+                            len(name), 0, 0, 0, 0, 0, 0) + name
+    offset = len(header) + compressed_size + 16
+    yield directory + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 1, 1,
+                                  len(directory), offset, 0)
+
+
+
+class AttachmentPolicy(object):
+    """
+    Decides how `Robot.sendmail` treats big attachments:
+
+     - attachments of more than `compress_threshold` bytes are
+       compressed with `compress`, which is "gzip", "zip" or None.
+       Those of unknown size (iterators) always are.
+
+     - attachments of more than `max_size` bytes (before compressing)
+       are copied to `artifact_dir`, and the mail contains a link to
+       them instead - prefixed with `artifact_url` if given. Without
+       an artifact-directory, they are sent anyway.
+
+    A `max_size` of 0 means no limit.
+    """
+
+    def __init__(self, compress=None, compress_threshold=1024 * 1024, compress_level=6,
+                 max_size=0, artifact_dir=None, artifact_url=None):
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.max_size = max_size
+        self.artifact_dir = artifact_dir
+        self.artifact_url = artifact_url
+
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        Creates a policy from the attachments.* options
+        of a mail-section, and removes them.
+        """
+        compress = conf.pop("attachments.compress", "none")
+        return cls(
+            compress=None if compress == "none" else compress,
+            compress_threshold=conf.pop("attachments.compress_threshold", 1024 * 1024),
+            compress_level=conf.pop("attachments.compress_level", 6),
+            max_size=conf.pop("attachments.max_size", 0),
+            artifact_dir=conf.pop("attachments.artifact_dir", None),
+            artifact_url=conf.pop("attachments.artifact_url", None),
+            )
+
+
+    @property
+    def active(self):
+        return bool(self.compress or self.max_size)
+
+
+    def apply(self, text, attachments):
+        """
+        Applies the policy to the attachments of a mail.
+
+        :return: a tuple of the text, extended by the links
+                 to stored attachments, and the attachments
+                 to actually send.
+        """
+        result, links = [], []
+        for original in attachments:
+            attachment = original
+            if not isinstance(attachment, Attachment):
+                name, content = attachment
+                attachment = Attachment([content], name=name)
+            size = attachment.size()
+            if self.max_size and size is not None and size > self.max_size:
+                if self.artifact_dir is not None:
+                    links.append(u"%s (%i bytes): %s" % (
+                        attachment.name, size, self.store(attachment)))
+                    continue
+                logger.warn("Attachment %s exceeds %i bytes", attachment.name, self.max_size)
+            if self.compress and attachment.compressible() \
+                   and (size is None or size > self.compress_threshold):
+                result.append(CompressedAttachment(attachment, self.compress, self.compress_level))
+            else:
+                result.append(original)
+        if links:
+            if isinstance(text, str):
+                text = text.decode("utf-8")
+            text = u"%s\n\nThese attachments were too big to be sent, " \
+                   u"they are stored at:\n\n%s\n" % (text or u"", u"\n".join(links))
+        return text, result
+
+
+    def store(self, attachment):
+        """
+        Copies the content of `attachment` into a directory
+        of its own below `artifact_dir`.
+
+        :return: the link to the stored file
+        """
+        dirname = "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), uuid4().hex[:8])
+        directory = os.path.join(self.artifact_dir, dirname)
+        os.makedirs(directory)
+        name = attachment.name
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        path = os.path.join(directory, name)
+        with open(path + ".tmp", "wb") as outf:
+            for chunk in attachment.chunks():
+                outf.write(chunk)
+        os.rename(path + ".tmp", path)
+        if self.artifact_url:
+            return "%s/%s/%s" % (self.artifact_url.rstrip("/"), dirname, quote(name))
+        return os.path.abspath(path)
+
+
+
+def encode_chunks(chunks):
+    """
+    Base64-encodes chunks of a multiple of 57 bytes
+    (except the last), yielding lines of 76 characters.
+    """
+    for chunk in chunks:
+        encoded = base64.b64encode(chunk)
+        for i in xrange(0, len(encoded), 76):
+            yield encoded[i:i + 76] + "\r\n"
+
+
+def rechunk(iterable, size):
+    """
+    Turns an iterable of strings of any size into one of
+    strings of exactly `size` bytes, except for the last.
+    """
+    buf = []
+    buffered = 0
+    for piece in iterable:
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            data = "".join(buf)
+            end = len(data) - len(data) % size
+            for i in xrange(0, end, size):
+                yield data[i:i + size]
+            buf = [data[end:]]
+            buffered = len(buf[0])
+    if buffered:
+        yield "".join(buf)
+
+
+def _header(value):
+    if isinstance(value, unicode):
+        try:
+            return value.encode("ascii")
+        except UnicodeEncodeError:
+            return Header(value, "utf-8").encode()
+    return value
+
+
+def render_message(author, to, subject, text, attachments):
+    """
+    Yields a multipart MIME-message in pieces of whole lines.
+
+    `attachments` may contain both `Attachment`-instances and the
+    (name, content)-tuples `Robot.sendmail` accepts.
+    """
+    boundary = "==robot-%s==" % uuid4().hex
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    yield "".join("%s: %s\r\n" % (name, value) for name, value in [
+        ("From", _header(author)),
+        ("To", ", ".join(_header(address) for address in to)),
+        ("Subject", _header(subject)),
+        ("Date", formatdate(localtime=True)),
+        ("Message-ID", make_msgid()),
+        ("MIME-Version", "1.0"),
+        ("Content-Type", 'multipart/mixed; boundary="%s"' % boundary),
+        ])
+    yield "\r\n--%s\r\n" % boundary
+    yield "Content-Type: text/plain; charset=utf-8\r\n"
+    yield "Content-Transfer-Encoding: base64\r\n\r\n"
+    yield base64.encodestring(text).replace("\n", "\r\n")
+    for attachment in attachments:
+        if isinstance(attachment, Attachment):
+            name, content_type = attachment.name, attachment.content_type
+            lines = attachment.encoded()
+        else:
+            name, content = attachment
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            lines = encode_chunks(rechunk([content], CHUNK_SIZE))
+        yield "\r\n--%s\r\n" % boundary
+        yield "Content-Type: %s\r\n" % content_type
+        yield "Content-Transfer-Encoding: base64\r\n"
+        yield 'Content-Disposition: attachment; filename="%s"\r\n\r\n' % _header(name)
+        for line in lines:
+            yield line
+    yield "\r\n--%s--\r\n" % boundary
+
+
+def send_streamed(server, sender, recipients, pieces,
+                  username=None, password=None, tls=None, timeout=60):
+    """
+    Sends the message yielded by `pieces` via SMTP, writing
+    each piece onto the connection as it is produced.
+
+    `pieces` must consist of whole lines.
+    """
+    connection = smtplib.SMTP(timeout=timeout)
+    connection.connect(server)
+    try:
+        connection.ehlo()
+        if tls or (tls is None and connection.has_extn("STARTTLS")):
+            connection.starttls()
+            connection.ehlo()
+        if username and password:
+            connection.login(username, password)
+        code, response = connection.mail(sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, sender)
+        refused = {}
+        for recipient in recipients:
+            code, response = connection.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, response = connection.docmd("DATA")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+        for piece in pieces:
+            # dot-stuffing, see RFC 5321, 4.5.2
+            if piece.startswith("."):
+                piece = "." + piece
+            connection.send(piece.replace("\r\n.", "\r\n.."))
+        connection.send(".\r\n")
+        code, response = connection.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+    finally:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
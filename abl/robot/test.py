@@ -1,17 +1,122 @@
+import sys
 from contextlib import contextmanager
-from tempfile import mktemp
 from unittest import TestCase
 
 from configobj import ConfigObj
 import threading
 from turbomail.control import interface
 
+from .mail import MailSink, decode_message
+from .smtpsink import SMTPSink
+
 #-------------------------------------------------------------------------------
 
 
+class RobotTimeout(AssertionError):
+    """
+    Raised when a threaded robot didn't finish in time.
+    """
+
+
+
+class RobotHandle(object):
+    """
+    A future-like handle on a robot running in its own thread,
+    as returned by `RobotTestCase.start_robot(threaded=True, handle=True)`.
+
+    Attribute-access not handled here is passed on to the robot.
+    """
+
+    def __init__(self, robot, smtp_sink=None):
+        self.robot = robot
+        self.smtp_sink = smtp_sink
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+
+    def __getattr__(self, name):
+        return getattr(self.robot, name)
+
+
+    def _run(self):
+        try:
+            self._result = self.robot.run()
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def done(self):
+        return self._done.is_set()
+
+
+    def wait(self, timeout=None):
+        """
+        Wait for the robot to finish.
+
+        :return: True if the robot has finished.
+        """
+        return self._done.wait(timeout)
+
+
+    def _wait_or_fail(self, timeout):
+        if not self.wait(timeout):
+            raise RobotTimeout("Robot %s didn't finish within %ss" % (self.robot.name, timeout))
+
+
+    def result(self, timeout=None):
+        """
+        Wait for the robot to finish and return the result of its
+        `work`, or re-raise the exception it raised.
+
+        :raises RobotTimeout: if the robot didn't finish within timeout.
+        """
+        self._wait_or_fail(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+    def exception(self, timeout=None):
+        """
+        Wait for the robot to finish and return the exception
+        it raised, if any.
+        """
+        self._wait_or_fail(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+
+    def messages(self):
+        """
+        The mails sent by this robot. If it delivers to an
+        `SMTPSink`, these are all mails the sink received.
+        """
+        if self.robot.mail_sink is not None:
+            return self.robot.mail_sink.get_sent_mails()
+        if self.smtp_sink is not None:
+            return [decode_message(data) for _, _, data, _ in self.smtp_sink.messages]
+        return []
+
+
+
 class RobotTestCase(TestCase):
     """
     Special baseclass to test Robots.
+
+    Robots started through `start_robot` get their configuration
+    in memory, and deliver their mails into a `MailSink` of the
+    test instead of the process-global turbomail-interface, so the
+    tests can be run by a multi-process test-runner.
     """
 
     ROBOT_CLASS = None
@@ -19,19 +124,44 @@ class RobotTestCase(TestCase):
     The class to instantiate. Override in subclasses.
     """
 
+    _multiprocess_can_split_ = True
+
+
+    def run(self, result=None):
+        # not in setUp, so subclasses needn't call ours
+        self.mail_sink = MailSink()
+        return super(RobotTestCase, self).run(result)
+
+
+    def start_smtp_sink(self):
+        """
+        Start a local `SMTPSink` on an ephemeral port, which
+        is stopped when the test is done. Pass it as `smtp_sink`
+        to `start_robot` to have the robot send mails over SMTP.
+        """
+        sink = SMTPSink(("localhost", 0))
+        sink.start()
+        self.addCleanup(sink.stop)
+        return sink
+
 
-    @classmethod
-    def get_messages(cls):
+    def get_messages(self):
+        messages = self.mail_sink.get_sent_mails()
         if interface and interface.manager and interface.manager.transport: #@UndefinedVariable
+            # robots not started through start_robot use turbomail, whose
             # transport is only available after at least one mail has been sent
-            return interface.manager.transport.get_sent_mails() #@UndefinedVariable
-        else:
-            return []
+            transport = interface.manager.transport #@UndefinedVariable
+            if hasattr(transport, "get_sent_mails"):
+                messages.extend(transport.get_sent_mails())
+        return messages
+
 
-    @classmethod
-    def clear_messages(cls):
+    def clear_messages(self):
+        self.mail_sink.clear()
         if interface and interface.manager and interface.manager.transport: #@UndefinedVariable
-            interface.manager.transport._sent_mails = []
+            transport = interface.manager.transport #@UndefinedVariable
+            if hasattr(transport, "get_sent_mails"):
+                transport._sent_mails = []
 
 
     def start_robot(self,
@@ -43,7 +173,9 @@ class RobotTestCase(TestCase):
                     commands=None,
                     robot_class=None,
                     raise_exceptions=True,
-                    argv=[]
+                    argv=[],
+                    smtp_sink=None,
+                    handle=False,
                     ):
         """
         Create a robot-instance.
@@ -68,10 +200,11 @@ class RobotTestCase(TestCase):
         :param norun: if True, don't invoke run (either threaded or directly)
         :type norun: bool
 
-        :param config: if given as dictionary, it will be written out as
-                       `ConfigObj` and the resulting file passed as
-                       --config-option.
-        :type config: None|dict
+        :param config: if given as dictionary or string, it will be
+                       passed as configuration to `Robot.setup`. A
+                       config-file given via `argv` or `opts` is read
+                       instead, giving both raises ValueError.
+        :type config: None|dict|basestring
 
         :param commands: list of callables; each function will be called
                          with the instanciated robot as argument.
@@ -81,32 +214,24 @@ class RobotTestCase(TestCase):
                             of ROBOT_CLASS class attribute
 
         :type robot_class: None|class
+
+        :param smtp_sink: if given, the robot delivers its mails via SMTP
+                          to this `SMTPSink` instead of the in-memory
+                          `MailSink`. This configures the process-global
+                          turbomail-interface.
+        :type smtp_sink: None|SMTPSink
+
+        :param handle: if True, return a `RobotHandle` instead of the
+                       robot, which allows to wait for the result of a
+                       threaded robot, and carries the result or the
+                       exception of an unthreaded one.
+        :type handle: bool
         """
 
         cm_opts = [] + argv
         if raise_exceptions:
             cm_opts.append("--raise-exceptions")
 
-        if config is None:
-            config = dict(mail=dict(transport="debug"),
-                          pingback=dict(url=""))
-
-        if config is not None:
-            config_filename = mktemp("robottestconfig")
-            if isinstance(config, basestring):
-                cf = ConfigObj(config.split("\n"))
-            else:
-                cf = ConfigObj()
-                for key, value in config.iteritems():
-                    cf[key] = value
-
-            cf["mail"] = dict(transport="debug")
-            cf["pingback"] = dict(url="")
-
-            cf.filename = config_filename
-            cf.write()
-            cm_opts.append("--config=%s" % cf.filename)
-
         for key, value in opts.iteritems():
             if len(key) == 1:
                 name = "-" + key
@@ -131,7 +256,35 @@ class RobotTestCase(TestCase):
 
         robot_class = robot_class if robot_class else self.ROBOT_CLASS
         robot = robot_class()
-        robot.setup(argv=cm_opts)
+
+        config_file = robot.parser.parse_args(list(cm_opts))[0].config
+        if config_file is not None:
+            if config is not None:
+                raise ValueError("Please give either a config or a config-file, not both")
+            # read here, so the mail-settings can be replaced
+            cf = ConfigObj(config_file, file_error=True)
+        else:
+            if config is None:
+                config = dict(mail=dict(transport="debug"),
+                              pingback=dict(url=""))
+            if isinstance(config, basestring):
+                cf = ConfigObj(config.split("\n"))
+            else:
+                cf = ConfigObj()
+                for key, value in config.iteritems():
+                    cf[key] = value
+
+        mail = dict(cf.get("mail", {}))
+        if smtp_sink is not None:
+            mail.update({"transport" : "smtp", "smtp.server" : smtp_sink.address})
+        else:
+            mail["transport"] = "debug"
+        cf["mail"] = mail
+        cf["pingback"] = dict(url="")
+
+        if smtp_sink is None:
+            robot.mail_sink = MailSink(parent=self.mail_sink)
+        robot.setup(argv=cm_opts, config=cf)
         if commands is not None:
             for cmd in commands:
                 cmd(robot)
@@ -145,13 +298,14 @@ class RobotTestCase(TestCase):
         robot._locking_context = _locking_context
         if nomail:
             robot.EXCEPTION_MAILING = None
+        # FIXME-dir: remove this
+        self.robot = robot
+        robot_handle = RobotHandle(robot, smtp_sink=smtp_sink)
         if not norun:
             if threaded:
-                t = threading.Thread(target=robot.run)
-                t.setDaemon(True)
-                t.start()
+                robot_handle.start()
             else:
-                robot.run()
-        # FIXME-dir: remove this
-        self.robot = robot
-        return robot
+                robot_handle._run()
+                if not handle:
+                    robot_handle.result()
+        return robot_handle if handle else robot
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Watching paths for changes, to start robots on demand instead
+of polling via cron.
+
+Linux gets inotify through libc, everything else - and filesystems
+inotify doesn't see changes on, like NFS - falls back to comparing
+`os.stat` results.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import stat
+import errno
+import ctypes
+import select
+import struct
+import logging
+from time import time, sleep
+
+from .isolation import libc
+
+
+logger = logging.getLogger("abl.robot.trigger")
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Watcher(object):
+    """
+    Baseclass for watching `paths`, files or directories - the
+    latter recursively.
+
+    Subclasses implement `changes`.
+    """
+
+    IDLE_TIMEOUT = 1.0
+    """
+    How long `wait` blocks at most without changes, before
+    checking whether it should stop.
+    """
+
+    def __init__(self, paths):
+        self.paths = [os.path.abspath(path) for path in paths]
+
+
+    def changes(self, timeout):
+        """
+        Waits up to `timeout` seconds for changes, and
+        returns the set of changed paths, or an empty set.
+        """
+        raise NotImplementedError
+
+
+    def wait(self, debounce, max_delay=None, stop=None):
+        """
+        Waits for changes, and collects them until there were none
+        for `debounce` seconds, or `max_delay` seconds passed since
+        the first one.
+
+        :param stop: a `threading.Event` ending the wait
+        :return: the set of changed paths, empty if stopped
+        """
+        changed = set()
+        first = None
+        while stop is None or not stop.isSet():
+            if not changed:
+                timeout = self.IDLE_TIMEOUT
+            else:
+                timeout = debounce
+                if max_delay is not None:
+                    timeout = min(timeout, max(first + max_delay - time(), 0))
+            new = self.changes(timeout)
+            if new:
+                changed.update(new)
+                if first is None:
+                    first = time()
+            if changed and (not new or max_delay is not None and time() - first >= max_delay):
+                return changed
+        return set()
+
+
+    def close(self):
+        pass
+
+
+
+class PollingWatcher(Watcher):
+    """
+    Compares the modification-time, size and inode of the
+    watched files every `interval` seconds. Directories are
+    only reported when they are created or removed.
+    """
+
+    def __init__(self, paths, interval=2.0):
+        super(PollingWatcher, self).__init__(paths)
+        self.interval = interval
+        self._snapshot = self.snapshot()
+        self._next = time() + interval
+
+
+    def snapshot(self):
+        result = {}
+        for path in self.paths:
+            self._stat(path, result)
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in dirnames + filenames:
+                    self._stat(os.path.join(dirpath, name), result)
+        return result
+
+
+    def _stat(self, path, result):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            # changes of the entries are reported for themselves
+            result[path] = (None, None, st.st_ino)
+        else:
+            result[path] = (st.st_mtime, st.st_size, st.st_ino)
+
+
+    def changes(self, timeout):
+        # without a poll, no changes can be told apart from
+        # no news, so the timeout is extended to the next one
+        delay = self._next - time()
+        if delay > 0:
+            sleep(delay)
+        self._next = time() + self.interval
+        before, after = self._snapshot, self.snapshot()
+        self._snapshot = after
+        return set(path for path in set(before) | set(after)
+                   if before.get(path) != after.get(path))
+
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watches through inotify(7). Directories are watched recursively,
+    including those created later. Files are watched via their
+    directory, so replacing them by renaming is noticed, too.
+
+    While a watched directory - or the directory of a watched file -
+    doesn't exist, its closest existing parent is watched, so it
+    is picked up again once it is (re-)created.
+    """
+
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+        self._libc = libc()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._watches = {}
+        self._files = set()
+        # the directories watched for the paths, and whether
+        # that is recursively
+        self._roots = {}
+        self._missing = set()
+        for path in self.paths:
+            # missing paths are taken for directories until they appear
+            if os.path.isdir(path) or not os.path.exists(path):
+                self._roots[path] = True
+            else:
+                self._files.add(path)
+                self._roots.setdefault(os.path.dirname(path), False)
+        for root in list(self._roots):
+            self._watch_root(root)
+
+
+    @classmethod
+    def available(cls):
+        try:
+            return hasattr(libc(), "inotify_init1")
+        except OSError:
+            return False
+
+
+    def _add(self, path):
+        """
+        Watches the directory `path`.
+
+        :return: False if it doesn't exist
+        """
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                # vanished in the meantime
+                return False
+            raise OSError(e, "%s: %s" % (os.strerror(e), path))
+        self._watches[wd] = path
+        return True
+
+
+    def _watch_root(self, root):
+        """
+        Watches `root`, or its closest existing parent
+        until it exists.
+
+        :return: True if `root` itself is watched
+        """
+        if root in self.paths and os.path.exists(root) and not os.path.isdir(root):
+            # a missing path turned out to be a file
+            del self._roots[root]
+            self._missing.discard(root)
+            self._files.add(root)
+            self._roots.setdefault(os.path.dirname(root), False)
+            self._watch_root(os.path.dirname(root))
+            return True
+        if self._add(root):
+            if self._roots[root]:
+                self._add_tree(root)
+            self._missing.discard(root)
+            return True
+        if root not in self._missing:
+            self._missing.add(root)
+            logger.warn("%s doesn't exist, waiting for it to appear", root)
+        parent = os.path.dirname(root)
+        while parent != os.path.dirname(parent) and not self._add(parent):
+            parent = os.path.dirname(parent)
+        return False
+
+
+    def _add_tree(self, path):
+        self._add(path)
+        for dirpath, dirnames, _ in os.walk(path):
+            for name in dirnames:
+                self._add(os.path.join(dirpath, name))
+
+
+    def _root_paths(self, root):
+        """
+        The watched paths depending on `root`.
+        """
+        if root in self.paths:
+            return set([root])
+        return set(path for path in self._files if os.path.dirname(path) == root)
+
+
+    def _watched(self, path):
+        """
+        Whether `path` is below a watched directory, or
+        a watched file.
+        """
+        if path in self._files:
+            return True
+        return any(path == watched or path.startswith(watched + os.sep)
+                   for watched in self.paths if watched not in self._files)
+
+
+    def changes(self, timeout):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+        data = ""
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+            data += chunk
+        return self._parse(data)
+
+
+    def _parse(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warn("The inotify-queue overflowed, assuming everything changed")
+                changed.update(self.paths)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                if directory in self._roots:
+                    # removed or moved away
+                    self._watch_root(directory)
+                    changed.update(self._root_paths(directory))
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            if self._watched(path):
+                changed.add(path)
+        for root in list(self._missing):
+            if self._watch_root(root):
+                logger.info("%s appeared, watching it again", root)
+                changed.update(self._root_paths(root))
+        return changed
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+def make_watcher(paths, backend="auto", poll_interval=2.0):
+    """
+    Creates the watcher for `backend`, which is one of "inotify",
+    "poll" or "auto" - inotify where available.
+    """
+    if backend == "auto":
+        backend = "inotify" if InotifyWatcher.available() else "poll"
+    if backend == "inotify":
+        return InotifyWatcher(paths)
+    return PollingWatcher(paths, interval=poll_interval)
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+A zygote-server, which imports `abl.robot` and the robot-modules
+once, and forks a child per robot-run. This saves the interpreter-
+startup and the imports of every run. Start it with::
+
+  python -m abl.robot.zygote serve --socket /var/run/robots.sock \\
+      --preload mycompany.robots
+
+and run robots through it with::
+
+  python -S /path/to/abl/robot/zygote.py run --socket /var/run/robots.sock \\
+      mycompany.robots:CleanupRobot -- -c cleanup.ini
+
+This module only needs the standard-library, so running it as a
+script keeps the client from importing `abl.robot` itself - with
+``python -m abl.robot.zygote run`` it works as well, but slower.
+
+The client passes its stdin, stdout and stderr, environment and
+working directory to the child, and exits with the exit-code of
+the robot. If the client dies, the child is terminated.
+
+The file-descriptors are passed via SCM_RIGHTS over a UNIX-socket,
+so this only works on POSIX-systems. The socket is only accessible
+by the user running the server.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import random
+import select
+import signal
+import socket
+import struct
+import logging
+import optparse
+import traceback
+from _multiprocessing import sendfd, recvfd
+
+
+logger = logging.getLogger("abl.robot.zygote")
+
+
+def load_robot(spec):
+    """
+    Imports the robot-class given as "module:Class".
+    """
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError("Please give the robot as module:Class, not %r" % spec)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], class_name)
+
+
+def _exit_code(status):
+    """
+    The exit-code of a child, following the shell
+    convention of 128 + signal for killed children.
+    """
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+
+class ZygoteServer(object):
+    """
+    Listens on the UNIX-socket `path`, and forks a child running
+    `Robot.main` for each request.
+
+    The server is single-threaded, so forking is safe. Children
+    are reaped when SIGCHLD arrives, and their exit-code is sent
+    to the client.
+    """
+
+    REQUEST_TIMEOUT = 5.0
+    """
+    How long a client may take to send its request, before
+    it is dropped so it doesn't block the server.
+    """
+
+    def __init__(self, path, preload=(), request_timeout=None):
+        self.path = path
+        self.preload = list(preload)
+        if request_timeout is not None:
+            self.REQUEST_TIMEOUT = request_timeout
+        self._children = {}
+        self._listener = None
+        self._wakeup = None
+        self._running = False
+
+
+    def preload_modules(self):
+        for module in ["abl.robot"] + self.preload:
+            __import__(module)
+            logger.info("Preloaded %s", module)
+
+
+    def bind(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # whoever connects can run code as us, so only we may
+        umask = os.umask(0o177)
+        try:
+            self._listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+        self._listener.listen(64)
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self._wakeup[1])
+
+
+    def serve_forever(self):
+        """
+        Preloads the modules and serves until `stop` is called,
+        or SIGTERM arrives.
+        """
+        self.preload_modules()
+        self.bind()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self._running = True
+        logger.info("Zygote listening on %s", self.path)
+        try:
+            while self._running:
+                conns = [conn for conn, _ in self._children.values() if conn is not None]
+                try:
+                    readable, _, _ = select.select(
+                        [self._listener, self._wakeup[0]] + conns, [], [])
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for sock in readable:
+                    if sock is self._listener:
+                        self._accept()
+                    elif sock is self._wakeup[0]:
+                        self._drain_wakeup()
+                    else:
+                        self._client_gone(sock)
+                self._reap()
+        finally:
+            self.close()
+
+
+    def stop(self):
+        self._running = False
+
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+        for pid, (conn, _) in self._children.items():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            if conn is not None:
+                conn.close()
+
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def _accept(self):
+        conn, _ = self._listener.accept()
+        fds = []
+        try:
+            # a timeout via settimeout would make the socket non-
+            # blocking, which recvfd doesn't cope with
+            seconds = int(self.REQUEST_TIMEOUT)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack(
+                "ll", seconds, int((self.REQUEST_TIMEOUT - seconds) * 1000000)))
+            for _ in xrange(3):
+                fds.append(recvfd(conn.fileno()))
+            data = ""
+            while not data.endswith("\n"):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    raise EOFError("The client hung up before sending a request")
+                data += chunk
+            request = json.loads(data)
+        except Exception as e:
+            if isinstance(e, EnvironmentError) and e.args[0] == errno.EAGAIN:
+                logger.warn("The client didn't send its request within %.1fs",
+                            self.REQUEST_TIMEOUT)
+            else:
+                logger.exception("Invalid request")
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+        try:
+            pid = os.fork()
+        except OSError:
+            logger.exception("Couldn't fork for %s", request["robot"])
+            pid = None
+        if pid == 0:
+            self._child(conn, fds, request)
+        for fd in fds:
+            os.close(fd)
+        if pid is None:
+            conn.close()
+            return
+        self._children[pid] = (conn, request["robot"])
+        logger.debug("Forked %i for %s", pid, request["robot"])
+
+
+    def _child(self, conn, fds, request):
+        """
+        Runs the robot in the forked child. Never returns.
+        """
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._listener.close()
+            for other, _ in self._children.values():
+                if other is not None:
+                    other.close()
+            for fd in self._wakeup:
+                os.close(fd)
+            conn.close()
+            random.seed()
+            root_logger = logging.getLogger()
+            root_logger.handlers[:] = []
+            root_logger.setLevel(logging.WARNING)
+            # move the descriptors out of the way first, in case
+            # the server runs with closed stdio
+            moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3) for fd in fds]
+            for fd in fds:
+                os.close(fd)
+            for target, fd in enumerate(moved):
+                os.dup2(fd, target)
+                os.close(fd)
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.argv = [request["robot"]] + request["argv"]
+            code = 0
+            try:
+                load_robot(request["robot"]).main()
+            except SystemExit as e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    sys.stderr.write("%s\n" % e.code)
+                    code = 1
+        except:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+
+    def _client_gone(self, conn):
+        """
+        The client closed its connection, so its
+        child isn't wanted anymore.
+        """
+        try:
+            if conn.recv(1):
+                return
+        except socket.error:
+            pass
+        for pid, (other, robot) in self._children.items():
+            if other is conn:
+                logger.warn("The client of %s (%i) went away, terminating it", robot, pid)
+                self._children[pid] = (None, robot)
+                conn.close()
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid not in self._children:
+                continue
+            conn, robot = self._children.pop(pid)
+            code = _exit_code(status)
+            logger.debug("%s (%i) exited with %i", robot, pid, code)
+            if conn is None:
+                continue
+            try:
+                conn.sendall("%i\n" % code)
+            except socket.error:
+                pass
+            conn.close()
+
+
+
+def spawn(path, robot, argv=(), env=None, cwd=None, stdio=None):
+    """
+    Lets the zygote at `path` run `robot`, and waits for it.
+
+    :param robot: the robot-class as "module:Class"
+    :param argv: the commandline-arguments of the robot
+    :param env: the environment, defaults to `os.environ`
+    :param cwd: the working directory, defaults to the current one
+    :param stdio: the files or file-descriptors for stdin, stdout
+                  and stderr, defaults to those of this process
+    :return: the exit-code of the robot
+    """
+    if stdio is None:
+        stdio = (0, 1, 2)
+    request = dict(
+        robot=robot,
+        argv=list(argv),
+        env=dict(os.environ if env is None else env),
+        cwd=cwd or os.getcwd(),
+        )
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        for f in stdio:
+            sendfd(sock.fileno(), f if isinstance(f, int) else f.fileno())
+        sock.sendall(json.dumps(request) + "\n")
+        data = ""
+        while not data.endswith("\n"):
+            try:
+                chunk = sock.recv(64)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                raise EOFError("The zygote hung up without an exit-code")
+            data += chunk
+        return int(data)
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog serve [options]\n       %prog run [options] module:Class [-- robot-arguments]")
+    parser.add_option("--socket", default=None,
+                      help="The UNIX-socket of the zygote.")
+    parser.add_option("--preload", default=[], action="append",
+                      help="A module to import before forking, can be repeated.")
+    parser.add_option("--loglevel", default="INFO",
+                      help="The log-level of the server.")
+    parser.add_option("--request-timeout", default=None, type="float",
+                      help="How long a client may take to send its request, "
+                      "defaults to %.1fs." % ZygoteServer.REQUEST_TIMEOUT)
+    opts, args = parser.parse_args(argv)
+    if opts.socket is None:
+        parser.error("Please give the --socket")
+    if args[:1] == ["serve"] and len(args) == 1:
+        logging.basicConfig(level=getattr(logging, opts.loglevel.upper()),
+                            format="%(asctime)s %(name)s %(levelname)s %(message)s")
+        ZygoteServer(opts.socket, preload=opts.preload,
+                     request_timeout=opts.request_timeout).serve_forever()
+    elif args[:1] == ["run"] and len(args) >= 2:
+        sys.exit(spawn(opts.socket, args[1], args[2:]))
+    else:
+        parser.error("Please give either serve or run with a robot")
+
+
+if __name__ == "__main__":
+    main()
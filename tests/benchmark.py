@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+"""
+Micro-benchmarks for the robot lifecycle and the mail/template paths.
+
+Run them from the project root with::
+
+  python -m tests.benchmark [--output results.json] [--baseline baseline.json]
+
+The results are written as JSON, mapping each benchmark to the best and
+median time of one operation in seconds. When a baseline is given, each
+median is compared against it, and the process exits with 1 if any
+benchmark got slower than the allowed tolerance.
+
+Use ``--save-baseline`` on a reference machine to create the baseline.
+"""
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import optparse
+from time import time
+from textwrap import dedent
+
+from configobj import ConfigObj
+from genshi.template.loader import directory
+
+from turbomail.control import interface
+
+from abl.robot import Robot
+from abl.robot.base import ErrorHandler
+from abl.robot.mail import TemplateMessage
+
+
+BENCHMARKS = []
+
+
+def benchmark(number):
+    """
+    Registers a benchmark. The decorated function does the setup
+    and returns the operation to be timed `number` times per round.
+    """
+    def decorator(func):
+        BENCHMARKS.append((func.__name__, number, func))
+        return func
+    return decorator
+
+
+
+class BenchBot(Robot):
+
+    AUTHOR = "robot@example.com"
+    EXCEPTION_MAILING = "robot@example.com"
+
+    CONFIGSPECS = dict(
+        benchbot=dedent("""
+        [benchbot]
+        items = integer(default=100)
+        name = string(default=bench)
+        """),
+        )
+
+
+
+class BenchTemplateMessage(TemplateMessage):
+
+    loader = None
+
+
+
+class Context(object):
+
+    def __init__(self):
+        self.tempdir = tempfile.mkdtemp()
+        config = ConfigObj()
+        config["mail"] = dict(transport="debug")
+        config["logging"] = dict(filename=os.path.join(self.tempdir, "bench.log"),
+                                 level="ERROR")
+        config["error_handler"] = {
+            "error.xml_dir" : self.tempdir,
+            "mail.on" : "true",
+            }
+        config["benchbot"] = dict(items="10")
+        config.filename = os.path.join(self.tempdir, "bench.ini")
+        config.write()
+        self.config_file = config.filename
+        self.argv = ["--config=%s" % self.config_file]
+
+        for name, content in [
+            ("subject.txt", "Report for ${name}"),
+            ("text.txt", "{% for item in items %}* ${item}\n{% end %}"),
+            ("page.html", '<html xmlns:py="http://genshi.edgewall.org/">'
+                          '<ul><li py:for="item in items">${item}</li></ul></html>'),
+            ]:
+            with open(os.path.join(self.tempdir, name), "w") as outf:
+                outf.write(content)
+        BenchTemplateMessage.loader = staticmethod(directory(self.tempdir))
+
+
+    def robot(self):
+        robot = BenchBot()
+        robot.setup(self.argv)
+        return robot
+
+
+    def cleanup(self):
+        shutil.rmtree(self.tempdir)
+
+
+
+def clear_sent_mails():
+    if interface.manager and interface.manager.transport:
+        interface.manager.transport._sent_mails = []
+
+
+@benchmark(number=50)
+def robot_setup(ctx):
+    return ctx.robot
+
+
+@benchmark(number=2000)
+def configspec(ctx):
+    robot = ctx.robot()
+    return robot._configspec
+
+
+@benchmark(number=2000)
+def merge_config_and_opts(ctx):
+    robot = ctx.robot()
+    return robot.merge_config_and_opts
+
+
+@benchmark(number=20)
+def call_small_output(ctx):
+    robot = ctx.robot()
+    cmd = [sys.executable, "-c", "print 'hello'"]
+    return lambda: robot.call(cmd)
+
+
+@benchmark(number=5)
+def call_large_output(ctx):
+    robot = ctx.robot()
+    cmd = [sys.executable, "-c", "for i in xrange(100000): print 'x' * 80"]
+    return lambda: robot.call(cmd)
+
+
+@benchmark(number=200)
+def sendmail_debug(ctx):
+    robot = ctx.robot()
+    attachment = "a,b,c\n" * 1000
+    def send():
+        robot.sendmail("subject", "nobody@example.com", text="body",
+                       attachments=[("data.csv", attachment)])
+        clear_sent_mails()
+    return send
+
+
+@benchmark(number=200)
+def template_message(ctx):
+    ctx.robot()
+    items = range(100)
+    def render():
+        message = BenchTemplateMessage(
+            author="robot@example.com",
+            to="nobody@example.com",
+            html="page.html",
+            text="text.txt",
+            subject="subject.txt",
+            )
+        message.render(items=items, name="bench")
+    return render
+
+
+@benchmark(number=50)
+def report_exception(ctx):
+    robot = ctx.robot()
+    handler = ErrorHandler(robot, robot.config["error_handler"])
+    payload = range(10000)
+    def report():
+        try:
+            raise ValueError(len(payload))
+        except ValueError:
+            handler.report_exception()
+        clear_sent_mails()
+    return report
+
+
+def measure(operation, number, rounds):
+    timings = []
+    for _ in xrange(rounds):
+        start = time()
+        for _ in xrange(number):
+            operation()
+        timings.append((time() - start) / number)
+    timings.sort()
+    return dict(
+        number=number,
+        rounds=rounds,
+        best=timings[0],
+        median=timings[len(timings) // 2],
+        )
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of (name, baseline, current) for all
+    benchmarks whose median regressed beyond `tolerance`.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]["median"]
+        if result["median"] > before * (1.0 + tolerance):
+            regressions.append((name, before, result["median"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--rounds", type="int", default=5,
+                      help="How often to repeat each benchmark.")
+    parser.add_option("--output", default=None,
+                      help="Write the results as JSON to this file instead of STDOUT.")
+    parser.add_option("--baseline", default=None,
+                      help="Compare the results with this JSON-file.")
+    parser.add_option("--save-baseline", default=False, action="store_true",
+                      help="Write the results to the baseline-file.")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="Allowed relative slowdown against the baseline.")
+    opts, names = parser.parse_args(argv)
+
+    results = {}
+    ctx = Context()
+    try:
+        for name, number, factory in BENCHMARKS:
+            if names and name not in names:
+                continue
+            results[name] = measure(factory(ctx), number, opts.rounds)
+            sys.stderr.write("%-25s %12.6fs\n" % (name, results[name]["median"]))
+    finally:
+        ctx.cleanup()
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output is not None:
+        with open(opts.output, "w") as outf:
+            outf.write(data)
+    else:
+        print data
+
+    if opts.baseline is not None:
+        if opts.save_baseline:
+            with open(opts.baseline, "w") as outf:
+                outf.write(data)
+        else:
+            with open(opts.baseline) as inf:
+                baseline = json.load(inf)
+            regressions = compare(results, baseline, opts.tolerance)
+            for name, before, after in regressions:
+                sys.stderr.write("REGRESSION %s: %.6fs -> %.6fs\n" % (name, before, after))
+            if regressions:
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
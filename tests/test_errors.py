@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+from cStringIO import StringIO
+
+from errorreporter.collector import collect_exception
+from errorreporter.reporter import XMLExceptionDumper
+
+from abl.robot.errors import CaptureLimits, DumpIndex, ShardedXMLDumper, main
+
+
+def recurse(depth, data):
+    if depth:
+        return recurse(depth - 1, data)
+    raise ValueError("bottom")
+
+
+def collect(depth=100, data=None, limits=None):
+    try:
+        recurse(depth, data)
+    except ValueError:
+        if limits is not None:
+            return limits.collect(sys.exc_info())
+        return collect_exception(*sys.exc_info())
+
+
+class CaptureLimitsTests(TestCase):
+
+    def test_limits(self):
+        data = range(1000000)
+        ident = collect(data=data).identification_code
+
+        exc_data = collect(data=data, limits=CaptureLimits(max_frames=10, max_repr=100))
+        self.assertEqual(len(exc_data.frames), 10)
+        self.assertEqual(exc_data.frames[-1].name, "recurse")
+        self.assertEqual(exc_data.identification_code, ident)
+        representation = repr(exc_data.frames[-1].locals["data"])
+        assert representation.startswith("[0, 1, 2")
+        assert len(representation) <= 100
+        [limits] = exc_data.extra_data[("important", "capture limits")]
+        assert limits["omitted_frames"] > 90
+        assert not limits["budget_exhausted"]
+
+        exc_data = CaptureLimits(max_locals=1, size_budget=100).apply(collect(data=data))
+        self.assertEqual(exc_data.frames[-1].locals.keys(), ["data"])
+        assert not exc_data.frames[0].locals
+        [limits] = exc_data.extra_data[("important", "capture limits")]
+        assert limits["budget_exhausted"]
+
+
+    def test_dump_bounded(self):
+        outputdir = tempfile.mkdtemp()
+        try:
+            exc_data = CaptureLimits(max_repr=50).apply(collect(depth=3, data="x" * 1000000))
+            name = XMLExceptionDumper(outputdir=outputdir).report(exc_data)
+            assert os.path.getsize(os.path.join(outputdir, name)) < 100000
+        finally:
+            shutil.rmtree(outputdir)
+
+
+
+class ShardedXMLDumperTests(TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+
+    def test_sharded_compressed_dump(self):
+        dumper = ShardedXMLDumper(outputdir=self.outputdir, shards=16, compress=True)
+        exc_data = collect(depth=3)
+        name = dumper.report(exc_data)
+        date, shard, filename = name.split(os.sep)
+        assert 0 <= int(shard, 16) < 16
+        assert filename.endswith("_%s.xml.gz" % exc_data.identification_code)
+        with gzip.open(os.path.join(self.outputdir, name)) as inf:
+            assert inf.read().startswith("<?xml")
+        self.assertEqual(dumper.viewer_path(exc_data), name[:-len(".xml.gz")])
+
+
+    def test_prune(self):
+        dumper = ShardedXMLDumper(outputdir=self.outputdir, shards=4)
+        names = []
+        for i in xrange(6):
+            exc_data = collect(depth=i)
+            exc_data.date = time.localtime(time.time() - (10 - i) * 86400)
+            names.append(dumper.report(exc_data))
+            path = os.path.join(self.outputdir, names[-1])
+            os.utime(path, (time.mktime(exc_data.date),) * 2)
+
+        dumper.max_age = 8.5
+        self.assertEqual(dumper.prune(), 2)
+        dumper.max_size = os.path.getsize(os.path.join(self.outputdir, names[-1])) * 2 + 1
+        self.assertEqual(dumper.prune(), 2)
+        remaining = [name for name in names
+                     if os.path.exists(os.path.join(self.outputdir, name))]
+        self.assertEqual(remaining, names[-2:])
+        # the directories of removed dumps are gone
+        self.assertEqual(len([d for d in os.listdir(self.outputdir) if not d.startswith(".")]), 2)
+
+
+    def test_prune_in_background(self):
+        dumper = ShardedXMLDumper(outputdir=self.outputdir)
+        exc_data = collect()
+        exc_data.date = time.localtime(time.time() - 2 * 86400)
+        name = dumper.report(exc_data)
+        os.utime(os.path.join(self.outputdir, name), (time.mktime(exc_data.date),) * 2)
+        dumper.max_age = 1
+        assert dumper.prune_in_background()
+        assert dumper.wait_for_pruning(10)
+        assert not os.path.exists(os.path.join(self.outputdir, name))
+        # stamped when done, and only once per prune_interval
+        assert os.path.exists(os.path.join(self.outputdir, dumper.PRUNE_STAMP))
+        self.assertEqual(dumper.prune_in_background(), None)
+
+
+    def test_report_survives_pruned_directory(self):
+        dumper = ShardedXMLDumper(outputdir=self.outputdir)
+        rename = os.rename
+        raced = []
+
+        def racing_rename(src, dst):
+            # a pruning removes the still empty directory
+            if not raced:
+                raced.append(dst)
+                os.rmdir(os.path.dirname(dst))
+            return rename(src, dst)
+
+        os.rename = racing_rename
+        try:
+            name = dumper.report(collect())
+        finally:
+            os.rename = rename
+        assert raced
+        assert os.path.exists(os.path.join(self.outputdir, name))
+
+
+
+class DumpIndexTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "index.sqlite")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_index(self):
+        index = DumpIndex(self.filename, flush_every=3, flush_interval=3600)
+        deep, shallow = collect(depth=3), collect(depth=1)
+        index.add(deep, robot="ABot", path="a/1.xml")
+        index.add(shallow, robot="BBot", path="b/1.xml")
+        # batched, so not written yet
+        self.assertEqual(DumpIndex(self.filename).recent(), [])
+        index.add(deep, robot="BBot", path="a/2.xml")
+        self.assertEqual(len(DumpIndex(self.filename).recent()), 3)
+
+        [first, second] = index.counts()
+        self.assertEqual((first["id_code"], first["count"], first["exception_type"]),
+                         (deep.identification_code, 2, "ValueError"))
+        self.assertEqual(second["id_code"], shallow.identification_code)
+        assert "in recurse" in first["last_line"]
+        self.assertEqual(index.counts(since=time.time() + 60), [])
+
+        self.assertEqual([row["path"] for row in index.recent(id_code=deep.identification_code)],
+                         ["a/2.xml", "a/1.xml"])
+        self.assertEqual([row["path"] for row in index.recent(robot="BBot")],
+                         ["a/2.xml", "b/1.xml"])
+        index.close()
+
+
+    def test_cli(self):
+        index = DumpIndex(self.filename)
+        exc_data = collect()
+        index.add(exc_data, robot="ABot", path="a/1.xml")
+        index.close()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main([self.filename, "counts", "--since", "1"])
+            main([self.filename, "recent", "--json"])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert "     1  %s  ValueError" % exc_data.identification_code in output
+        assert '"path": "a/1.xml"' in output
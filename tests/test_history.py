@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import tempfile
+import shutil
+from time import time
+from unittest import TestCase
+
+from abl.robot.history import RunHistory, format_report
+
+
+class RunHistoryTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "history.sqlite")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def record(self, history, start, duration, outcome="ok", robot="ABot"):
+        history.record(robot=robot, shard=0, start=start, duration=duration, outcome=outcome,
+                       lock_wait=0.0, peak_rss=10240, calls=2, call_time=duration / 2)
+
+
+    def test_batched_writes_and_retention(self):
+        history = RunHistory(self.filename, max_runs=3)
+        now = time()
+        for i in xrange(5):
+            self.record(history, now + i, i)
+        self.record(history, now, 1, robot="BBot")
+        self.assertEqual(RunHistory(self.filename).runs("ABot"), [])
+        history.flush()
+        self.assertEqual([run["duration"] for run in history.runs("ABot")], [2, 3, 4])
+        self.assertEqual(len(history.runs("BBot")), 1)
+
+        history = RunHistory(self.filename, max_runs=3, flush_every=2)
+        self.record(history, now + 5, 5)
+        self.assertEqual(len(RunHistory(self.filename).runs("ABot")), 3)
+        self.record(history, now + 6, 6)
+        self.assertEqual([run["duration"] for run in RunHistory(self.filename).runs("ABot")],
+                         [4, 5, 6])
+
+
+    def test_report(self):
+        history = RunHistory(self.filename)
+        now = time()
+        for week in xrange(3):
+            for i in xrange(10):
+                # a robot getting slower every week
+                self.record(history, now - (2 - week) * 7 * 86400 - i * 3600, (week + 1) * 10.0,
+                            outcome="ok" if i else "error")
+        history.flush()
+        report = history.report("ABot", weeks=4, now=now + 1)
+        self.assertEqual(report["runs"], 30)
+        self.assertEqual(report["outcomes"], dict(ok=27, error=3))
+        self.assertEqual(report["duration"]["p50"], 20.0)
+        self.assertEqual([week["p50"] for week in report["trend"]], [None, 10.0, 20.0, 30.0])
+        text = format_report(report)
+        assert "runs:       30 (error=3, ok=27)" in text
+        assert "(+100%)" in text and "(+50%)" in text
+
+
+    def test_report_without_peak_rss(self):
+        history = RunHistory(self.filename)
+        history.record(robot="ABot", shard=0, start=time(), duration=1.0, outcome="ok",
+                       lock_wait=0.0, peak_rss=None, calls=0, call_time=0.0)
+        report = history.report("ABot")
+        self.assertEqual(report["peak_rss"]["count"], 0)
+        assert "peak rss:   n/a" in format_report(report)
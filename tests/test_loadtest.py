@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import tempfile
+import shutil
+from time import sleep
+from unittest import TestCase
+
+from abl.robot import Robot
+from abl.robot.loadtest import run_load, arrival_times, format_report
+
+
+class LoadBot(Robot):
+
+    AUTHOR = "robot@example.com"
+
+    def work(self):
+        sleep(0.1)
+        self.sendmail("done", "nobody@example.com", text="done")
+
+
+
+class FailingBot(Robot):
+
+    AUTHOR = "robot@example.com"
+
+    def work(self):
+        raise ValueError("failing under load")
+
+
+
+class LoadTestTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.config = dict(
+            locking=dict(
+                filename=os.path.join(self.tempdir, "loadbot.lock"),
+                terminate_when_locked="false",
+                ),
+            )
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_queueing_robots(self):
+        report = run_load(LoadBot, 4, config=self.config, timeout=30)
+        self.assertEqual(report["outcomes"], dict(ok=4, locked=0, error=0, lost=0))
+        self.assertEqual(report["mail"]["messages"], 4)
+        assert report["lock_wait"]["max"] >= 0.2
+        assert report["lock_contention"] > 0
+        assert format_report(report)
+
+
+    def test_terminating_robots(self):
+        self.config["locking"]["terminate_when_locked"] = "true"
+        report = run_load(LoadBot, 4, config=self.config, timeout=30)
+        self.assertEqual(report["outcomes"]["ok"] + report["outcomes"]["locked"], 4)
+        assert report["outcomes"]["locked"]
+        self.assertEqual(report["mail"]["messages"], report["outcomes"]["ok"])
+
+
+    def test_failing_robots(self):
+        report = run_load(FailingBot, 2, config=self.config, timeout=30)
+        self.assertEqual(report["outcomes"], dict(ok=0, locked=0, error=2, lost=0))
+
+
+    def test_arrival_times(self):
+        self.assertEqual(arrival_times(3, 0), [0.0] * 3)
+        self.assertEqual(arrival_times(3, 2, "uniform"), [0.0, 0.5, 1.0])
+        offsets = arrival_times(10, 5, "poisson")
+        self.assertEqual(offsets, sorted(offsets))
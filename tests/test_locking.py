@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sqlite3
+import tempfile
+import shutil
+from time import time, sleep
+from unittest import TestCase
+
+from abl.util import LockFileObtainException, LockFileCreationException
+
+from abl.robot import Robot, LockLost
+from abl.robot.locking import (
+    SQLiteLock,
+    ServerLock,
+    LockServer,
+    )
+from abl.robot.test import RobotTestCase
+
+
+class LeasedLockTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.server = LockServer(("localhost", 0))
+        self.server.start()
+
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+
+
+    def check_exclusive(self, lock_class, config):
+        first = lock_class("robot", fail_on_lock=True, config=config)
+        second = lock_class("robot", fail_on_lock=True, config=config)
+        other = lock_class("other", fail_on_lock=True, config=config)
+        with first:
+            self.failUnlessRaises(LockFileObtainException, second.__enter__)
+            with other:
+                pass
+        with second:
+            pass
+
+
+    def test_sqlite_lock(self):
+        config = dict(database=os.path.join(self.tempdir, "locks.db"))
+        self.check_exclusive(SQLiteLock, config)
+
+
+    def test_server_lock(self):
+        config = dict(server=self.server.address)
+        self.check_exclusive(ServerLock, config)
+
+
+    def test_expired_lease_is_taken_over(self):
+        config = dict(server=self.server.address, lease=60, heartbeat=30)
+        first = ServerLock("robot", config=config)
+        assert first.acquire()
+        self.server.leases["robot"] = first.owner, 0
+        second = ServerLock("robot", fail_on_lock=True, config=config)
+        with second:
+            assert not first.renew()
+
+
+    def test_lease_runs_out_while_renewing_fails(self):
+
+        class FlakyLock(SQLiteLock):
+
+            def renew(self):
+                raise sqlite3.OperationalError("database is locked")
+
+        lost = []
+        config = dict(database=os.path.join(self.tempdir, "locks.db"),
+                      lease=0.3, heartbeat=0.1)
+        lock = FlakyLock("robot", config=config)
+        lock.on_lost = lambda: lost.append(time())
+        with lock:
+            start = time()
+            while not lost:
+                assert time() - start < 5
+                sleep(0.05)
+            assert lost[0] - start >= 0.25
+            self.assertRaises(LockLost, lock.check)
+
+
+    def test_heartbeat_shorter_than_lease(self):
+        config = dict(server=self.server.address, lease=10, heartbeat=10)
+        self.failUnlessRaises(LockFileCreationException, ServerLock, "robot", config=config)
+
+
+
+class LockingConfigTests(RobotTestCase):
+
+    def test_backend_from_config(self):
+        server = LockServer(("localhost", 0))
+        server.start()
+        try:
+            config = dict(
+                locking=dict(
+                    filename="lockbot",
+                    backend="server",
+                    server=server.address,
+                    ),
+                )
+            robot = self.start_robot(config=config, robot_class=Robot, norun=True)
+            # start_robot patches the locking away
+            with Robot._locking_context(robot):
+                assert "lockbot" in server.leases
+            assert not server.leases
+        finally:
+            server.stop()
+
+
+    def test_lost_lease_aborts_work(self):
+        tempdir = tempfile.mkdtemp()
+        database = os.path.join(tempdir, "locks.db")
+
+        class LostBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            mode = "async"
+
+            def work(self):
+                if self.mode == "check":
+                    self._held_lock.lost = True
+                    self.check_deadline()
+                    return
+                conn = sqlite3.connect(database, isolation_level=None)
+                conn.execute("UPDATE locks SET owner='thief'")
+                conn.close()
+                start = time()
+                while time() - start < 10:
+                    sleep(0.05)
+
+        config = dict(
+            mail=dict(transport="debug"),
+            error_handler={"mail.on": "true"},
+            locking=dict(filename="lostbot", backend="sqlite", database=database,
+                         lease="5", heartbeat="1"),
+            )
+        try:
+            # the thief holds the lease of the first run,
+            # so the second one works on another lock
+            for mode, filename in ("async", "lostbot"), ("check", "checkbot"):
+                LostBot.mode = mode
+                config["locking"]["filename"] = filename
+                robot = self.start_robot(config=config, robot_class=LostBot,
+                                         raise_exceptions=False, norun=True)
+                # use the real locking
+                del robot._locking_context
+                start = time()
+                robot.run()
+                assert time() - start < 5
+                self.assertEqual(robot.last_run["outcome"], "lock_lost")
+                [message] = self.get_messages()
+                assert "LockLost" in message
+                self.clear_messages()
+        finally:
+            shutil.rmtree(tempdir)
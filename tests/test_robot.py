@@ -7,13 +7,25 @@ from __future__ import with_statement
 __docformat__ = "restructuredtext en"
 
 import os
+import json
+import re
+import sys
+import resource
 import tempfile
+import threading
+from time import time, sleep
+from cStringIO import StringIO
 from textwrap import dedent
 
 import shutil
 
-from abl.robot import Robot
-from abl.robot.test import RobotTestCase
+from abl.robot import Robot, RobotCallError, DeadlineExceeded, LockLost
+from abl.robot.errors import DumpIndex
+from abl.robot.history import reset_peak_rss
+from abl.robot.memory import current_rss, raise_in_thread, MemoryLimitExceeded
+from abl.robot.mail import MailSink
+from abl.robot.state import StateStore
+from abl.robot.test import RobotTestCase, RobotTimeout
 
 
 class BasicRobotTests(RobotTestCase):
@@ -75,6 +87,45 @@ class BasicRobotTests(RobotTestCase):
             shutil.rmtree(error_log)
 
 
+    def test_sharded_compressed_error_dumps(self):
+
+        class FailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            def work(self):
+                raise Exception("Oh lord forgive me, I'm such an epic fail!")
+
+
+        url = "http://view/that/error"
+
+        error_log = tempfile.mkdtemp()
+        try:
+            config = dict(
+                error_handler={
+                    "error.viewer_url" : url,
+                    "error.xml_dir" : error_log,
+                    "error.xml_shards" : "8",
+                    "error.xml_compress" : "true",
+                    "mail.on" : "true",
+                    }
+                )
+            self.start_robot(
+                config=config,
+                robot_class=FailBot,
+                raise_exceptions=False
+                )
+
+            [message] = self.get_messages()
+            path = re.search(re.escape(url) + r"/stack/(\S+)", message).group(1)
+            assert os.path.exists(os.path.join(error_log, path + ".xml.gz"))
+            [occurrence] = DumpIndex(os.path.join(error_log, "index.sqlite")).recent()
+            self.assertEqual((occurrence["robot"], occurrence["path"]), ("FailBot", path + ".xml.gz"))
+        finally:
+            shutil.rmtree(error_log)
+
+
 
     def test_exception_raising(self):
 
@@ -147,3 +198,498 @@ class BasicRobotTests(RobotTestCase):
         self.assertEqual(config["a"], "foo")
         self.assertEqual(config["b"], 100)
         self.assertEqual(config["c"], 100)
+
+
+    def test_sharding(self):
+
+        slices = []
+
+        class ShardBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            def work(self):
+                slices.append(list(self.shard(range(100))))
+
+        for index in range(3):
+            self.start_robot(
+                robot_class=ShardBot,
+                opts={"shard-index" : str(index), "shard-count" : "3"},
+                )
+        self.assertEqual(sorted(sum(slices, [])), range(100))
+        assert all(slices)
+
+        config = dict(
+            locking=dict(filename="/tmp/shardbot.lock"),
+            sharding=dict(index="1", count="2"),
+            )
+        robot = self.start_robot(config=config, robot_class=ShardBot, norun=True)
+        self.assertEqual(robot.shard_index, 1)
+        lock = Robot._locking_context(robot)
+        self.assertEqual(lock.name, "/tmp/shardbot.lock.shard-1-of-2")
+
+
+    def test_checkpoint_resume(self):
+
+        processed = []
+
+        class ResumeBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            fail_at = None
+
+            def work(self):
+                for item in range(self.checkpoint.get("next", 0), 10):
+                    if item == self.fail_at:
+                        raise Exception("transient failure")
+                    processed.append(item)
+                    self.checkpoint["next"] = item + 1
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "checkpoint.json")
+            config = dict(checkpoint=dict(filename=filename, flush_every="1000"))
+            ResumeBot.fail_at = 5
+            self.start_robot(config=config, robot_class=ResumeBot, raise_exceptions=False)
+            assert os.path.exists(filename)
+            ResumeBot.fail_at = None
+            self.start_robot(config=config, robot_class=ResumeBot)
+            self.assertEqual(processed, range(10))
+            assert not os.path.exists(filename)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_run_history(self):
+
+        class HistoryBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            allocate = 0
+
+            def work(self):
+                ballast = "x" * self.allocate
+                self.call(["true"])
+                self.call(["true"])
+                del ballast
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            config = dict(history=dict(filename=os.path.join(tempdir, "history.sqlite")))
+            HistoryBot.allocate = 100 * 1024 * 1024
+            robot = self.start_robot(config=config, robot_class=HistoryBot)
+            HistoryBot.allocate = 0
+            self.start_robot(config=config, robot_class=HistoryBot)
+            runs = robot.history.runs("HistoryBot")
+            self.assertEqual([(run["outcome"], run["calls"]) for run in runs], [("ok", 2)] * 2)
+            assert runs[0]["duration"] >= runs[0]["call_time"] > 0
+            assert runs[0]["peak_rss"] > 0
+            if reset_peak_rss():
+                # the peak of the first run isn't taken for that of the second
+                assert runs[1]["peak_rss"] < runs[0]["peak_rss"] - 50 * 1024
+
+            robot = self.start_robot(config=config, robot_class=HistoryBot,
+                                     argv=["--stats"], norun=True)
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                self.assertRaises(SystemExit, robot.run)
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            assert "runs:       2 (ok=2)" in output
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_deadline(self):
+
+        class SlowBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            mode = "loop"
+            terminated = False
+            saved = None
+
+            def work(self):
+                if self.mode == "loop":
+                    while True:
+                        self.check_deadline()
+                        sleep(0.01)
+                elif self.mode == "call":
+                    self.call(["sleep", "10"])
+                else:
+                    self.checkpoint["progress"] = 1
+                    self.state.set("progress", 1)
+                    sleep(1.0)
+
+            def terminate(self):
+                self.terminated = True
+                with open(self.checkpoint.filename) as inf:
+                    checkpoint = json.load(inf)
+                state = StateStore(self.state.filename)
+                try:
+                    self.saved = (checkpoint, state.get("progress"))
+                finally:
+                    state.close()
+
+        config = dict(
+            mail=dict(transport="debug"),
+            error_handler={"mail.on": "true"},
+            deadline=dict(grace="0.2"),
+            )
+        start = time()
+        robot = self.start_robot(config=config, robot_class=SlowBot,
+                                 argv=["--max-runtime", "0.2"], raise_exceptions=False)
+        self.assertEqual(robot.last_run["outcome"], "timeout")
+        assert robot.remaining_time() == 0
+        [message] = self.get_messages()
+        assert "[Robot Timeout]" in message and "DeadlineExceeded" in message
+
+        SlowBot.mode = "call"
+        self.assertRaises(DeadlineExceeded, self.start_robot, config=config,
+                          robot_class=SlowBot, argv=["--max-runtime", "0.2"])
+        assert time() - start < 5
+
+        self.clear_messages()
+        SlowBot.mode = "ignore"
+        tempdir = tempfile.mkdtemp()
+        try:
+            config.update(
+                checkpoint=dict(filename=os.path.join(tempdir, "checkpoint.json"),
+                                flush_every="1000", flush_interval="1000",
+                                clear_on_success="false"),
+                state=dict(filename=os.path.join(tempdir, "state.db"),
+                           commit_every="1000", commit_interval="1000"),
+                )
+            robot = self.start_robot(config=config, robot_class=SlowBot,
+                                     argv=["--max-runtime", "0.2"], raise_exceptions=False)
+        finally:
+            shutil.rmtree(tempdir)
+        assert robot.terminated
+        self.assertEqual(robot.saved, ({"progress": 1}, 1))
+        [message] = self.get_messages()
+        assert "didn't stop within 0.2s" in message and "in work" in message
+
+
+    def test_splay(self):
+
+        class SplayBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            def work(self):
+                pass
+
+        config = dict(splay={"max": "0.5"})
+        robot = self.start_robot(config=config, robot_class=SplayBot)
+        offset = robot.splay_offset()
+        assert 0 <= offset < 0.5
+        self.assertEqual(offset, robot.splay_offset())
+        self.assertAlmostEqual(robot.last_run["splay"], offset, places=1)
+
+        robot = self.start_robot(config=config, robot_class=SplayBot,
+                                 argv=["--splay", "1000"], norun=True)
+        self.assertEqual(robot.splay, 1000)
+        self.assertNotEqual(robot.splay_offset(), offset)
+        robot = self.start_robot(config=config, robot_class=SplayBot,
+                                 argv=["--splay", "1000", "--max-runtime", "0.1"])
+        self.assertEqual(robot.last_run["splay"], 0.0)
+
+        class Lease(object):
+            lease, lost = 0.5, False
+
+            def check(self):
+                if self.lost:
+                    raise LockLost()
+
+        robot = self.start_robot(config=config, robot_class=SplayBot,
+                                 argv=["--splay", "1000"], norun=True)
+        lease = Lease()
+        self.assertEqual(robot._splay(lease, 0.0), 0.0)
+        lease.lease, lease.lost = 10000, True
+        self.assertRaises(LockLost, robot._splay, lease, 0.0)
+
+
+    def test_memory_limits(self):
+
+        class HungryBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            def work(self):
+                self.pressure = []
+                data = []
+                for _ in xrange(200):
+                    data.append("x" * (5 << 20))
+                    sleep(0.01)
+
+            def memory_pressure(self, rss):
+                self.pressure.append(rss)
+
+        rss = current_rss() // 1024
+        config = dict(
+            mail=dict(transport="debug"),
+            error_handler={"mail.on": "true"},
+            memory=dict(soft_limit=str(rss + 20), hard_limit=str(rss + 60), interval="0.01"),
+            )
+        robot = self.start_robot(config=config, robot_class=HungryBot, raise_exceptions=False)
+        self.assertEqual(robot.last_run["outcome"], "memory")
+        self.assertEqual(len(robot.pressure), 1)
+        assert robot.last_run["peak_memory"] >= (rss + 60) * 1024
+        [message] = self.get_messages()
+        assert "MemoryLimitExceeded" in message
+
+
+        class BlockedBot(Robot):
+
+            AUTHOR = "robot@example.com"
+            EXCEPTION_MAILING = "robot@example.com"
+
+            terminated = False
+
+            def work(self):
+                data = "x" * (80 << 20)
+                # the exception can't arrive while sleeping in C
+                sleep(1.0)
+                return data
+
+            def terminate(self):
+                self.terminated = True
+
+        self.clear_messages()
+        config["memory"]["grace"] = "0.2"
+        robot = self.start_robot(config=config, robot_class=BlockedBot, raise_exceptions=False)
+        assert robot.terminated
+        self.assertEqual(robot.last_run["outcome"], "memory")
+        messages = self.get_messages()
+        assert any("didn't stop within 0.2s" in message and "in work" in message
+                   for message in messages)
+
+
+    def test_call_resource_limits(self):
+        config = dict(call=dict(nice="5", open_files="64"))
+        robot = self.start_robot(config=config, robot_class=Robot, norun=True)
+        script = dedent("""
+        import os, resource
+        print os.nice(0), resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        print [line for line in open("/proc/self/status") if line.startswith("Cpus_allowed_list")][0]
+        """)
+        result = robot.call([sys.executable, "-c", script],
+                            open_files=32, cpu_affinity=[0], ionice="idle")
+        nice, files = result.output[0].split()
+        self.assertEqual((int(nice), int(files)), (os.nice(0) + 5, 32))
+        self.assertEqual(result.output[1].split(), ["Cpus_allowed_list:", "0"])
+        assert result.rusage.ru_maxrss > 0
+
+        try:
+            robot.call([sys.executable, "-c", "while True: pass"], cpu_time=1)
+        except RobotCallError, e:
+            assert e.ec < 0
+            assert e.rusage.ru_utime + e.rusage.ru_stime >= 0.9
+        else:
+            self.fail("cpu_time wasn't limited")
+
+        # limits above the hard limit are lowered to it
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY:
+            result = robot.call([sys.executable, "-c", script], open_files=hard + 1000)
+            self.assertEqual(int(result.output[0].split()[1]), hard)
+
+        self.assertRaises(ValueError, robot.call, ["true"], ionice="bogus")
+        self.assertRaises(ValueError, self.start_robot, config=dict(call=dict(ionice="idle:9")),
+                          robot_class=Robot, norun=True)
+
+
+    def test_failing_cleanup(self):
+
+        class CleanupBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                raise ValueError("the real error")
+
+            def close_mail_queue(self):
+                raise IOError("mail relay down")
+
+        def break_flush(robot):
+            def flush():
+                raise IOError("dump directory not writable")
+            robot.error_handler.flush = flush
+
+        try:
+            self.start_robot(robot_class=CleanupBot, commands=[break_flush])
+        except ValueError as e:
+            self.assertEqual(str(e), "the real error")
+        else:
+            self.fail("The error of work got lost")
+        self.assertEqual(self.robot.last_run["outcome"], "error")
+        assert "duration" in self.robot.last_run
+
+
+    def test_aborted_call_kills_subprocess(self):
+        robot = self.start_robot(robot_class=Robot, norun=True)
+        script = dedent("""
+        import os, sys, time
+        while True:
+            print os.getpid()
+            sys.stdout.flush()
+            time.sleep(0.05)
+        """)
+        pids = []
+
+        class Output(object):
+
+            def write(self, line):
+                pids.append(int(line))
+
+        errors = []
+
+        def run():
+            try:
+                robot.call([sys.executable, "-c", script],
+                           print_output=True, output_stream=Output())
+            except MemoryLimitExceeded as e:
+                errors.append(e)
+
+        worker = threading.Thread(target=run)
+        worker.start()
+        start = time()
+        while not pids:
+            assert time() - start < 10
+            sleep(0.01)
+        raise_in_thread(worker, MemoryLimitExceeded)
+        worker.join(10)
+        assert errors
+        self.assertRaises(OSError, os.kill, pids[0], 0)
+
+
+    def test_threaded_calls(self):
+        robot = self.start_robot(robot_class=Robot, norun=True)
+        out = StringIO()
+        results = []
+
+        def run():
+            results.append(robot.call(
+                [sys.executable, "-c", "for i in range(50): print 'line', i"],
+                print_output=True,
+                tag_output=True,
+                output_stream=out,
+                ))
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        call_ids = set(r.call_id for r in results)
+        self.assertEqual(len(call_ids), 4)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 200)
+        for call_id in call_ids:
+            tagged = [l for l in lines if l.startswith("[%s] line " % call_id)]
+            self.assertEqual(len(tagged), 50)
+
+        try:
+            robot.call([sys.executable, "-c", "import sys; sys.exit(3)"])
+        except RobotCallError as e:
+            self.assertEqual(e.ec, 3)
+            assert e.call_id in str(e)
+        else:
+            self.fail("No RobotCallError raised")
+
+
+    def test_in_memory_config_and_mail_sink(self):
+
+        class MailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                self.sendmail(u"Grüße", "nobody@example.com", text=u"Hällo")
+
+        own_sink = MailSink()
+        robot = MailBot()
+        robot.mail_sink = own_sink
+        robot.setup([], config=dict(sharding=dict(count="4")))
+        self.assertEqual(robot.config["sharding"]["count"], 4)
+        robot.run()
+
+        self.clear_messages()
+        self.start_robot(robot_class=MailBot)
+        for messages in own_sink.get_sent_mails(), self.get_messages():
+            self.assertEqual(len(messages), 1)
+            assert u"Subject: Grüße" in messages[0]
+            assert u"Hällo" in messages[0]
+
+
+    def test_threaded_robots(self):
+
+        release = threading.Event()
+
+        class WaitBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                release.wait()
+                self.sendmail("done", "nobody@example.com")
+                if self.shard_index:
+                    raise ValueError(self.shard_index)
+                return 42
+
+        handles = [self.start_robot(robot_class=WaitBot, threaded=True, handle=True,
+                                    opts={"shard-index" : str(i), "shard-count" : "2"})
+                   for i in range(2)]
+        good, bad = handles
+        self.assertEqual(good.shard_index, 0)
+        assert not good.wait(0.01)
+        self.failUnlessRaises(RobotTimeout, good.result, 0.01)
+
+        release.set()
+        self.assertEqual(good.result(timeout=5), 42)
+        assert isinstance(bad.exception(timeout=5), ValueError)
+        self.failUnlessRaises(ValueError, bad.result)
+        for handle in handles:
+            self.assertEqual(len(handle.messages()), 1)
+        self.assertEqual(len(self.get_messages()), 2)
+        self.clear_messages()
+        self.assertEqual(self.get_messages(), [])
+
+        release.clear()
+        robot = self.start_robot(robot_class=WaitBot, threaded=True)
+        assert isinstance(robot, WaitBot)
+        # a robot outliving its test doesn't mail into the next one
+        own_sink, self.mail_sink = self.mail_sink, MailSink()
+        release.set()
+        start = time()
+        while not own_sink.get_sent_mails():
+            assert time() - start < 5
+            sleep(0.01)
+        self.assertEqual(self.get_messages(), [])
+
+
+    def test_config_file_in_argv(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "robot.ini")
+            with open(filename, "w") as outf:
+                outf.write("[sharding]\ncount = 3\n")
+            robot = self.start_robot(robot_class=Robot, argv=["-c", filename], norun=True)
+            self.assertEqual(robot.config["sharding"]["count"], 3)
+            robot = self.start_robot(robot_class=Robot, opts={"config": filename}, norun=True)
+            self.assertEqual(robot.config["sharding"]["count"], 3)
+            self.assertRaises(ValueError, self.start_robot, robot_class=Robot,
+                              argv=["--config", filename], config={}, norun=True)
+        finally:
+            shutil.rmtree(tempdir)
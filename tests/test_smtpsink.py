@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import email
+import zlib
+import shutil
+import zipfile
+import json
+import socket
+import smtplib
+import tempfile
+from cStringIO import StringIO
+from time import time
+from smtplib import SMTPDataError
+
+from abl.robot import Robot
+from abl.robot.mail import MailRelayUnavailable
+from abl.robot.outbox import Outbox
+from abl.robot.streaming import Attachment, rechunk, zip_chunks
+from abl.robot.test import RobotTestCase
+
+
+class SMTPSinkTests(RobotTestCase):
+
+    def test_robot_mails_over_smtp(self):
+
+        class MailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                for i in range(3):
+                    self.sendmail("mail %i" % i, "nobody@example.com", text="body")
+
+        sink = self.start_smtp_sink()
+        handle = self.start_robot(robot_class=MailBot, smtp_sink=sink, handle=True)
+        self.assertEqual(len(handle.messages()), 3)
+        stats = sink.stats()
+        self.assertEqual(stats["messages"], 3)
+        self.assertEqual(stats["connections"], 3)
+        mailfrom, rcpttos, data, _ = sink.messages[0]
+        self.assertEqual(rcpttos, ["<nobody@example.com>"])
+        assert "Subject: mail 0" in data
+
+
+    def test_injected_failures(self):
+        sink = self.start_smtp_sink()
+        sink.fail("CONNECT", code=421)
+        sink.fail("DATA", times=1)
+        self.failUnlessRaises(smtplib.SMTPConnectError, smtplib.SMTP, sink.address)
+        connection = smtplib.SMTP(sink.address)
+        try:
+            self.failUnlessRaises(smtplib.SMTPDataError, connection.sendmail,
+                                  "a@example.com", ["b@example.com"], "first")
+            connection.sendmail("a@example.com", ["b@example.com"], "second")
+        finally:
+            connection.quit()
+        self.assertEqual([m[2] for m in sink.messages], ["second\r\n"])
+        stats = sink.stats()
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["connections"], 2)
+
+
+    def test_retry_and_circuit_breaker(self):
+
+        sink = self.start_smtp_sink()
+        outcomes = []
+
+        class MailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                for i in range(3):
+                    try:
+                        self.sendmail("mail %i" % i, "nobody@example.com", text="body")
+                    except Exception as e:
+                        outcomes.append(e.__class__)
+                    else:
+                        outcomes.append(None)
+                    # from now on, the relay is down
+                    sink.fail("DATA", times=10)
+
+        # the first mail succeeds on the third attempt, the second
+        # fails three times, and the first failure of the third
+        # opens the breaker.
+        sink.fail("DATA", times=2)
+        config = dict(mail={
+            "retry.attempts" : "3",
+            "retry.backoff" : "0.01",
+            "breaker.threshold" : "4",
+            })
+        self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config)
+        self.assertEqual(outcomes, [None, SMTPDataError, MailRelayUnavailable])
+        self.assertEqual(len(sink.messages), 1)
+        self.assertEqual(sink.stats()["failures"], 2 + 3 + 1)
+
+
+    def test_outbox(self):
+
+        class MailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                for i in range(3):
+                    self.sendmail(u"mail %i" % i, "nobody@example.com", text=u"Grüße")
+                assert len(self.outbox.pending()) == 3
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            sink = self.start_smtp_sink()
+            config = dict(mail={
+                "outbox.dir" : tempdir,
+                "retry.attempts" : "1",
+                "breaker.threshold" : "1",
+                })
+            sink.fail("CONNECT", code=421)
+            robot = self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config)
+            # the relay was down, and the breaker prevents further tries
+            self.assertEqual(len(robot.outbox.pending()), 3)
+            self.assertEqual(sink.stats()["connections"], 1)
+
+            robot = self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config,
+                                     norun=True)
+            self.assertEqual(robot.flush_outbox(), 3)
+            self.assertEqual(robot.outbox.pending(), [])
+            subjects = [data for _, _, data, _ in sink.messages]
+            for i, data in enumerate(subjects):
+                assert "Subject: mail %i" % i in data
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_outbox_failures_and_claims(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            outbox = Outbox(tempdir, max_attempts=2, claim_timeout=3600)
+            for i in range(3):
+                with open(os.path.join(tempdir, "%i%s" % (i, Outbox.SUFFIX)), "w") as outf:
+                    json.dump(dict(sender="robot@example.com", recipients=["nobody@example.com"],
+                                   message="Subject: mail %i\n\nmail" % i), outf)
+            delivered = []
+
+            def deliver(message):
+                if "mail 0" in str(message):
+                    raise ValueError("permanently broken")
+                delivered.append(message)
+
+            # the failing mail at the front doesn't block the others
+            skip = set()
+            self.assertEqual(outbox.flush(deliver, batch=1, skip=skip), (0, 1))
+            self.assertEqual(outbox.flush(deliver, batch=1, skip=skip), (1, 0))
+            self.assertEqual(outbox.pending(), ["0.mail", "2.mail"])
+            self.assertEqual(outbox.flush(deliver), (1, 1))
+            self.assertEqual(outbox.pending(), [])
+            self.assertEqual(outbox.failed(), ["0.failed"])
+            self.assertEqual(len(delivered), 2)
+
+            # claims of dead processes, or old ones of other hosts, are taken back
+            pid = os.fork()
+            if not pid:
+                os._exit(0)
+            os.waitpid(pid, 0)
+            for name in ("a.mail@%s:%i" % (socket.gethostname(), pid),
+                         "b.mail@%s:%i" % (socket.gethostname(), os.getpid()),
+                         "c.mail@smtp.mail.example.com:1",
+                         # claimed by an older version
+                         "d.mail.elsewhere:1"):
+                open(os.path.join(tempdir, name), "w").close()
+            self.assertEqual(outbox.reclaim(), 1)
+            outbox.claim_timeout = 0
+            self.assertEqual(outbox.reclaim(), 2)
+            self.assertEqual(outbox.pending(), ["a.mail", "c.mail", "d.mail"])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_streamed_attachments(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            report = os.path.join(tempdir, "report.csv")
+            with open(report, "wb") as outf:
+                for i in xrange(20000):
+                    outf.write("%i,.line\n" % i)
+            with open(report, "rb") as inf:
+                expected = inf.read()
+            chunks = ("x" * 1000 for _ in xrange(500))
+
+            class MailBot(Robot):
+
+                AUTHOR = "robot@example.com"
+
+                def work(self):
+                    self.sendmail(u"Bericht", ["nobody@example.com"], text=u"Grüße",
+                                  attachments=[
+                                      Attachment(report),
+                                      Attachment(chunks, name="x.bin"),
+                                      ("small.txt", "small"),
+                                      ])
+
+            sink = self.start_smtp_sink()
+            self.start_robot(robot_class=MailBot, smtp_sink=sink)
+            self.assertEqual(sink.stats()["messages"], 1)
+            message = email.message_from_string(sink.messages[0][2])
+            parts = [part for part in message.walk() if not part.is_multipart()]
+            self.assertEqual(
+                [(p.get_filename(), p.get_content_type()) for p in parts],
+                [(None, "text/plain"), ("report.csv", "text/csv"),
+                 ("x.bin", "application/octet-stream"), ("small.txt", "text/plain")])
+            self.assertEqual(parts[0].get_payload(decode=True), u"Grüße".encode("utf-8"))
+            self.assertEqual(parts[1].get_payload(decode=True), expected)
+            self.assertEqual(parts[2].get_payload(decode=True), "x" * 500000)
+            self.assertEqual(parts[3].get_payload(decode=True), "small")
+
+            # without SMTP, the message is assembled
+            self.start_robot(robot_class=MailBot)
+            assert "Subject: Bericht" in self.get_messages()[0]
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_attachment_compression_and_artifacts(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            report = "".join("%i,line\n" % i for i in xrange(10000))
+
+            class MailBot(Robot):
+
+                AUTHOR = "robot@example.com"
+
+                def work(self):
+                    self.sendmail(u"Bericht", ["nobody@example.com"], text=u"Grüße",
+                                  attachments=[
+                                      ("small.csv", "a,b\n"),
+                                      ("report.csv", report),
+                                      ("report.log", report),
+                                      ("huge.csv", report * 4),
+                                      ])
+
+            sink = self.start_smtp_sink()
+            config = {"mail": {
+                "attachments.compress": "gzip",
+                "attachments.compress_threshold": "1000",
+                "attachments.max_size": str(len(report) * 2),
+                "attachments.artifact_dir": tempdir,
+                "attachments.artifact_url": "http://robots/artifacts/",
+                }}
+            self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config)
+            message = email.message_from_string(sink.messages[0][2])
+            parts = [part for part in message.walk() if not part.is_multipart()]
+            self.assertEqual(
+                [(p.get_filename(), p.get_content_type()) for p in parts],
+                [(None, "text/plain"), ("small.csv", "text/csv"),
+                 ("report.csv.gz", "application/gzip"),
+                 ("report.log.gz", "application/gzip")])
+            compressed = parts[2].get_payload(decode=True)
+            assert len(compressed) < len(report) / 2
+            self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), report)
+
+            text = parts[0].get_payload(decode=True).decode("utf-8")
+            assert text.startswith(u"Grüße")
+            [stored] = os.listdir(tempdir)
+            assert u"huge.csv (%i bytes): http://robots/artifacts/%s/huge.csv" \
+                   % (len(report) * 4, stored) in text
+            with open(os.path.join(tempdir, stored, "huge.csv")) as inf:
+                self.assertEqual(inf.read(), report * 4)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_zip_chunks(self):
+        content = "".join("%i,line\n" % i for i in xrange(10000))
+        data = "".join(zip_chunks("report.csv", rechunk([content], 1000)))
+        archive = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(archive.namelist(), ["report.csv"])
+        self.assertEqual(archive.read("report.csv"), content)
+        self.assertEqual(archive.testzip(), None)
+
+
+    def test_mail_queue(self):
+
+        class MailBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            def work(self):
+                start = time()
+                for i in xrange(4):
+                    self.sendmail("mail %i" % i, "nobody@example.com", text="text")
+                return time() - start
+
+        sink = self.start_smtp_sink()
+        sink.delays["DATA"] = 0.2
+        config = {"mail": {"manager": "queue", "queue.workers": "2", "retry.attempts": "1"}}
+        robot = self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config, norun=True)
+        assert robot.run() < 0.2
+        self.assertEqual(sink.stats()["messages"], 4)
+        self.assertEqual(sink.stats()["max_active_connections"], 2)
+        self.assertEqual(robot.undelivered_mails, [])
+
+        sink.delays["DATA"] = 1.0
+        config["mail"]["queue.drain_timeout"] = "0.3"
+        robot = self.start_robot(robot_class=MailBot, smtp_sink=sink, config=config, norun=True)
+        robot.run()
+        self.assertEqual(sorted(m.subject for m in robot.undelivered_mails),
+                         ["mail %i" % i for i in xrange(4)])
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import tempfile
+import shutil
+from unittest import TestCase
+
+from abl.robot.state import StateStore
+
+
+class StateStoreTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "state.db")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_values_survive_reopening(self):
+        store = StateStore(self.filename, commit_every=1000)
+        store["mark"] = dict(offset=10, name="foo")
+        store.set("other", [1, 2])
+        self.assertEqual(store.get("missing", 42), 42)
+        store.close()
+
+        store = StateStore(self.filename)
+        self.assertEqual(store["mark"], dict(offset=10, name="foo"))
+        self.assertEqual(store["other"], [1, 2])
+        del store["other"]
+        assert "other" not in store
+        self.failUnlessRaises(KeyError, store.__getitem__, "other")
+
+
+    def test_compare_and_set(self):
+        store = StateStore()
+        assert store.compare_and_set("mark", None, 1)
+        assert not store.compare_and_set("mark", None, 2)
+        assert not store.compare_and_set("mark", 5, 2)
+        assert store.compare_and_set("mark", 1, dict(b=1, a=2))
+        assert store.compare_and_set("mark", dict(a=2, b=1), 3)
+        self.assertEqual(store["mark"], 3)
+
+
+    def test_batched_commits(self):
+        store = StateStore(self.filename, commit_every=2, commit_interval=3600)
+        reader = StateStore(self.filename)
+        store["a"] = 1
+        assert "a" not in reader
+        store["b"] = 2
+        self.assertEqual(reader["a"], 1)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import shutil
+import tempfile
+import threading
+from time import time, sleep
+from unittest import TestCase
+
+from abl.robot import Robot
+from abl.robot.test import RobotTestCase
+from abl.robot.trigger import InotifyWatcher, PollingWatcher
+
+
+def touch(path, content="x"):
+    with open(path, "w") as outf:
+        outf.write(content)
+
+
+
+class WatcherTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+        self.spool = os.path.join(self.tempdir, "spool")
+        os.mkdir(self.spool)
+        self.single = os.path.join(self.tempdir, "single")
+        touch(self.single)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def check_watcher(self, watcher):
+        try:
+            self.assertEqual(watcher.changes(0.01), set())
+            touch(os.path.join(self.spool, "a"))
+            os.mkdir(os.path.join(self.spool, "sub"))
+            touch(os.path.join(self.tempdir, "unwatched"))
+            sleep(0.1)
+            changed = watcher.wait(0.2)
+            assert os.path.join(self.spool, "a") in changed
+            assert os.path.join(self.spool, "sub") in changed
+            assert os.path.join(self.tempdir, "unwatched") not in changed
+
+            touch(os.path.join(self.spool, "sub", "b"))
+            os.rename(os.path.join(self.spool, "a"), os.path.join(self.spool, "c"))
+            touch(self.single + ".tmp", "new")
+            os.rename(self.single + ".tmp", self.single)
+            changed = watcher.wait(0.2)
+            self.assertEqual(changed, set([
+                os.path.join(self.spool, "sub", "b"),
+                os.path.join(self.spool, "a"),
+                os.path.join(self.spool, "c"),
+                self.single,
+                ]))
+        finally:
+            watcher.close()
+
+
+    def test_inotify(self):
+        if not InotifyWatcher.available():
+            return
+        self.check_watcher(InotifyWatcher([self.spool, self.single]))
+
+
+    def test_inotify_missing_and_recreated(self):
+        if not InotifyWatcher.available():
+            return
+        later = os.path.join(self.tempdir, "later", "spool")
+        watcher = InotifyWatcher([self.spool, later])
+        try:
+            shutil.rmtree(self.spool)
+            self.assertEqual(watcher.wait(0.2), set([self.spool]))
+            os.mkdir(self.spool)
+            self.assertEqual(watcher.wait(0.2), set([self.spool]))
+            touch(os.path.join(self.spool, "a"))
+            self.assertEqual(watcher.wait(0.2), set([os.path.join(self.spool, "a")]))
+
+            os.makedirs(later)
+            self.assertEqual(watcher.wait(0.2), set([later]))
+            touch(os.path.join(later, "b"))
+            self.assertEqual(watcher.wait(0.2), set([os.path.join(later, "b")]))
+
+            missing = os.path.join(self.tempdir, "missing")
+            watcher.close()
+            watcher = InotifyWatcher([missing])
+            touch(missing)
+            self.assertEqual(watcher.wait(0.2), set([missing]))
+            touch(missing, "again")
+            self.assertEqual(watcher.wait(0.2), set([missing]))
+        finally:
+            watcher.close()
+
+
+    def test_polling(self):
+        self.check_watcher(PollingWatcher([self.spool, self.single], interval=0.05))
+
+
+    def test_debouncing(self):
+        watcher = PollingWatcher([self.spool], interval=0.05)
+        stop = threading.Event()
+
+        def write():
+            for i in xrange(10):
+                touch(os.path.join(self.spool, str(i)))
+                sleep(0.03)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        changed = watcher.wait(0.2)
+        writer.join()
+        self.assertEqual(len(changed), 10)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        changed = watcher.wait(0.2, max_delay=0.1)
+        writer.join()
+        assert 0 < len(changed) < 10
+
+        stop.set()
+        self.assertEqual(watcher.wait(0.2, stop=stop), set())
+
+
+
+class TriggerBot(Robot):
+
+    AUTHOR = "robot@example.com"
+    EXCEPTION_MAILING = "robot@example.com"
+
+    def __init__(self):
+        super(TriggerBot, self).__init__()
+        self.calls = []
+
+
+    def work_on_changes(self, paths):
+        self.calls.append(paths)
+        if any(path.endswith("fail") for path in paths):
+            raise ValueError("failing on purpose")
+
+
+
+class TriggerRobotTests(RobotTestCase):
+
+    def test_trigger_mode(self):
+        tempdir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            config = dict(
+                mail=dict(transport="debug"),
+                error_handler={"mail.on": "true"},
+                trigger=dict(paths=tempdir, debounce="0.1", backend="poll",
+                             poll_interval="0.05"),
+                )
+            handle = self.start_robot(config=config, robot_class=TriggerBot,
+                                      argv=["--trigger"], threaded=True, handle=True,
+                                      raise_exceptions=False)
+            robot = handle.robot
+            start = time()
+            while len(robot.calls) < 1:
+                assert time() - start < 10
+                sleep(0.05)
+            self.assertEqual(robot.calls[0], set([tempdir]))
+
+            touch(os.path.join(tempdir, "fail"))
+            while len(robot.calls) < 2:
+                assert time() - start < 10
+                sleep(0.05)
+            touch(os.path.join(tempdir, "a"))
+            touch(os.path.join(tempdir, "b"))
+            while len(robot.calls) < 3:
+                assert time() - start < 10
+                sleep(0.05)
+            robot.stop_watching()
+            handle.wait(10)
+            self.assertEqual(robot.calls[2], set([os.path.join(tempdir, "a"),
+                                                  os.path.join(tempdir, "b")]))
+            self.assertEqual(robot.last_run["outcome"], "ok")
+            [message] = self.get_messages()
+            assert "failing on purpose" in message
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_plain_robot(self):
+
+        class PlainBot(Robot):
+
+            AUTHOR = "robot@example.com"
+
+            runs = 0
+
+            def work(self):
+                self.runs += 1
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            config = dict(
+                mail=dict(transport="debug"),
+                trigger=dict(paths=tempdir, backend="poll", poll_interval="0.05"),
+                splay={"max": "1000"},
+                )
+            handle = self.start_robot(config=config, robot_class=PlainBot,
+                                      argv=["--trigger"], threaded=True, handle=True)
+            start = time()
+            while not handle.robot.runs:
+                assert time() - start < 10
+                sleep(0.05)
+            handle.robot.stop_watching()
+            handle.wait(10)
+            self.assertEqual(handle.robot.last_run["outcome"], "ok")
+            assert "splay" not in handle.robot.last_run
+        finally:
+            shutil.rmtree(tempdir)
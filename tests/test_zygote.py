@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# (C) 2013 Ableton AG
+#******************************************************************************
+from __future__ import with_statement
+
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import stat
+import shutil
+import socket
+import tempfile
+import subprocess
+from time import time, sleep
+from unittest import TestCase
+
+from abl.robot import Robot
+from abl.robot.zygote import spawn
+
+
+class EchoBot(Robot):
+
+    AUTHOR = "robot@example.com"
+
+    def work(self):
+        if os.environ.get("ECHO_FAIL"):
+            raise ValueError("asked to fail")
+        print "%s %s %s" % (os.getpid(), os.environ["ECHO"], " ".join(self.rest[1:]))
+
+
+
+class ZygoteTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tempdir, "zygote.sock")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.server = subprocess.Popen(
+            [sys.executable, "-m", "abl.robot.zygote", "serve",
+             "--socket", self.socket, "--preload", "tests.test_zygote",
+             "--loglevel", "WARNING", "--request-timeout", "0.5"],
+            cwd=root,
+            )
+        with open(os.path.join(self.tempdir, "echo.ini"), "w") as outf:
+            outf.write("[mail]\ntransport = debug\n")
+        start = time()
+        while not os.path.exists(self.socket):
+            assert self.server.poll() is None and time() - start < 30, "The zygote didn't start"
+            sleep(0.05)
+
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tempdir)
+
+
+    def run_echo(self, *argv, **env):
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        with open(os.devnull) as stdin:
+            code = spawn(self.socket, "tests.test_zygote:EchoBot", ("-c", "echo.ini") + argv,
+                         env=env, cwd=self.tempdir, stdio=(stdin, stdout, stderr))
+        stdout.seek(0)
+        stderr.seek(0)
+        return code, stdout.read(), stderr.read()
+
+
+    def test_forking_robots(self):
+        code, out, err = self.run_echo("foo", "bar", ECHO="hello")
+        self.assertEqual(code, 0, err)
+        pid, echo = out.split(" ", 1)
+        self.assertEqual(echo, "hello foo bar\n")
+        assert int(pid) not in (os.getpid(), self.server.pid)
+
+        code, out, _ = self.run_echo("--config-spec", ECHO="hello")
+        self.assertEqual(code, 0)
+        assert "[deadline]" in out
+
+        code, out, err = self.run_echo("--raise-exceptions", ECHO="hello", ECHO_FAIL="1")
+        self.assertEqual(code, 1)
+        assert "asked to fail" in err
+        self.assertEqual(self.server.poll(), None)
+
+
+    def test_socket_permissions(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode), 0o600)
+
+
+    def test_stalled_client(self):
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            stalled.connect(self.socket)
+            start = time()
+            code, out, err = self.run_echo(ECHO="hello")
+            self.assertEqual(code, 0, err)
+            assert time() - start < 5
+            # the server hung up on the stalled client
+            self.assertEqual(stalled.recv(1), "")
+        finally:
+            stalled.close()